@@ -0,0 +1,314 @@
+"""
+Headless benchmarks for the dispatch console's hot path.
+
+Loads a layout, makes up MRBus status traffic for every node its sensors listen
+to, and times each stage separately - decoding, applying packets to the layout,
+control point recalculation, block route tracing and drawing cells, with and
+without the tile atlas - with no display needed.  Drawing goes to a RecordingDC
+that just counts calls.
+
+  python benchmark.py [layout.json] [--packets N] [--seed N] [--json results.json]
+
+With --scale, layouts that many times the size of the given one are generated
+(see layoutGenerator.py) and each is timed for startup, memory and packets/sec.
+
+  python benchmark.py --scale 1,5,10,50
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import cells
+from mrbusUtils import MRBusPacket, MRBusDecoder
+from mrbusBuffer import MRBusPacketBuffer
+from dispatchEngine import DispatchEngine
+from cells import GDICache, TileAtlas
+from layoutGenerator import generateLayout, makeTrafficProfile
+
+
+# Stands in for a wx.DC, counting what would have been drawn
+class RecordingDC:
+  def __init__(self):
+    self.calls = { }
+
+  def record(self, name):
+    self.calls[name] = self.calls.get(name, 0) + 1
+
+  def SetBrush(self, brush):
+    self.record('SetBrush')
+
+  def SetPen(self, pen):
+    self.record('SetPen')
+
+  def SetTextForeground(self, color):
+    self.record('SetTextForeground')
+
+  def DrawLine(self, x1, y1, x2, y2):
+    self.record('DrawLine')
+
+  def DrawRectangle(self, x, y, w, h):
+    self.record('DrawRectangle')
+
+  def DrawCircle(self, x, y, r):
+    self.record('DrawCircle')
+
+  def DrawText(self, text, x, y):
+    self.record('DrawText')
+
+  def DrawBitmap(self, bitmap, x, y):
+    self.record('DrawBitmap')
+
+  def SelectObject(self, bitmap):
+    self.record('SelectObject')
+
+
+# Pens, brushes and tile bitmaps for the cells to hand the RecordingDC when wx isn't installed
+class RecordedGDIObject:
+  def __init__(self, *args, **kwargs):
+    self.args = args
+    self.kwargs = kwargs
+
+class StandInWx:
+  Pen = RecordedGDIObject
+  Brush = RecordedGDIObject
+  Font = RecordedGDIObject
+  Bitmap = RecordedGDIObject
+  MemoryDC = RecordingDC
+  NullBitmap = None
+
+
+# Makes up status traffic from a traffic profile (see makeTrafficProfile).  Most
+# packets repeat the node's last status, like the real bus, and the rest flip one of
+# the bits a sensor is watching.
+class SyntheticTraffic:
+  def __init__(self, profile, seed=1):
+    self.rng = random.Random(seed)
+    self.changeRate = profile['changeRate']
+    self.nodes = [ ]
+    self.payloads = { }
+    self.watchedBits = { }
+
+    for node in profile['nodes']:
+      key = (node['src'], node['cmd'])
+      self.nodes.append(key)
+      self.payloads[key] = bytearray(node['length'])
+      self.watchedBits[key] = [tuple(bit) for bit in node['watchedBits']]
+
+  def packets(self, count):
+    pkts = [ ]
+    for i in range(count):
+      key = self.nodes[self.rng.randrange(len(self.nodes))]
+      payload = self.payloads[key]
+      if self.rng.random() < self.changeRate:
+        (byte, bit) = self.rng.choice(self.watchedBits[key])
+        payload[byte] ^= 1 << bit
+      pkts.append(MRBusPacket.fromValues(0xFF, key[0], key[1], bytes(payload)))
+    return pkts
+
+
+# Wraps a method on every object in objs so the time spent in it is added to stats
+def timeMethod(objs, methodName, stats):
+  for obj in objs:
+    method = getattr(obj, methodName)
+    def timed(*args, method=method, **kwargs):
+      startTime = time.perf_counter()
+      try:
+        return method(*args, **kwargs)
+      finally:
+        stats['total'] += time.perf_counter() - startTime
+        stats['count'] += 1
+    setattr(obj, methodName, timed)
+
+def result(count, total, **extra):
+  r = { 'count':count, 'totalSeconds':total, 'perOpMicroseconds':0.0, 'opsPerSecond':0.0 }
+  if count > 0 and total > 0:
+    r['perOpMicroseconds'] = total / count * 1000000
+    r['opsPerSecond'] = count / total
+  r.update(extra)
+  return r
+
+def benchDecode(pkts, decoder, encode):
+  payloads = [encode(pkt) for pkt in pkts]
+  decode = decoder.decode
+  startTime = time.perf_counter()
+  for payload in payloads:
+    decode(payload)
+  return result(len(payloads), time.perf_counter() - startTime, bytesPerPacket=sum([len(p) for p in payloads]) / max(1, len(payloads)))
+
+def benchApply(engine, pkts, batchSize):
+  startTime = time.perf_counter()
+  for i in range(0, len(pkts), batchSize):
+    engine.applyPackets(pkts[i:i+batchSize])
+  return result(len(pkts), time.perf_counter() - startTime, batchSize=batchSize)
+
+def benchPipeline(engine, pkts, batchSize):
+  # JSON off the wire, through the decoder and buffer, drained in batches and applied
+  decoder = MRBusDecoder()
+  decoder.setWantedSources(engine.getWantedSources())
+  buffer = MRBusPacketBuffer(maxsize=len(pkts) + 1)
+  payloads = [pkt.toJSON().encode() for pkt in pkts]
+  startTime = time.perf_counter()
+  for i in range(0, len(payloads), batchSize):
+    for payload in payloads[i:i+batchSize]:
+      pkt = decoder.decode(payload)
+      if pkt is not None:
+        buffer.put(pkt)
+    engine.applyPackets(buffer.drain())
+  return result(len(payloads), time.perf_counter() - startTime, batchSize=batchSize)
+
+# Sets a sensor's bit in the traffic's payload for its node, returning False if the
+# traffic doesn't carry that bit
+def setSensor(traffic, sensor, state):
+  payload = traffic.payloads.get((sensor.src, sensor.cmd))
+  if payload is None or sensor.byte >= len(payload):
+    return False
+  if state != sensor.negate:
+    payload[sensor.byte] |= 1 << sensor.bit
+  else:
+    payload[sensor.byte] &= ~(1 << sensor.bit)
+  return True
+
+# Turns on the first sensor of every CP - a lined bit, or an entrance signal's on the
+# crossovers - with the CP's switches normal and its blocks empty, so recalculating
+# CPs traces routes rather than mostly clearing them.  Goes through the traffic's
+# payloads so later packets from the same nodes keep it that way.
+def lineRoutes(engine, traffic):
+  linedSensors = [ ]
+  for cp in engine.controlpoints:
+    for switch in cp.switches.values():
+      setSensor(traffic, switch.sensorNormal, True)
+      setSensor(traffic, switch.sensorReverse, False)
+    for block in cp.blocks.values():
+      setSensor(traffic, block.sensorOccupancy, False)
+    for sensor in cp.sensors.values():
+      if setSensor(traffic, sensor, True):
+        linedSensors.append(sensor)
+      break
+  engine.applyPackets([MRBusPacket.fromValues(0xFF, src, cmd, bytes(payload)) for ((src, cmd), payload) in sorted(traffic.payloads.items())])
+  return sum(1 for sensor in linedSensors if sensor.getState())
+
+def benchRecalculate(engine, rounds):
+  # Route tracing only happens inside CP recalculation, so time it from in there
+  traceStats = { 'total':0.0, 'count':0 }
+  timeMethod([block for block in engine.blocks if getattr(block, 'cp', None) is not None], 'routeTracer', traceStats)
+
+  startTime = time.perf_counter()
+  for i in range(rounds):
+    for cp in engine.controlpoints:
+      cp.recalculateState()
+  total = time.perf_counter() - startTime
+
+  for block in engine.blocks:
+    block.__dict__.pop('routeTracer', None)
+  return (result(rounds * len(engine.controlpoints), total), result(traceStats['count'], traceStats['total']))
+
+def benchDraw(engine, rounds, useAtlas=True):
+  TileAtlas.enabled = useAtlas
+  TileAtlas.clear()
+  dc = RecordingDC()
+  startTime = time.perf_counter()
+  try:
+    for i in range(rounds):
+      for cell in engine.cells:
+        cell.draw(dc)
+  finally:
+    TileAtlas.enabled = True
+  return result(rounds * len(engine.cells), time.perf_counter() - startTime, dcCalls=dc.calls, gdiObjects=len(GDICache.pens) + len(GDICache.brushes), tiles=len(TileAtlas.tiles))
+
+def runBenchmarks(layoutData, packetCount=20000, seed=1, rounds=200):
+  engine = DispatchEngine()
+  engine.loadLayout(layoutData)
+  traffic = SyntheticTraffic(makeTrafficProfile(engine.sensorTable), seed=seed)
+  pkts = traffic.packets(packetCount)
+
+  # Each apply run gets traffic carrying on from the last, rather than a replay of
+  # packets the layout has already seen
+  results = { }
+  results['decodeJSON'] = benchDecode(pkts, MRBusDecoder(), lambda pkt: pkt.toJSON().encode())
+  results['decodeBinary'] = benchDecode(pkts, MRBusDecoder(), lambda pkt: pkt.toBinary())
+  results['applyPacket'] = benchApply(engine, pkts, 1)
+  results['applyPackets'] = benchApply(engine, traffic.packets(packetCount), 50)
+  results['pipeline'] = benchPipeline(engine, traffic.packets(packetCount), 50)
+  linedRoutes = lineRoutes(engine, traffic)
+  (results['cpRecalculateState'], results['blockRouteTracer']) = benchRecalculate(engine, rounds)
+  results['cellDraw'] = benchDraw(engine, rounds)
+  results['cellDrawNoAtlas'] = benchDraw(engine, rounds, useAtlas=False)
+
+  info = { 'layoutName':layoutData.get('layoutName', ''), 'python':platform.python_version(), 'seed':seed,
+    'packets':packetCount, 'nodes':len(traffic.nodes), 'sensors':len(engine.sensorTable), 'cells':len(engine.cells),
+    'blocks':len(engine.blocks), 'switches':len(engine.switches), 'signals':len(engine.signals), 'controlPoints':len(engine.controlpoints),
+    'linedRoutes':linedRoutes }
+  return { 'info':info, 'results':results }
+
+# Startup time, memory and packets/sec for the template layout scaled up by each factor
+def runScaling(template, factors, packetCount=20000, seed=1):
+  results = [ ]
+  for factor in factors:
+    layoutData = generateLayout(template, factor)
+
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    engine = DispatchEngine()
+    engine.loadLayout(layoutData)
+    startup = time.perf_counter() - startTime
+    (memory, peakMemory) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    traffic = SyntheticTraffic(makeTrafficProfile(engine.sensorTable), seed=seed)
+    apply = benchApply(engine, traffic.packets(packetCount), 50)
+    results.append({ 'scale':factor, 'blocks':len(engine.blocks), 'controlPoints':len(engine.controlpoints), 'cells':len(engine.cells),
+      'nodes':len(traffic.nodes), 'startupSeconds':startup, 'memoryBytes':memory, 'peakMemoryBytes':peakMemory,
+      'packetsPerSecond':apply['opsPerSecond'] })
+  return results
+
+def printResults(report):
+  info = report['info']
+  print("%s - %d nodes, %d sensors, %d cells, %d CPs (%d lined), python %s" % (info['layoutName'], info['nodes'], info['sensors'], info['cells'], info['controlPoints'], info['linedRoutes'], info['python']))
+  for (name, r) in report['results'].items():
+    print("  %-20s %9d ops  %10.2f us/op  %12.0f ops/s" % (name, r['count'], r['perOpMicroseconds'], r['opsPerSecond']))
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the dispatch console's packet and drawing path")
+  parser.add_argument('layout', nargs='?', default='layout.json')
+  parser.add_argument('--packets', type=int, default=20000)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--rounds', type=int, default=200, help="passes over every CP / cell for the recalculate and draw benchmarks")
+  parser.add_argument('--json', help="also write the results to this file")
+  parser.add_argument('--scale', help="comma separated layout size multipliers to measure scaling at, e.g. 1,5,10,50")
+  args = parser.parse_args()
+
+  if cells.wx is None:
+    cells.wx = StandInWx
+
+  with open(args.layout) as file:
+    layoutData = json.load(file)
+
+  # Layout objects chatter on stdout, keep it out of the results
+  realStdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    if args.scale:
+      report = { 'scaling':runScaling(layoutData, [int(f) for f in args.scale.split(',')], args.packets, args.seed) }
+    else:
+      report = runBenchmarks(layoutData, args.packets, args.seed, args.rounds)
+  finally:
+    sys.stdout.close()
+    sys.stdout = realStdout
+
+  if args.scale:
+    print("  scale  blocks    CPs  nodes  startup ms   memory KB    pkts/s")
+    for r in report['scaling']:
+      print("  %5d  %6d  %5d  %5d  %10.1f  %10.0f  %8.0f" % (r['scale'], r['blocks'], r['controlPoints'], r['nodes'], r['startupSeconds'] * 1000, r['memoryBytes'] / 1024, r['packetsPerSecond']))
+  else:
+    printResults(report)
+
+  if args.json:
+    with open(args.json, 'w') as file:
+      json.dump(report, file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
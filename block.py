@@ -1,8 +1,10 @@
-from cells import SwitchCell,TrackCellColors,TrackCellType
-from mrbusUtils import MRBusBit,MRBusPacket
+from cells import SwitchCell,TrackCellType
+from mrbusUtils import MRBusPacket
 import datetime
 import re
-from cells import TrackCell, TrackCellColors, TrackCellType
+from cells import TrackCell, TrackCellType
+from palette import Palette
+from trackGraph import TrackGraph
 
 def relCoord(base_x, newVal):
   newVal = str(newVal)
@@ -21,7 +23,7 @@ def relCoord(base_x, newVal):
   return int(newVal)
 
 class Block:
-  def __init__(self, config, txCallback, cellXY):
+  def __init__(self, config, txCallback, cellXY, sensorTable):
     self.name = config['name']
     self.type = config['type']
     self.manualControl = False
@@ -36,7 +38,9 @@ class Block:
     self.base_x = 0
     self.base_y = 0
     self.cellXY = cellXY
-    self.linedCells = [ ]
+    self.trackGraph = None
+    self.linedCells = [ ]       # Cells on the traced route, in the order they were traced
+    self.linedCellSet = set()   # The same cells, for asking whether a cell is lined
     self.cp = None
     
     if "leftAdjoiningBlockName" in config.keys():
@@ -49,17 +53,17 @@ class Block:
     pattern = ""
     if "sensorManual" in config.keys():
       pattern = config['sensorManual']
-    self.sensorManual = MRBusBit(pattern)
+    self.sensorManual = sensorTable.addSensor(pattern, False, self)
 
     pattern = ""
     if "sensorOccupancy" in config.keys():
       pattern = config['sensorOccupancy']
-    self.sensorOccupancy = MRBusBit(pattern)
+    self.sensorOccupancy = sensorTable.addSensor(pattern, False, self)
 
     pattern = ""
     if "sensorPower" in config.keys():
       pattern = config['sensorPower']
-    self.sensorPower = MRBusBit(pattern, True)
+    self.sensorPower = sensorTable.addSensor(pattern, True, self)
 
     self.cells = [ ]
     if "base_x" in config.keys():
@@ -109,7 +113,13 @@ class Block:
 
   # processPacket takes an incoming MRBus packet
   def processPacket(self, pkt):
-#    print("Block [%s] processing packet [%s]"% (self.name, pkt))
+    if self.updateFromPacket(pkt):
+      self.recalculateState()
+
+  # Applies the packet to the block's sensor state only, returns true if
+  # recalculateState() needs to be run afterwards
+  def updateFromPacket(self, pkt):
+#    print("Block [%s] processing packet [%s]"% (self.name, str(pkt)))
     changed = self.sensorManual.testPacket(pkt)
     changed = self.sensorOccupancy.testPacket(pkt) or changed
     changed = self.sensorPower.testPacket(pkt) or changed
@@ -119,7 +129,7 @@ class Block:
       self.manualControl = self.sensorManual.getState()
       self.occupied = self.sensorOccupancy.getState()
       self.powerOn = self.sensorPower.getState()
-      self.recalculateState()
+    return changed
 
   def isOccupied(self):
     return self.occupied
@@ -145,6 +155,7 @@ class Block:
       else:
         nextBlockName = self.rightAdjoiningBlockName
         #print("Right 2 adjoining block name [%s]" % (nextBlockName))
+    self.linedCellSet = set(self.linedCells)
     self.recalculateState()
     return nextBlockName
   
@@ -155,14 +166,14 @@ class Block:
     self.lined = False
 
     if self.cp:
+      # Every step of a trace moves one cell further the same way, so the route's
+      # far end is the last cell traced
       if self.linedLeftBound:
         x = 16000;
         y = 16000;
 
-        for cell in self.linedCells:
-          if cell.cell_x < x:
-            x = cell.cell_x
-            y = cell.cell_y
+        if len(self.linedCells) > 0:
+          (x, y) = self.linedCells[-1].getXY()
 
         if (x-1,y) in self.cellXY.keys():
           #print("Looking for next block at %d/%d" % (x-1, y))
@@ -173,10 +184,8 @@ class Block:
         x = 0;
         y = 0;
 
-        for cell in self.linedCells:
-          if cell.cell_x >= x:
-            x = cell.cell_x
-            y = cell.cell_y
+        if len(self.linedCells) > 0:
+          (x, y) = self.linedCells[-1].getXY()
 
         if (x+1,y) in self.cellXY.keys():
           #print("Looking for next block at %d/%d" % (x+1, y))
@@ -191,6 +200,7 @@ class Block:
         nextBlockName = self.rightAdjoiningBlockName
         #print("Right 2 adjoining block name [%s]" % (nextBlockName))
     self.linedCells = [ ]
+    self.linedCellSet = set()
     self.recalculateState()
     return nextBlockName
 
@@ -203,200 +213,46 @@ class Block:
 
   def recalculateState(self):
     #print("Recalculating state for [%s]" % (self.name))
-    trackColor = TrackCellColors.getColor('track_unknown')
+    trackColor = Palette.track_unknown
 
     # Compute track color
     
     if not self.powerOn:
-      trackColor = TrackCellColors.getColor('track_nopower')
+      trackColor = Palette.track_nopower
     elif self.occupied:
-      trackColor = TrackCellColors.getColor('track_occupied')
+      trackColor = Palette.track_occupied
       self.lined = False  # if we're occupied, we can't be lined
     elif self.lined:
-      trackColor = TrackCellColors.getColor('track_lined')
+      trackColor = Palette.track_lined
     elif self.manualControl:
-      trackColor = TrackCellColors.getColor('track_manual')
+      trackColor = Palette.track_manual
     else:
-      trackColor = TrackCellColors.getColor('track_idle')
-
-    for i in range(0, len(self.cells)):
-      if self.cp and trackColor == TrackCellColors.getColor('track_lined'):
-        # only make the traced cells lined
-        if self.cells[i] in self.linedCells:
-          self.cells[i].setColor(trackColor)
-        else:
-          self.cells[i].setColor(TrackCellColors.getColor('track_idle'))
-      else:
-        self.cells[i].setColor(trackColor)
-
-  def routeTracer(self, startX, startY, walkLeft):
-    x = startX
-    y = startY
-    
-    #print("Tracing route squirrel - startx=%d starty=%d" % (x,y))
-    # From our current point, we need to walk left or right 
-    # until we hit the end of the CP
-
-    try:
-      nextBlock = None
-      stillWalking = True
-      while(stillWalking):
-
-        if (x,y) not in self.cellXY.keys():
-          #print("x=%d y=%d not in cellXY keys, ending" % (x, y))
-          stillWalking = False
-          break
-
-        cell = self.cellXY[(x,y)]
-        if walkLeft:
-          #print("Walking left - x=%d, y=%d, type=%s" % (x, y, cell.trackType))
-
-          if cell.trackType == TrackCellType.HORIZONTAL:
-            self.linedCells.append(cell)
-            x = x - 1
-            
-          elif cell.trackType == TrackCellType.END_HORIZ_RIGHT:
-            self.linedCells.append(cell)
-            x = x - 1
-
-          elif cell.trackType == TrackCellType.END_HORIZ_LEFT:
-            self.linedCells.append(cell)
-            
-            if (x-1,y) in self.cellXY.keys():
-              #print("Looking for next block at %d/%d" % (x-1, y))
-              nextBlockCell = self.cellXY[(x-1,y)]
-              nextBlock = nextBlockCell.owner.name
-            else:
-              pass
-              #print("No next block at %d/%d" % (x-1, y))
-            stillWalking = False # terminate walking
-
-          elif cell.trackType == TrackCellType.DIAG_LEFT_UP:
-            self.linedCells.append(cell)
-            x = x - 1
-            y = y - 1
-
-          elif cell.trackType == TrackCellType.DIAG_RIGHT_UP:
-            self.linedCells.append(cell)
-            x = x - 1
-            y = y + 1
-
-          elif cell.trackType == TrackCellType.ANGLE_LEFT_UP:
-            self.linedCells.append(cell)
-            x = x - 1
-            y = y - 1
-
-          elif cell.trackType == TrackCellType.ANGLE_LEFT_DOWN:
-            self.linedCells.append(cell)
-            x = x - 1
-            y = y + 1
-
-          elif cell.trackType == TrackCellType.ANGLE_RIGHT_UP:
-            self.linedCells.append(cell)
-            x = x - 1
-
-          elif cell.trackType == TrackCellType.ANGLE_RIGHT_DOWN:
-            self.linedCells.append(cell)
-            x = x - 1
-
-          elif cell.trackType == TrackCellType.SWITCH_RIGHT_UP:
-            self.linedCells.append(cell)
-            x = x - 1 
-
-          elif cell.trackType == TrackCellType.SWITCH_RIGHT_DOWN:
-            self.linedCells.append(cell)
-            x = x - 1
-
-          elif cell.trackType == TrackCellType.SWITCH_LEFT_UP:
-            self.linedCells.append(cell)
-            x = x - 1 
-            if cell.getSwitchPosition() != 0:
-              y = y - 1
-
-          elif cell.trackType == TrackCellType.SWITCH_LEFT_DOWN:
-            self.linedCells.append(cell)
-            x = x - 1 
-            if cell.getSwitchPosition() != 0:
-              y = y + 1
+      trackColor = Palette.track_idle
+
+    # One pass over the cells, only calling into the ones whose color changes
+    if self.cp and trackColor is Palette.track_lined:
+      # only make the traced cells lined
+      linedCellSet = self.linedCellSet
+      idleColor = Palette.track_idle
+      for cell in self.cells:
+        color = trackColor if cell in linedCellSet else idleColor
+        if cell.color is not color:
+          cell.setColor(color)
+    else:
+      for cell in self.cells:
+        if cell.color is not trackColor:
+          cell.setColor(trackColor)
 
-          else:
-            stillWalking = False  # Don't know where to go from here
-            break
-
-        else:  # Now walking right
-          #print("Walking right")
-          #print("Walking right - x=%d, y=%d, type=%s" % (x, y, cell.trackType))          
-          if cell.trackType == TrackCellType.HORIZONTAL:
-            self.linedCells.append(cell)
-            x = x + 1
-            
-          elif cell.trackType == TrackCellType.END_HORIZ_RIGHT:
-            self.linedCells.append(cell)
-            if (x+1,y) in self.cellXY.keys():
-              #print("Looking for next block at %d/%d" % (x-1, y))
-              nextBlockCell = self.cellXY[(x+1,y)]
-              nextBlock = nextBlockCell.owner.name
-            else:
-              pass
-              #print("No next block at %d/%d" % (x-1, y))
-            stillWalking = False # terminate walking
-
-            
-          elif cell.trackType == TrackCellType.END_HORIZ_LEFT:
-            self.linedCells.append(cell)
-            x = x + 1
-
-          elif cell.trackType == TrackCellType.DIAG_LEFT_UP:
-            self.linedCells.append(cell)
-            x = x + 1
-            y = y + 1
-
-          elif cell.trackType == TrackCellType.DIAG_RIGHT_UP:
-            self.linedCells.append(cell)
-            x = x + 1
-            y = y - 1
-
-          elif cell.trackType == TrackCellType.ANGLE_LEFT_UP:
-            self.linedCells.append(cell)
-            x = x + 1
-
-          elif cell.trackType == TrackCellType.ANGLE_LEFT_DOWN:
-            self.linedCells.append(cell)
-            x = x + 1
-
-          elif cell.trackType == TrackCellType.ANGLE_RIGHT_UP:
-            self.linedCells.append(cell)
-            x = x + 1
-            y = y - 1
-
-          elif cell.trackType == TrackCellType.ANGLE_RIGHT_DOWN:
-            self.linedCells.append(cell)
-            x = x + 1
-            y = y + 1
-
-          elif cell.trackType == TrackCellType.SWITCH_RIGHT_UP:
-            self.linedCells.append(cell)
-            x = x + 1 
-            if cell.switchState != 0:
-              y = y - 1
-          elif cell.trackType == TrackCellType.SWITCH_RIGHT_DOWN:
-            self.linedCells.append(cell)
-            x = x + 1 
-            if cell.switchState != 0:
-              y = y + 1
-
-          elif cell.trackType == TrackCellType.SWITCH_LEFT_UP:
-            self.linedCells.append(cell)
-            x = x + 1 
-          elif cell.trackType == TrackCellType.SWITCH_LEFT_DOWN:
-            self.linedCells.append(cell)
-            x = x + 1 
-          else:
-            stillWalking = False  # Don't know where to go from here
-            break        
-    except Exception as e:
-      print(e)
+  def setTrackGraph(self, trackGraph):
+    self.trackGraph = trackGraph
 
+  def routeTracer(self, startX, startY, walkLeft):
+    # From our current point, follow the compiled track graph left or right until
+    # we hit the end of the CP
+    if self.trackGraph is None:
+      self.trackGraph = TrackGraph(self.cellXY)
+    (cells, nextBlock) = self.trackGraph.trace((startX, startY), walkLeft)
+    self.linedCells.extend(cells)
     return nextBlock
 
   def getCells(self):
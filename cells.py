@@ -1,5 +1,11 @@
 from enum import Enum
-import wx
+from palette import Palette
+
+# wx is only needed to draw, the cells themselves work without it
+try:
+  import wx
+except ImportError:
+  wx = None
 
 class TrackCellType(Enum):
   HORIZONTAL        = 1,
@@ -24,29 +30,75 @@ class TrackCellType(Enum):
 # Each "TrackCell" defines an 16x16 pixel block
 # corresponding to a single track element
 
+# Kept for anything still looking colors up by name, see palette.py
 class TrackCellColors:
   @staticmethod
   def getColor(itemName):
-    colors = {
-      'track_occupied':'#ff0000',
-      'track_idle'    :'#ffffff',
-      'track_lined'   :'#00ff00',
-      'track_manual'  :'#00ccff',
-      'track_unknown' :'#cccccc',
-      'track_nopower' :'#ffd700',
-      'switch_locked' :'#ff0000',
-      'switch_normal' :'#00ff00',
-      'switch_manual' :'#00ccff',
-      'switch_unknown':'#cccccc',
-      'signal_blinkoff':'#777777',
-      'signal_lined'  :'#00ff00',
-      'signal_normal' :'#ff0000',
-      'signal_unknown':'#cccccc',
-      'default'       :'#cccccc',
-    }
-    if itemName in colors.keys():
-      return colors[itemName]
-    return colors['default']
+    return Palette.getColor(itemName)
+
+
+# Pens and brushes are native objects, so rather than every draw() making its own,
+# one of each (color, width, style) is made the first time it's asked for and
+# shared by every cell from then on.  Loading a theme that changes the colors
+# clears it.
+class GDICache:
+  pens = { }
+  brushes = { }
+
+  @staticmethod
+  def getPen(color, width=1, style=None):
+    key = (color, width, style)
+    pen = GDICache.pens.get(key)
+    if pen is None:
+      if style is None:
+        pen = wx.Pen(color, width=width)
+      else:
+        pen = wx.Pen(color, width=width, style=style)
+      GDICache.pens[key] = pen
+    return pen
+
+  @staticmethod
+  def getBrush(color, style=None):
+    key = (color, style)
+    brush = GDICache.brushes.get(key)
+    if brush is None:
+      if style is None:
+        brush = wx.Brush(color)
+      else:
+        brush = wx.Brush(color, style)
+      GDICache.brushes[key] = brush
+    return brush
+
+  @staticmethod
+  def clear():
+    GDICache.pens.clear()
+    GDICache.brushes.clear()
+
+
+# There are only so many ways a cell can look - track type, colors, switch position,
+# blink - so each look is drawn once into a bitmap of its own, the first time a cell
+# needs it, and drawing a cell is then a single blit.  Drawn with the GDICache's pens
+# and brushes, so clear it along with that.
+class TileAtlas:
+  enabled = True
+  tiles = { }
+
+  @staticmethod
+  def getTile(cell):
+    key = (cell.__class__, cell.tileKey())
+    tile = TileAtlas.tiles.get(key)
+    if tile is None:
+      tile = wx.Bitmap(cell.cellSize, cell.cellSize)
+      dc = wx.MemoryDC()
+      dc.SelectObject(tile)
+      cell.drawTile(dc, 0, 0)
+      dc.SelectObject(wx.NullBitmap)
+      TileAtlas.tiles[key] = tile
+    return tile
+
+  @staticmethod
+  def clear():
+    TileAtlas.tiles.clear()
 
 
 
@@ -62,6 +114,7 @@ class TrackCell:
     self.cellSize = 16
     self.color = "#FFF"
     self.changedSinceRefresh = True
+    self.dirtyCells = None   # Set of changed cells shared with the rest of the layout
 
   def setXY(self, x, y):
     self.x = x * self.cellSize
@@ -74,63 +127,89 @@ class TrackCell:
 
   def setColor(self, color):
     if color != self.color:
-      self.changedSinceRefresh = True
+      self.markChanged()
       self.color = color
 
   def getXY(self):
     return (self.cell_x, self.cell_y)
 
+  # Pixel rectangle draw() covers, (x, y, width, height)
+  def getBounds(self):
+    return (self.x, self.y, self.cellSize, self.cellSize)
+
   def needsRedraw(self):
     return self.changedSinceRefresh
 
+  # Cells put themselves in the dirty set as they change, so whoever redraws them
+  # needn't look at the ones that didn't
+  def setDirtySet(self, dirtyCells):
+    self.dirtyCells = dirtyCells
+    if self.changedSinceRefresh:
+      dirtyCells.add(self)
+
+  def markChanged(self):
+    self.changedSinceRefresh = True
+    if self.dirtyCells is not None:
+      self.dirtyCells.add(self)
+
   def setType(self, trackType):
     if self.trackType != trackType:
-      self.changedSinceRefresh = True
+      self.markChanged()
       self.trackType = trackType
 
   def getType(self):
     return self.trackType
 
+  # Everything drawTile() looks at, cells with the same key look the same
+  def tileKey(self):
+    return (self.trackType, self.color)
+
   def draw(self, dc):
-    dc.SetBrush(wx.Brush('#000'))
-    dc.SetPen(wx.Pen("#000"))
-    dc.DrawRectangle(self.x, self.y, self.cellSize, self.cellSize)
+    if TileAtlas.enabled:
+      dc.DrawBitmap(TileAtlas.getTile(self), self.x, self.y)
+    else:
+      self.drawTile(dc, self.x, self.y)
+    self.changedSinceRefresh = False
 
-    dc.SetPen(wx.Pen(self.color, width=2))
+  def drawTile(self, dc, x, y):
+    dc.SetBrush(GDICache.getBrush(Palette.background))
+    dc.SetPen(GDICache.getPen(Palette.background))
+    dc.DrawRectangle(x, y, self.cellSize, self.cellSize)
+
+    dc.SetPen(GDICache.getPen(self.color, width=2))
 
     if self.trackType == TrackCellType.HORIZONTAL:
-      dc.DrawLine(self.x, self.y + (self.cellSize//2 - 1), self.x+self.cellSize-1, self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x, y + (self.cellSize//2 - 1), x+self.cellSize-1, y + (self.cellSize//2 - 1))
 
     elif self.trackType == TrackCellType.END_HORIZ_RIGHT:
-      dc.DrawLine(self.x, self.y + (self.cellSize//2 - 1), self.x+self.cellSize-5, self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x, y + (self.cellSize//2 - 1), x+self.cellSize-5, y + (self.cellSize//2 - 1))
 
     elif self.trackType == TrackCellType.END_HORIZ_LEFT:
-      dc.DrawLine(self.x+4, self.y + (self.cellSize//2 - 1), self.x+self.cellSize-1, self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x+4, y + (self.cellSize//2 - 1), x+self.cellSize-1, y + (self.cellSize//2 - 1))
 
 
     elif self.trackType == TrackCellType.DIAG_LEFT_UP:
-      dc.DrawLine(self.x, self.y, self.x+self.cellSize-1, self.y+self.cellSize-1)
+      dc.DrawLine(x, y, x+self.cellSize-1, y+self.cellSize-1)
 
     elif self.trackType == TrackCellType.DIAG_RIGHT_UP:
-      dc.DrawLine(self.x+self.cellSize-1, self.y, self.x, self.y+self.cellSize-1)
+      dc.DrawLine(x+self.cellSize-1, y, x, y+self.cellSize-1)
 
     elif self.trackType == TrackCellType.ANGLE_LEFT_UP:
-      dc.DrawLine(self.x, self.y, self.x+(self.cellSize//2 - 1), self.y+(self.cellSize//2 - 1))
-      dc.DrawLine(self.x+(self.cellSize//2 - 1), self.y + (self.cellSize//2 - 1), self.x + (self.cellSize - 1), self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x, y, x+(self.cellSize//2 - 1), y+(self.cellSize//2 - 1))
+      dc.DrawLine(x+(self.cellSize//2 - 1), y + (self.cellSize//2 - 1), x + (self.cellSize - 1), y + (self.cellSize//2 - 1))
 
     elif self.trackType == TrackCellType.ANGLE_LEFT_DOWN:
-      dc.DrawLine(self.x, self.y + self.cellSize-1, self.x+(self.cellSize//2 - 1), self.y+(self.cellSize//2 - 1))
-      dc.DrawLine(self.x+(self.cellSize//2 - 1), self.y + (self.cellSize//2 - 1), self.x + (self.cellSize - 1), self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x, y + self.cellSize-1, x+(self.cellSize//2 - 1), y+(self.cellSize//2 - 1))
+      dc.DrawLine(x+(self.cellSize//2 - 1), y + (self.cellSize//2 - 1), x + (self.cellSize - 1), y + (self.cellSize//2 - 1))
 
     elif self.trackType == TrackCellType.ANGLE_RIGHT_UP:
-      dc.DrawLine(self.x + self.cellSize - 1, self.y, self.x+(self.cellSize//2 - 1), self.y+(self.cellSize//2 - 1))
-      dc.DrawLine(self.x+(self.cellSize//2 - 1), self.y + (self.cellSize//2 - 1), self.x, self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x + self.cellSize - 1, y, x+(self.cellSize//2 - 1), y+(self.cellSize//2 - 1))
+      dc.DrawLine(x+(self.cellSize//2 - 1), y + (self.cellSize//2 - 1), x, y + (self.cellSize//2 - 1))
 
     elif self.trackType == TrackCellType.ANGLE_RIGHT_DOWN:
-      dc.DrawLine(self.x + self.cellSize - 1, self.y + self.cellSize-1, self.x+(self.cellSize//2 - 1), self.y+(self.cellSize//2 - 1))
-      dc.DrawLine(self.x+(self.cellSize//2 - 1), self.y + (self.cellSize//2 - 1), self.x, self.y + (self.cellSize//2 - 1))
+      dc.DrawLine(x + self.cellSize - 1, y + self.cellSize-1, x+(self.cellSize//2 - 1), y+(self.cellSize//2 - 1))
+      dc.DrawLine(x+(self.cellSize//2 - 1), y + (self.cellSize//2 - 1), x, y + (self.cellSize//2 - 1))
 
-    self.changedSinceRefresh = False
 
 class TextCell(TrackCell):
   def __init__(self):
@@ -142,20 +221,24 @@ class TextCell(TrackCell):
   def setType(self, signalType):
     if self.trackType != signalType:
       self.trackType = signalType
-      self.changedSinceRefresh = True
+      self.markChanged()
     
   def setText(self, text):
     if text != self.text:
       self.text = text
-      self.changedSinceRefresh = True
+      self.markChanged()
+
+  # The text runs on past the cell, a cell per character is more than enough
+  def getBounds(self):
+    return (self.x, self.y, max(1, len(self.text)) * self.cellSize, self.cellSize)
 
   def draw(self, dc):
-    dc.SetBrush(wx.Brush('#000'))
-    dc.SetPen(wx.Pen("#000"))
+    dc.SetBrush(GDICache.getBrush(Palette.background))
+    dc.SetPen(GDICache.getPen(Palette.background))
     dc.DrawRectangle(self.x, self.y, self.cellSize, self.cellSize)
 
-    dc.SetPen(wx.Pen(self.color, width=2))
-    dc.SetBrush(wx.Brush(self.color))
+    dc.SetPen(GDICache.getPen(self.color, width=2))
+    dc.SetBrush(GDICache.getBrush(self.color))
     dc.SetTextForeground(self.color) 
     dc.DrawText(self.text, self.x, self.y)
     self.changedSinceRefresh = False
@@ -166,14 +249,27 @@ class SignalCell(TrackCell):
     self.color = '#F00'
     self.blinky = False
     self.blinkState = False
+    self.blinkyCells = None
 
   def setColor(self, color, blinky=False):
     if color != self.color:
-      self.changedSinceRefresh = True
+      self.markChanged()
       self.color = color
     if blinky != self.blinky:
       self.blinky = blinky
-      self.changedSinceRefresh = True
+      self.markChanged()
+      if self.blinkyCells is not None:
+        if blinky:
+          self.blinkyCells.add(self)
+        else:
+          self.blinkyCells.discard(self)
+
+  # Blinking cells keep themselves in this set, so the blink timer only has to
+  # look at them and can stop when there aren't any
+  def setBlinkySet(self, blinkyCells):
+    self.blinkyCells = blinkyCells
+    if self.blinky:
+      blinkyCells.add(self)
 
   def isBlinky(self):
     return self.blinky
@@ -181,64 +277,66 @@ class SignalCell(TrackCell):
   def setBlinkState(self, blinkState):
     if self.blinkState != blinkState:
       self.blinkState = blinkState
-      self.changedSinceRefresh = True
+      self.markChanged()
 
   def setType(self, signalType):
     if self.trackType != signalType:
       self.trackType = signalType
-      self.changedSinceRefresh = True
+      self.markChanged()
+
+  def tileKey(self):
+    return (self.trackType, self.color, self.blinky and self.blinkState)
       
-  def draw(self, dc):
-    dc.SetBrush(wx.Brush('#000'))
-    dc.SetPen(wx.Pen("#000"))
-    dc.DrawRectangle(self.x, self.y, self.cellSize, self.cellSize)
+  def drawTile(self, dc, x, y):
+    dc.SetBrush(GDICache.getBrush(Palette.background))
+    dc.SetPen(GDICache.getPen(Palette.background))
+    dc.DrawRectangle(x, y, self.cellSize, self.cellSize)
 
     if self.blinky and self.blinkState:
-      color = TrackCellColors.getColor('signal_blinkoff')
+      color = Palette.signal_blinkoff
     else:
       color = self.color
       
-    dc.SetPen(wx.Pen(color, width=2))
-    dc.SetBrush(wx.Brush(color))
+    dc.SetPen(GDICache.getPen(color, width=2))
+    dc.SetBrush(GDICache.getBrush(color))
 
     if self.trackType == TrackCellType.SIG_SINGLE_RIGHT:
-      dc.DrawCircle(self.x + self.cellSize - 3, self.y + self.cellSize//2, 3)
-      dc.SetBrush(wx.Brush('#000'))
-      dc.DrawLine(self.x, self.y + self.cellSize//2, self.x + self.cellSize - 7, self.y + self.cellSize//2)
-      dc.DrawLine(self.x, self.y + self.cellSize//2 - 4, self.x, self.y + self.cellSize//2 + 4)
+      dc.DrawCircle(x + self.cellSize - 3, y + self.cellSize//2, 3)
+      dc.SetBrush(GDICache.getBrush(Palette.background))
+      dc.DrawLine(x, y + self.cellSize//2, x + self.cellSize - 7, y + self.cellSize//2)
+      dc.DrawLine(x, y + self.cellSize//2 - 4, x, y + self.cellSize//2 + 4)
 
     elif self.trackType == TrackCellType.SIG_DOUBLE_RIGHT:
-      dc.DrawCircle(self.x + self.cellSize - 3, self.y + self.cellSize//2, 3)
-      dc.DrawCircle(self.x + self.cellSize - 9, self.y + self.cellSize//2, 3)
-      dc.SetBrush(wx.Brush('#000'))
-      dc.DrawLine(self.x, self.y + self.cellSize//2, self.x + self.cellSize - 7, self.y + self.cellSize//2)
-      dc.DrawLine(self.x, self.y + self.cellSize//2 - 4, self.x, self.y + self.cellSize//2 + 4)
+      dc.DrawCircle(x + self.cellSize - 3, y + self.cellSize//2, 3)
+      dc.DrawCircle(x + self.cellSize - 9, y + self.cellSize//2, 3)
+      dc.SetBrush(GDICache.getBrush(Palette.background))
+      dc.DrawLine(x, y + self.cellSize//2, x + self.cellSize - 7, y + self.cellSize//2)
+      dc.DrawLine(x, y + self.cellSize//2 - 4, x, y + self.cellSize//2 + 4)
 
     elif self.trackType == TrackCellType.SIG_SINGLE_LEFT:
-      dc.DrawCircle(self.x + 3, self.y + self.cellSize//2, 3)
-      dc.SetBrush(wx.Brush('#000'))
-      dc.DrawLine(self.x + self.cellSize-1, self.y + self.cellSize//2, self.x + 6, self.y + self.cellSize//2)
-      dc.DrawLine(self.x + self.cellSize-1, self.y + self.cellSize//2 - 4, self.x + self.cellSize-1, self.y + self.cellSize//2 + 4)
+      dc.DrawCircle(x + 3, y + self.cellSize//2, 3)
+      dc.SetBrush(GDICache.getBrush(Palette.background))
+      dc.DrawLine(x + self.cellSize-1, y + self.cellSize//2, x + 6, y + self.cellSize//2)
+      dc.DrawLine(x + self.cellSize-1, y + self.cellSize//2 - 4, x + self.cellSize-1, y + self.cellSize//2 + 4)
 
     elif self.trackType == TrackCellType.SIG_DOUBLE_LEFT:
-      dc.DrawCircle(self.x + 3, self.y + self.cellSize//2, 3)
-      dc.DrawCircle(self.x + 9, self.y + self.cellSize//2, 3)
-      dc.SetBrush(wx.Brush('#000'))
-      dc.DrawLine(self.x + self.cellSize-1, self.y + self.cellSize//2, self.x + 6, self.y + self.cellSize//2)
-      dc.DrawLine(self.x + self.cellSize-1, self.y + self.cellSize//2 - 4, self.x + self.cellSize-1, self.y + self.cellSize//2 + 4)
+      dc.DrawCircle(x + 3, y + self.cellSize//2, 3)
+      dc.DrawCircle(x + 9, y + self.cellSize//2, 3)
+      dc.SetBrush(GDICache.getBrush(Palette.background))
+      dc.DrawLine(x + self.cellSize-1, y + self.cellSize//2, x + 6, y + self.cellSize//2)
+      dc.DrawLine(x + self.cellSize-1, y + self.cellSize//2 - 4, x + self.cellSize-1, y + self.cellSize//2 + 4)
 
-    self.changedSinceRefresh = False      
       
 class SwitchCell(TrackCell):
   def __init__(self):
     super().__init__()
     self.switchState = 0
-    self.switchStatusColor = TrackCellColors.getColor('switch_unknown')
+    self.switchStatusColor = Palette.switch_unknown
     pass
 
   def setSwitchPosition(self, pos):
     if pos != self.switchState:
-      self.changedSinceRefresh = True
+      self.markChanged()
       self.switchState = pos
 
   def getSwitchPosition(self):
@@ -247,44 +345,46 @@ class SwitchCell(TrackCell):
   def setSwitchStatusColor(self, color):
     if color != self.switchStatusColor:
       self.switchStatusColor = color
-      self.changedSinceRefresh = True
+      self.markChanged()
+
+  def tileKey(self):
+    return (self.trackType, self.color, self.switchState != 0, self.switchStatusColor)
       
-  def draw(self, dc):
-    dc.SetBrush(wx.Brush('#000'))
+  def drawTile(self, dc, x, y):
+    dc.SetBrush(GDICache.getBrush(Palette.background))
 #    dc.SetPen(wx.Pen("#E1FCFF", width=1))
-    dc.SetPen(wx.Pen("#000"))
-    dc.DrawRectangle(self.x, self.y, self.cellSize, self.cellSize)
+    dc.SetPen(GDICache.getPen(Palette.background))
+    dc.DrawRectangle(x, y, self.cellSize, self.cellSize)
 
-    dc.SetPen(wx.Pen(self.switchStatusColor, width=1))
-    dc.DrawRectangle(self.x+2, self.y+2, self.cellSize-4, self.cellSize-4)
-    dc.SetPen(wx.Pen(self.color, width=2))
+    dc.SetPen(GDICache.getPen(self.switchStatusColor, width=1))
+    dc.DrawRectangle(x+2, y+2, self.cellSize-4, self.cellSize-4)
+    dc.SetPen(GDICache.getPen(self.color, width=2))
     
     if self.trackType == TrackCellType.SWITCH_RIGHT_DOWN:
       if self.switchState != 0:
-        dc.DrawLine(self.x, self.y+(self.cellSize//2 - 1), self.x+(self.cellSize//2), self.y+(self.cellSize/2 - 1))
-        dc.DrawLine(self.x+(self.cellSize//2), self.y+(self.cellSize/2 - 1), self.x+(self.cellSize - 1), self.y+(self.cellSize - 1))
+        dc.DrawLine(x, y+(self.cellSize//2 - 1), x+(self.cellSize//2), y+(self.cellSize/2 - 1))
+        dc.DrawLine(x+(self.cellSize//2), y+(self.cellSize/2 - 1), x+(self.cellSize - 1), y+(self.cellSize - 1))
       else:
-        dc.DrawLine(self.x, self.y + (self.cellSize/2 - 1), self.x+self.cellSize-1, self.y + (self.cellSize/2 - 1))
+        dc.DrawLine(x, y + (self.cellSize/2 - 1), x+self.cellSize-1, y + (self.cellSize/2 - 1))
 
     elif self.trackType == TrackCellType.SWITCH_RIGHT_UP:
       if self.switchState != 0:
-        dc.DrawLine(self.x, self.y+(self.cellSize//2 - 1), self.x+(self.cellSize//2), self.y+(self.cellSize//2 - 1))
-        dc.DrawLine(self.x+(self.cellSize//2), self.y+(self.cellSize//2 - 1), self.x + (self.cellSize - 1), self.y)
+        dc.DrawLine(x, y+(self.cellSize//2 - 1), x+(self.cellSize//2), y+(self.cellSize//2 - 1))
+        dc.DrawLine(x+(self.cellSize//2), y+(self.cellSize//2 - 1), x + (self.cellSize - 1), y)
       else:
-        dc.DrawLine(self.x, self.y + (self.cellSize/2 - 1), self.x+self.cellSize-1, self.y + (self.cellSize/2 - 1))
+        dc.DrawLine(x, y + (self.cellSize/2 - 1), x+self.cellSize-1, y + (self.cellSize/2 - 1))
 
     elif self.trackType == TrackCellType.SWITCH_LEFT_DOWN:
       if self.switchState != 0:
-        dc.DrawLine(self.x + (self.cellSize - 1), self.y+(self.cellSize//2 - 1), self.x+(self.cellSize//2), self.y+(self.cellSize//2 - 1))
-        dc.DrawLine(self.x+(self.cellSize/2 - 1), self.y+(self.cellSize//2 - 1), self.x, self.y+(self.cellSize - 1))
+        dc.DrawLine(x + (self.cellSize - 1), y+(self.cellSize//2 - 1), x+(self.cellSize//2), y+(self.cellSize//2 - 1))
+        dc.DrawLine(x+(self.cellSize/2 - 1), y+(self.cellSize//2 - 1), x, y+(self.cellSize - 1))
       else:
-        dc.DrawLine(self.x, self.y + (self.cellSize/2 - 1), self.x+self.cellSize-1, self.y + (self.cellSize/2 - 1))
+        dc.DrawLine(x, y + (self.cellSize/2 - 1), x+self.cellSize-1, y + (self.cellSize/2 - 1))
 
     elif self.trackType == TrackCellType.SWITCH_LEFT_UP:
       if self.switchState != 0:
-        dc.DrawLine(self.x + (self.cellSize - 1), self.y+(self.cellSize//2 - 1), self.x+(self.cellSize//2), self.y+(self.cellSize/2 - 1))
-        dc.DrawLine(self.x+(self.cellSize//2), self.y+(self.cellSize//2 - 1), self.x, self.y)
+        dc.DrawLine(x + (self.cellSize - 1), y+(self.cellSize//2 - 1), x+(self.cellSize//2), y+(self.cellSize/2 - 1))
+        dc.DrawLine(x+(self.cellSize//2), y+(self.cellSize//2 - 1), x, y)
       else:
-        dc.DrawLine(self.x, self.y + (self.cellSize/2 - 1), self.x+self.cellSize-1, self.y + (self.cellSize/2 - 1))
+        dc.DrawLine(x, y + (self.cellSize/2 - 1), x+self.cellSize-1, y + (self.cellSize/2 - 1))
 
-    self.changedSinceRefresh = False
@@ -1,9 +1,37 @@
 from cells import SignalCell,TrackCellColors,TrackCellType
-from mrbusUtils import MRBusBit,MRBusPacket
+from mrbusUtils import MRBusPacket
 import datetime
 
-class ControlPoint:
-  def __init__(self, config, txCallback, getItemCallback):
+# What the engine asks of every kind of CP when deciding which ones a batch of
+# packets touched.  Expects tracedBlocks, filled in by setRouteTrace() and
+# clearRouteTrace(), and the sensors and signals dicts.
+class ControlPointRouting:
+  # True if the last trace or clear of any of this CP's routes went through one of
+  # these blocks, so their changing could make the route longer or shorter
+  def routeCrosses(self, blocks):
+    for traced in self.tracedBlocks.values():
+      if not traced.isdisjoint(blocks):
+        return True
+    return False
+
+  # True while a signal is waiting on the node to answer a command - the answer
+  # recalculates the CP, anything earlier would show a state the node hasn't reported
+  def awaitingResponse(self):
+    for signal in self.signals.values():
+      if None != signal and signal.unverified:
+        return True
+    return False
+
+  # Makes the node's next packet reach this CP and its waiting signals in full
+  def resyncSensors(self):
+    for sensor in self.sensors.values():
+      sensor.resync()
+    for signal in self.signals.values():
+      if None != signal and signal.unverified:
+        signal.sensorLined.resync()
+
+class ControlPoint(ControlPointRouting):
+  def __init__(self, config, txCallback, getItemCallback, sensorTable):
     self.name = config['name']
     self.lined = "none"
     self.signals = { }
@@ -12,6 +40,7 @@ class ControlPoint:
     self.routeClrCmds = { }
     self.blocks = { }
     self.sensors = { }
+    self.tracedBlocks = { }   # Where each route starts -> blocks its last trace or clear went through
     self.txCallback = txCallback
     self.timelock = datetime.datetime.utcnow()
     self.getItemCallback = getItemCallback
@@ -57,7 +86,7 @@ class ControlPoint:
         self.blocks[blockConfig['role']].assocControlPoint(self)
 
     for sensorConfig in config['sensors']:
-      self.sensors[sensorConfig['role']] = MRBusBit(sensorConfig['source'])
+      self.sensors[sensorConfig['role']] = sensorTable.addSensor(sensorConfig['source'], False, self)
 
 
 
@@ -188,14 +217,29 @@ class ControlPoint:
     self.txCallback(self.routeCmds[reqSignalRole])
     return True
 
-  def processPacket(self, pkt):
-    changed = False
-
+  def checkTimelock(self):
     if self.lined == "run_time":
       if (datetime.datetime.utcnow() - self.timelock).total_seconds() >= self.timeoutSeconds:
         self.lined = "none"
         print("Timelock on [%s] expired" % (self.name))
-        changed = True
+        return True
+    return False
+
+  # Called periodically so the running time expires even when no packets arrive for this CP
+  def processTimers(self):
+    if not self.checkTimelock():
+      return False
+    self.recalculateState()
+    return True
+
+  def processPacket(self, pkt):
+    if self.updateFromPacket(pkt):
+      self.recalculateState()
+
+  # Applies the packet to the CP's sensors only, returns true if
+  # recalculateState() needs to be run afterwards
+  def updateFromPacket(self, pkt):
+    changed = self.checkTimelock()
 
     for sensorName in self.sensors.keys():
       changed = self.sensors[sensorName].testPacket(pkt) or changed
@@ -204,26 +248,31 @@ class ControlPoint:
       changed = self.sensors[sensorName].packetApplies(pkt) or changed
 
 
-    if changed:
-      self.recalculateState()
+    return changed
       
   def clearRouteTrace(self):
+    traced = set([self.blocks['main']])
     nextBlockName = self.blocks['main'].clearRoute()
     while (None != nextBlockName and "" != nextBlockName):
       nextBlock = self.getItemCallback('block', nextBlockName)
       #print("Next block is %s" % (nextBlock.name))
       if None == nextBlock or nextBlock.cp == True:
         break
+      traced.add(nextBlock)
       nextBlockName = nextBlock.clearRoute()
+    self.tracedBlocks['main'] = traced
 
   def setRouteTrace(self, leftBound, x, y):
+    traced = set([self.blocks['main']])
     nextBlockName = self.blocks['main'].setRoute(leftBound, x, y)
     while (None != nextBlockName):
       nextBlock = self.getItemCallback('block', nextBlockName)
       #print("Next block left is %s" % (nextBlock.name))
       if None == nextBlock or nextBlock.cp == True:
         break
+      traced.add(nextBlock)
       nextBlockName = nextBlock.setRoute(leftBound)
+    self.tracedBlocks['main'] = traced
 
   def recalculateState(self):
     try:
@@ -1,9 +1,10 @@
 from cells import SignalCell,TrackCellColors,TrackCellType
-from mrbusUtils import MRBusBit,MRBusPacket
+from mrbusUtils import MRBusPacket
+from controlpoint import ControlPointRouting
 import datetime
 
-class ControlPoint_XO3:
-  def __init__(self, config, txCallback, getItemCallback):
+class ControlPoint_XO3(ControlPointRouting):
+  def __init__(self, config, txCallback, getItemCallback, sensorTable):
     self.name = config['name']
     self.lined = { 'main_1':'none', 'main_2':'none' }
     self.signals = { }
@@ -12,6 +13,7 @@ class ControlPoint_XO3:
     self.routeClrCmds = { }
     self.blocks = { }
     self.sensors = { }
+    self.tracedBlocks = { }   # Where each route starts -> blocks its last trace or clear went through
     self.txCallback = txCallback
     self.timelock = datetime.datetime.utcnow()
     self.getItemCallback = getItemCallback
@@ -41,7 +43,7 @@ class ControlPoint_XO3:
         cmdBytes = entranceSignal['clr_cmd'].split(',')
         self.routeClrCmds[entranceSignal['role']] = MRBusPacket(cmdBytes[0], 0xFE, cmdBytes[1], [int(str(d),0) for d in cmdBytes[2:]])
 
-        self.sensors[entranceSignal['role']] = MRBusBit(entranceSignal['sensor'])
+        self.sensors[entranceSignal['role']] = sensorTable.addSensor(entranceSignal['sensor'], False, self)
 
     for switchConfig in config['switches']:
       self.switches[switchConfig['role']] = getItemCallback('switch', switchConfig['name'])
@@ -61,7 +63,7 @@ class ControlPoint_XO3:
 
     if 'sensors' in config.keys():
       for sensorConfig in config['sensors']:
-        self.sensors[sensorConfig['role']] = MRBusBit(sensorConfig['source'])
+        self.sensors[sensorConfig['role']] = sensorTable.addSensor(sensorConfig['source'], False, self)
 
   def removeRoute(self, entranceSignal):
     print("Signal [%s] has asked to unline CP [%s]" % (entranceSignal, self.name))    
@@ -194,7 +196,7 @@ class ControlPoint_XO3:
     self.txCallback(self.routeCmds[reqSignalRole])
     return True
 
-  def processPacket(self, pkt):
+  def checkTimelock(self):
     changed = False
 
     if self.lined['main_1'] == "run_time":
@@ -209,6 +211,24 @@ class ControlPoint_XO3:
         print("Timelock on [%s] expired" % (self.name))
         changed = True
 
+    return changed
+
+  # Called periodically so the running time expires even when no packets arrive for this CP
+  def processTimers(self):
+    if not self.checkTimelock():
+      return False
+    self.recalculateState()
+    return True
+
+  def processPacket(self, pkt):
+    if self.updateFromPacket(pkt):
+      self.recalculateState()
+
+  # Applies the packet to the CP's sensors only, returns true if
+  # recalculateState() needs to be run afterwards
+  def updateFromPacket(self, pkt):
+    changed = self.checkTimelock()
+
 
     for sensorName in self.sensors.keys():
       changed = self.sensors[sensorName].testPacket(pkt) or changed
@@ -216,12 +236,12 @@ class ControlPoint_XO3:
     for sensorName in self.sensors.keys():
       changed = self.sensors[sensorName].packetApplies(pkt) or changed
 
-    if changed:
-      self.recalculateState()
+    return changed
       
   def clearRouteTrace(self, whichBlock='main'):
     if self.debug:
       print("Clearing route [%s]" % (whichBlock))
+    traced = set([self.blocks[whichBlock]])
     nextBlockName = self.blocks[whichBlock].clearRoute()
     
     while (None != nextBlockName and "" != nextBlockName):
@@ -229,15 +249,20 @@ class ControlPoint_XO3:
       #print("Next block is %s" % (nextBlock.name))
       if None == nextBlock or nextBlock.cp == True:
         break
+      traced.add(nextBlock)
       nextBlockName = nextBlock.clearRoute()
+    self.tracedBlocks[whichBlock] = traced
 
   def setRouteTrace(self, whichBlock, leftBound, x, y):
+    traced = set([self.blocks[whichBlock]])
     nextBlockName = self.blocks[whichBlock].setRoute(leftBound, x, y)
     while (None != nextBlockName):
       nextBlock = self.getItemCallback('block', nextBlockName)
       if None == nextBlock or nextBlock.cp == True:
         break
+      traced.add(nextBlock)
       nextBlockName = nextBlock.setRoute(leftBound)
+    self.tracedBlocks[whichBlock] = traced
 
   def lockAllSwitches(self):
     self.switches['switch_e_xover_1'].setLock()
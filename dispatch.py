@@ -51,36 +51,36 @@ import wx
 import wx.adv
 import re
 import json
-import paho.mqtt.client as mqtt
-import queue
-import socket
-from cells import TrackCell, SignalCell, SwitchCell, TextCell, TrackCellType
-from mrbusUtils import MRBusBit, MRBusPacket
-from switch import Switch
-from block import Block
-from signal import Signal
-from controlpoint import ControlPoint
-from controlpoint_cp3 import ControlPoint_CP3
-from controlpoint_xo2 import ControlPoint_XO2
-from controlpoint_xo3 import ControlPoint_XO3
-import datetime
-
-
-# This class is used to pass packets between the mrbus/mqtt thread and the master gui thread
+from mrbusUtils import MRBusDecoder
+from mrbusBuffer import MRBusPacketBuffer
+from mrbusTransport import MqttTransport, SerialTransport
+from mrbusCapture import MRBusCaptureRecorder, MRBusCaptureReplayer
+from layoutSimulator import SimulatorTransport
+from dispatchEngine import DispatchEngine
+from cells import GDICache, TileAtlas
+from palette import Palette
+import time
+
+
+# This class is used to pass packets between the transport's thread and the master gui thread
 class MqttMRBus:
-  incomingPkts = queue.Queue(maxsize=500)
+  incomingPkts = MRBusPacketBuffer(maxsize=500, overflowPolicy=MRBusPacketBuffer.COLLAPSE)
   def __init__(self):
-    pass
+    self.wakeupCallback = None
+    self.decoder = MRBusDecoder()
+    self.recorder = None   # MRBusCaptureRecorder while a capture is running
+
+  # Called from the transport thread with each packet received.  Never blocks - if the gui
+  # has fallen behind, the buffer's overflow policy throws something away instead.
+  # Only the packet that finds the buffer empty wakes the gui up, the rest ride along
+  # on the same wakeup.
+  def packetReceived(self, pkt):
+    if self.incomingPkts.put(pkt) and self.wakeupCallback is not None:
+      self.wakeupCallback()
 
 
 class DispatchConsole(wx.Frame):
-  cells = []
-  blocks = [ ]
-  signals = []
-  switches = []
-  controlpoints = []
-  clickables = { }
-  cellXY = { }
+  engine = None
   menuHeight = 0
   currentBlockType = 0
   gridOn = False
@@ -88,132 +88,98 @@ class DispatchConsole(wx.Frame):
   pktTimer = None
   terminate = False
   timerCnt = 0
-  blinkCnt = 0
+  blinkTimer = None
+  blinkInterval = 600   # ms between blinky signals turning on and off
   blinkState = False
-  fcAddress = 0
+  transport = None
   secondTicker = 0
+  backBuffer = None   # Everything drawn so far, paints are blitted from here
+  gridBrush = None    # One grid square, tiled across the back buffer
   pktsLastSecond = 0
+  applyTimeLastSecond = 0.0   # Seconds spent in applyPackets
 
-  def __init__(self, layoutDataFile, mqttMRBus, mqttClient):
+  def __init__(self, layoutDataFile, mqttMRBus):
     super().__init__(None)
     self.layoutData = None
-    self.mqttClient = mqttClient
+    self.transport = None
     self.mqttMRBus = mqttMRBus
+
+    # All the layout state lives in the engine, the console just draws it
+    self.engine = DispatchEngine(self.txPacket)
+    self.engine.subscribeStateChanges(self.OnStateChanged)
+    self.engine.subscribeFastClock(self.OnFastClock)
     
     icon = wx.EmptyIcon()
     icon.CopyFromBitmap(wx.Bitmap("dispatch.ico", wx.BITMAP_TYPE_ANY))
     self.SetIcon(icon)
 
+    # Packets wake the gui up as they arrive, the timer is only for the once a
+    # second housekeeping, and blinking has a timer of its own
+    if self.mqttMRBus is not None:
+      self.mqttMRBus.wakeupCallback = lambda: wx.CallAfter(self.OnPacketsReady)
+
     if layoutDataFile != None:
       self.load_layout_data(layoutDataFile)
 
     self.InitUI()
 
     self.pktTimer = wx.Timer(self, 1)
-    self.Bind(wx.EVT_TIMER, self.OnTimer)
-    self.pktTimer.Start(100)
+    self.Bind(wx.EVT_TIMER, self.OnTimer, self.pktTimer)
+    self.pktTimer.Start(200)
+
+    # Only runs while something is blinking, see updateBlinkTimer()
+    self.blinkTimer = wx.Timer(self, 2)
+    self.Bind(wx.EVT_TIMER, self.OnBlinkTimer, self.blinkTimer)
+    self.updateBlinkTimer()
 
     print(wx.version())
 
+  # The engine calls this for everything it wants sent.  Whether a transport that
+  # isn't connected yet drops it or holds on to it is up to the transport.
   def txPacket(self, pkt):
-    message = pkt.toJSON()
-    topic = 'crnw/send'
-    print("Sending [%s]  [%s]" % (topic, message))
-    self.mqttClient.publish(topic=topic, payload=message)
-    print("Sent")
+    if self.transport is None:
+      print("No transport, dropping [%s]" % (str(pkt)))
+      return
+    self.transport.send(pkt)
 
   def doDisplayUpdate(self):
-    dc = wx.ClientDC(self)
-    # Since the cells all know if they changed since last time,
-    # just loop through them and call draw on the ones that changed
-    for i in self.cells:
-      if i.needsRedraw():
-        i.draw(dc)
-
-  def applyPacket(self, pkt):
-    for i in range(0, len(self.blocks)):
-      self.blocks[i].processPacket(pkt)
-
-    for i in range(0, len(self.switches)):
-      self.switches[i].processPacket(pkt)
-
-    for i in range(0, len(self.signals)):
-      self.signals[i].processPacket(pkt)
-
-    for i in range(0, len(self.controlpoints)):
-      self.controlpoints[i].processPacket(pkt)
-
-    if 0 != self.fcAddress and pkt.src == self.fcAddress:
-      self.fastClockUpdate(pkt)
-
+    if self.backBuffer is None:
+      return   # The first paint draws everything
+    dirtyCells = self.engine.takeDirtyCells()
+    if len(dirtyCells) == 0:
+      return
+    dc = wx.MemoryDC(self.backBuffer)
+    # Cells add themselves to the engine's dirty set as they change, so only those
+    # get drawn into the back buffer and have their rectangles repainted
+    for i in dirtyCells:
+      i.draw(dc)
+      self.RefreshRect(wx.Rect(*i.getBounds()), eraseBackground=False)
+    dc.SelectObject(wx.NullBitmap)
+
+  def OnStateChanged(self, changed):
     self.doDisplayUpdate()
+    self.updateBlinkTimer()
 
-  def updateBlinkyCells(self, blinkState):
-    blinkiesExist = False
-    for signal in self.signals:
-      if signal.cell.isBlinky():
-        blinkiesExist = True
-        signal.cell.setBlinkState(blinkState)
-    return blinkiesExist
-
-  def fastClockUpdate(self, pkt):
-    try:
-      self.realFastClockUpdate(pkt)
-    except Exception as e:
-      print(e)
-
+  def OnFastClock(self, fastTimeStr):
+    self.SetStatusText(fastTimeStr)
 
-  def realFastClockUpdate(self, pkt):
-    #print("Doing FC Update")
-    if pkt.src != self.fcAddress or pkt.cmd != ord('T') or len(pkt.data) < 12:
+  # Starts the blink timer when the first cell starts blinking and stops it when
+  # the last one stops
+  def updateBlinkTimer(self):
+    if self.blinkTimer is None:
       return
-
-    flags = pkt.data[3]
-    try:
-      fastTime = datetime.time(pkt.data[4], pkt.data[5], pkt.data[6])
-    except Exception as e:
-      print(e)
-      fastTime = None
-
-    fastHold = False
-    if (flags & 0x02) != 0:
-      fastHold = True
-
-    fastFactor = pkt.data[7] * 256 + pkt.data[8]
-    inFastMode = flags & 0x01
-    displayRealAMPM = False;
-    if (flags & 0x04) != 0:
-      displayRealAMPM = True
-
-    displayFastAMPM = False;
-    if (flags & 0x08) != 0:
-      displayFastAMPM = True
-    try:
-      year = (pkt.data[9] * 16) + ((pkt.data[10]<<4) & 0xF0)
-      month = pkt.data[10] & 0x0F
-      day = pkt.data[11]
-      realTime = datetime.datetime(year, month, day, pkt.data[0], pkt.data[1], pkt.data[2])
-    except Exception as e:
-      print(e)
-      realTime = None
-    fastTimeStr = ""
-    if None != fastTime:
-      if fastHold:
-        fastTimeStr = fastTime.strftime("FAST: HOLD")
-      elif displayFastAMPM:
-        fastTimeStr = fastTime.strftime("FAST: %I:%M:%S%p")
-      else:
-        fastTimeStr = fastTime.strftime("FAST: %H:%M:%S")
-
-    if None != realTime:
-      fastTimeStr += "   "
-      if displayRealAMPM:
-        fastTimeStr += realTime.strftime("REAL: %I:%M:%S%p")
-      else:
-        fastTimeStr += realTime.strftime("REAL: %H:%M:%S")
-
-
-    self.SetStatusText(fastTimeStr)
+    if len(self.engine.blinkyCells) > 0:
+      if not self.blinkTimer.IsRunning():
+        self.blinkTimer.Start(self.blinkInterval)
+    elif self.blinkTimer.IsRunning():
+      self.blinkTimer.Stop()
+
+  def OnBlinkTimer(self, event):
+    self.blinkState = not self.blinkState
+    for cell in self.engine.blinkyCells:
+      cell.setBlinkState(self.blinkState)
+    self.doDisplayUpdate()
+    self.updateBlinkTimer()
 
   def panelToPNG(self):
     #Create a DC for the whole screen area
@@ -249,42 +215,43 @@ class DispatchConsole(wx.Frame):
 
   def OnTimer(self, event):
     self.timerCnt += 1
-    self.blinkCnt += 1
     self.secondTicker += 1
 
-    if self.blinkCnt > 5:
-      self.blinkCnt = 0
-      self.blinkState = not self.blinkState
-      blinkiesExist = self.updateBlinkyCells(self.blinkState)
-      if blinkiesExist:  # don't do all the display update stuff if there are no blinking elements
-        self.doDisplayUpdate()
-
 
-    if self.secondTicker >= 10:
+    if self.secondTicker >= 5:
       # Anything that happens once per second happens here
-      if self.mqttClient.is_connected():
-        self.SetStatusText("PPS: %d" % self.pktsLastSecond, 2)
+      if self.transport is not None and self.transport.name == 'Replay':
+        replayStats = self.transport.getStats()
+        self.SetStatusText("Replay: %d  PPS: %d  Depth: %d  Apply: %d ms" % (replayStats['replayed'], self.pktsLastSecond, replayStats['depth'], self.applyTimeLastSecond * 1000), 2)
+      elif self.transport is not None and self.transport.isConnected():
+        rxStats = self.mqttMRBus.incomingPkts.getStats()
+        self.SetStatusText("PPS: %d  Peak: %d  Drops: %d  Apply: %d ms" % (self.pktsLastSecond, rxStats['highWater'], rxStats['dropped'], self.applyTimeLastSecond * 1000), 2)
       else:
         self.SetStatusText("Disconnected", 2)
 
       self.secondTicker = 0
       self.pktsLastSecond = 0
+      self.applyTimeLastSecond = 0.0
+      self.engine.processTimers()
       #self.panelToPNG()
 
 
-    if self.mqttMRBus is not None:
-      while not self.mqttMRBus.incomingPkts.empty():
-        try:
-          pkt = self.mqttMRBus.incomingPkts.get_nowait()
-          self.pktsLastSecond += 1
-          #print("pkt: %s" % (pkt))
-          self.applyPacket(pkt)
-        except:
-          pass
-
     if self.terminate:
       self.close()
 
+  def OnPacketsReady(self):
+    if self.mqttMRBus is None:
+      return
+
+    # Anything that shows up after the drain finds the buffer empty and wakes us again
+    pkts = self.mqttMRBus.incomingPkts.drain()
+    if len(pkts) > 0:
+      self.pktsLastSecond += len(pkts)
+      #print("pkts: %d" % (len(pkts)))
+      startTime = time.perf_counter()
+      self.engine.applyPackets(pkts)
+      self.applyTimeLastSecond += time.perf_counter() - startTime
+
   def isSignalCell(self, cellType):
     if cellType in ['signal_left', 'signal_right']:
       return True
@@ -300,21 +267,11 @@ class DispatchConsole(wx.Frame):
       return True
     return False
 
-  def getRailroadObject(self, objectType, objectName):
-    objectList = {'switch':self.switches, 'signal':self.signals, 'block':self.blocks}
-
-    if objectType not in objectList.keys():
-      return None
-
-    for i in range(0, len(objectList[objectType])):
-      if objectList[objectType][i].name == objectName:
-        return objectList[objectType][i]
-
-    return None
-
   def InitUI(self):
+    # Paints come from the back buffer, so wx needn't erase anything first
+    self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
     self.Bind(wx.EVT_PAINT, self.OnPaint)
-    self.Bind(wx.EVT_SIZE, self.OnPaint)
+    self.Bind(wx.EVT_SIZE, self.OnSize)
     self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
 
     titleName = "MRBus Dispatch Console"
@@ -342,14 +299,6 @@ class DispatchConsole(wx.Frame):
     if self.layoutData is None:
       return
 
-    self.cells = []
-    self.blocks = [ ]
-    self.signals = []
-    self.switches = []
-    self.controlpoints = []
-    self.clickables = { }
-    self.cellXY = { }
-
     if 'layoutName' in self.layoutData:
       self.SetTitle(self.layoutData['layoutName'])
 
@@ -357,50 +306,22 @@ class DispatchConsole(wx.Frame):
       if 1 == self.layoutData['gridOn']:
         self.gridOn = True
 
-    if "fastClockAddress" in self.layoutData.keys():
-      self.fcAddress = int(str(self.layoutData['fastClockAddress']), 0)
-
-    for text in self.layoutData['text']:
-      newCell = TextCell()
-      newCell.setText(text['value'])
-      x = int(text['x'])
-      y = int(text['y'])
-      newCell.setXY(x, y)
-      if text['type'] == 'blockname':
-        newCell.setColor('#ccffff')
-      self.cells.append(newCell)
-
-    for signalconfig in self.layoutData['signals']:
-      newSignal = Signal(signalconfig, self.txPacket)
-      self.signals.append(newSignal)
-      self.cells = self.cells + newSignal.getCells()
-      self.clickables[newSignal.getClickXY()] = newSignal.onLeftClick
-
-    for switchconfig in self.layoutData['switches']:
-      newSwitch = Switch(switchconfig, self.txPacket)
-      self.switches.append(newSwitch)
-      self.cells = self.cells + newSwitch.getCells()
-      self.clickables[newSwitch.getClickXY()] = newSwitch.onLeftClick
-
-    for blockconfig in self.layoutData['blocks']:
-      newBlock = Block(blockconfig, self.txPacket, self.cellXY)
-      self.blocks.append(newBlock)
-      self.cells = self.cells + newBlock.getCells()
-
-    for cell in self.cells:
-      # Build a cell finder
-      self.cellXY[(cell.cell_x,cell.cell_y)] = cell
-
-    for cpconfig in self.layoutData['controlPoints']:
-      if cpconfig['type'] == 'cp3':
-        newCP = ControlPoint_CP3(cpconfig, self.txPacket, self.getRailroadObject)
-      elif cpconfig['type'] == 'xo2':
-        newCP = ControlPoint_XO2(cpconfig, self.txPacket, self.getRailroadObject)
-      elif cpconfig['type'] == 'xo3':
-        newCP = ControlPoint_XO3(cpconfig, self.txPacket, self.getRailroadObject)
-      else:
-        newCP = ControlPoint(cpconfig, self.txPacket, self.getRailroadObject)
-      self.controlpoints.append(newCP)
+    if "rxOverflowPolicy" in self.layoutData.keys() and self.mqttMRBus is not None:
+      self.mqttMRBus.incomingPkts.setOverflowPolicy(self.layoutData['rxOverflowPolicy'])
+
+    self.engine.loadLayout(self.layoutData)
+    # Pens, brushes and tiles made in the old theme's colors
+    if self.engine.themeChanged:
+      GDICache.clear()
+      TileAtlas.clear()
+    self.backBuffer = None
+    self.gridBrush = None   # The theme may have changed the grid's colors
+    self.Refresh(eraseBackground=False)
+    self.updateBlinkTimer()
+
+    # Let the network thread throw away packets from nodes none of this layout watches
+    if self.mqttMRBus is not None:
+      self.mqttMRBus.decoder.setWantedSources(self.engine.getWantedSources())
 
 
   def OnLeftDown(self, e):
@@ -411,30 +332,82 @@ class DispatchConsole(wx.Frame):
     ctrlState = wx.GetKeyState(wx.WXK_CONTROL)
 
     m = (block_x, block_y)
-    if m in self.clickables:
-      self.clickables[m](ctrl=ctrlState)
+    if m in self.engine.clickables:
+      self.engine.clickables[m](ctrl=ctrlState)
+      self.doDisplayUpdate()
+      self.updateBlinkTimer()
 
 #      dc = wx.PaintDC(self)
 #      self.cells[0].setSwitchPosition([1,0][self.cells[0].getSwitchPosition()])
 #      self.cells[0].draw(wx.PaintDC(self))
 
-  def OnPaint(self, e):
-    dc = wx.ClientDC(self)
-    (size_x, size_y) = self.GetSize()
-    dc.SetBackground(wx.Brush('#000'))
+  # The back buffer covers the whole layout or the window, whichever is bigger, and
+  # only ever grows, so most resizes don't need it redrawn
+  def getBackBufferSize(self):
+    (size_x, size_y) = self.GetClientSize()
+    for cell in self.engine.cells:
+      (x, y, w, h) = cell.getBounds()
+      size_x = max(size_x, x + w)
+      size_y = max(size_y, y + h)
+    if self.backBuffer is not None:
+      size_x = max(size_x, self.backBuffer.GetWidth())
+      size_y = max(size_y, self.backBuffer.GetHeight())
+    return (size_x, size_y)
+
+  # A 16x16 square with the grid lines along its top and left edges, drawn once
+  def getGridBrush(self):
+    if self.gridBrush is None:
+      square = wx.Bitmap(16, 16)
+      dc = wx.MemoryDC(square)
+      dc.SetBackground(GDICache.getBrush(Palette.background))
+      dc.Clear()
+      dc.SetPen(GDICache.getPen(Palette.grid, width=1))
+      dc.DrawLine(0, 0, 16, 0)
+      dc.DrawLine(0, 0, 0, 16)
+      dc.SelectObject(wx.NullBitmap)
+      self.gridBrush = wx.Brush(square)
+    return self.gridBrush
+
+  def renderBackBuffer(self):
+    (size_x, size_y) = self.getBackBufferSize()
+    self.backBuffer = wx.Bitmap(size_x, size_y)
+    dc = wx.MemoryDC(self.backBuffer)
+    dc.SetBackground(GDICache.getBrush(Palette.background))
     dc.Clear()
 
-    dc.SetBrush(wx.Brush('#000'))
     if self.gridOn:
-      dc.SetPen(wx.Pen("#AAA", width=1))
-      for x in range(0, size_x//16):
-        for y in range(0, size_y//16):
-          dc.DrawRectangle(x*16, y*16, 17, 17)
+      # One rectangle filled with the grid square, rather than one per square
+      dc.SetBrush(self.getGridBrush())
+      dc.SetPen(wx.TRANSPARENT_PEN)
+      dc.DrawRectangle(0, 0, size_x, size_y)
 
-    dc.SetPen(wx.Pen("#FFF", width=2))
+    dc.SetBrush(GDICache.getBrush(Palette.background))
+    dc.SetPen(GDICache.getPen(Palette.text, width=2))
 
-    for cell in self.cells:
+    for cell in self.engine.cells:
       cell.draw(dc)
+    dc.SelectObject(wx.NullBitmap)
+    self.engine.takeDirtyCells()   # All drawn just now
+
+  def OnSize(self, e):
+    (size_x, size_y) = self.GetClientSize()
+    if self.backBuffer is not None and (size_x > self.backBuffer.GetWidth() or size_y > self.backBuffer.GetHeight()):
+      self.backBuffer = None
+    e.Skip()
+
+  # Exposes and resizes are served from the back buffer, only the damaged
+  # rectangles get copied and the layout isn't looked at
+  def OnPaint(self, e):
+    dc = wx.PaintDC(self)
+    if self.backBuffer is None:
+      self.renderBackBuffer()
+    bufferDC = wx.MemoryDC(self.backBuffer)
+    regions = wx.RegionIterator(self.GetUpdateRegion())
+    while regions.HaveRects():
+      rect = regions.GetRect()
+      dc.Blit(rect.x, rect.y, rect.width, rect.height, bufferDC, rect.x, rect.y)
+      regions.Next()
+    bufferDC.SelectObject(wx.NullBitmap)
 
 
 
@@ -454,8 +427,12 @@ class DispatchConsole(wx.Frame):
 
     connectMenu = wx.Menu()
     
-    connect_item = connectMenu.Append(-1, "&Connect MQTT")
-    disconnect_item = connectMenu.Append(-1, "&Disconnect MQTT")
+    connect_item = connectMenu.Append(-1, "&Connect")
+    disconnect_item = connectMenu.Append(-1, "&Disconnect")
+    connectMenu.AppendSeparator()
+    captureStart_item = connectMenu.Append(-1, "&Start Capture...")
+    captureStop_item = connectMenu.Append(-1, "S&top Capture")
+    replay_item = connectMenu.Append(-1, "&Replay Capture...")
 
     open_item = fileMenu.Append(-1, "&Open New Layout Config")
 
@@ -488,6 +465,51 @@ class DispatchConsole(wx.Frame):
 
     self.Bind(wx.EVT_MENU, self.OnMenuItemMQTTConnect, connect_item)
     self.Bind(wx.EVT_MENU, self.OnMenuItemMQTTDisconnect, disconnect_item)
+    self.Bind(wx.EVT_MENU, self.OnMenuItemCaptureStart, captureStart_item)
+    self.Bind(wx.EVT_MENU, self.OnMenuItemCaptureStop, captureStop_item)
+    self.Bind(wx.EVT_MENU, self.OnMenuItemReplay, replay_item)
+
+  def OnMenuItemCaptureStart(self, event):
+    with wx.FileDialog(self, "Save packet capture", wildcard="MRBus captures (*.mrbcap)|*.mrbcap",
+                       style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
+      if fileDialog.ShowModal() == wx.ID_CANCEL:
+        return
+      pathname = fileDialog.GetPath()
+
+    self.stopCapture()
+    try:
+      self.mqttMRBus.recorder = MRBusCaptureRecorder(pathname)
+    except OSError as e:
+      wx.MessageBox("Cannot open capture file")
+      print(e)
+
+  def OnMenuItemCaptureStop(self, event):
+    self.stopCapture()
+
+  def stopCapture(self):
+    recorder = self.mqttMRBus.recorder
+    if recorder is None:
+      return
+    self.mqttMRBus.recorder = None
+    recorder.close()
+
+  def OnMenuItemReplay(self, event):
+    with wx.FileDialog(self, "Replay packet capture", wildcard="MRBus captures (*.mrbcap)|*.mrbcap",
+                       style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
+      if fileDialog.ShowModal() == wx.ID_CANCEL:
+        return
+      pathname = fileDialog.GetPath()
+
+    dialog = wx.TextEntryDialog(self, "Speed (1 = real time, 0 = as fast as possible)", caption="Replay Capture", value="1", style=wx.OK | wx.CANCEL)
+    if dialog.ShowModal() != wx.ID_OK:
+      return
+    try:
+      speed = float(dialog.GetValue())
+    except ValueError:
+      wx.MessageBox("Replay speed must be a number")
+      return
+
+    self.connectReplay(pathname, speed)
 
   def OnMenuItemMQTTConnect(self, event):
     self.connect(True)
@@ -496,8 +518,7 @@ class DispatchConsole(wx.Frame):
     self.disconnect()
 
   def load_layout_data(self, file_name):
-    if self.mqttClient.is_connected():
-      self.mqttClient.disconnect()
+    self.disconnect()
 
     try:
       with open(file_name) as file:
@@ -510,17 +531,81 @@ class DispatchConsole(wx.Frame):
     self.connect()
 
   def disconnect(self):
-    if self.mqttClient.is_connected():
-      self.mqttClient.disconnect()
-    self.mqttClient.loop_stop()
+    if self.transport is not None:
+      self.transport.disconnect()
+      self.transport = None
 
+  # Picks the transport from the layout's connectionType - "mqtt" (the default) goes
+  # through the broker, "serial" talks to an MRBus interface directly, "replay"
+  # plays back a capture file and "simulator" runs against simulated nodes
   def connect(self, promptForInfo = False):
     self.disconnect()
 
+    connectionType = 'mqtt'
+    if self.layoutData is not None and 'connectionType' in self.layoutData.keys():
+      connectionType = self.layoutData['connectionType']
+
+    if connectionType == 'serial':
+      self.connectSerial(promptForInfo)
+    elif connectionType == 'mqtt':
+      self.connectMQTT(promptForInfo)
+    elif connectionType == 'replay' and 'replayFile' in self.layoutData.keys():
+      replaySpeed = 1.0
+      if 'replaySpeed' in self.layoutData.keys():
+        replaySpeed = float(self.layoutData['replaySpeed'])
+      self.connectReplay(self.layoutData['replayFile'], replaySpeed)
+    elif connectionType == 'simulator':
+      self.connectSimulator()
+    else:
+      print("Unknown connectionType [%s]" % (connectionType))
+
+  def connectReplay(self, fileName, speed):
+    self.disconnect()
+    transport = MRBusCaptureReplayer(self.mqttMRBus, fileName, speed)
+    if transport.connect():
+      self.transport = transport
+
+  def connectSimulator(self):
+    options = { }
+    try:
+      for (key, option) in [('simulatorStatusInterval', 'statusInterval'), ('simulatorResponseDelay', 'responseDelay'),
+          ('simulatorSwitchTime', 'switchTime'), ('simulatorOccupancyRate', 'occupancyRate')]:
+        if key in self.layoutData.keys():
+          options[option] = float(self.layoutData[key])
+      transport = SimulatorTransport(self.mqttMRBus, self.layoutData, **options)
+    except ValueError as e:
+      print("Cannot start the simulator: %s" % (e))
+      return
+    if transport.connect():
+      self.transport = transport
+
+  def connectSerial(self, promptForInfo):
+    serial_port = "/dev/ttyUSB0"
+    serial_baud = 115200
+
+    if self.layoutData is not None:
+      if 'serialPort' in self.layoutData.keys():
+        serial_port = self.layoutData['serialPort']
+      if 'serialBaud' in self.layoutData.keys():
+        serial_baud = int(self.layoutData['serialBaud'])
+
+    if promptForInfo:
+      dialog = wx.TextEntryDialog(self, "Serial Port", caption="MRBus Serial Connection", value=serial_port, style=wx.OK | wx.CANCEL)
+      if dialog.ShowModal() == wx.ID_OK:
+        serial_port = dialog.GetValue()
+      else:
+        return
+
+    transport = SerialTransport(self.mqttMRBus, serial_port, serial_baud)
+    if transport.connect():
+      self.transport = transport
+
+  def connectMQTT(self, promptForInfo):
     mqtt_host = "crnw.drgw.net"
     mqtt_port = 1883
     mqtt_user = None
     mqtt_pass = None
+    payloadFormat = 'json'
 
     if self.layoutData is not None:
       print("Have layout data")
@@ -533,6 +618,12 @@ class DispatchConsole(wx.Frame):
         mqtt_user = int(self.layoutData['mqttUser'])
       if 'mqttPass' in self.layoutData.keys():
         mqtt_pass = int(self.layoutData['mqttPass'])
+      # Received packets are recognised in either format, this picks what gets sent
+      if 'mqttPayloadFormat' in self.layoutData.keys():
+        if self.layoutData['mqttPayloadFormat'] in ['json', 'binary']:
+          payloadFormat = self.layoutData['mqttPayloadFormat']
+        else:
+          print("Unknown mqttPayloadFormat [%s], using [%s]" % (self.layoutData['mqttPayloadFormat'], payloadFormat))
 
     if promptForInfo:
       dialog = wx.TextEntryDialog(self, "Host Name", caption="MQTT Connection Information", value=mqtt_host, style=wx.OK | wx.CANCEL)
@@ -559,20 +650,15 @@ class DispatchConsole(wx.Frame):
       else:
         return
 
-    print("Starting MQTT connection user=[%s], pass=[%s], host=[%s], port=[%d]" % (mqtt_user, mqtt_pass, mqtt_host, mqtt_port))
-
-    if mqtt_user != None:
-      self.mqttClient.username_pw_set(mqtt_user, mqtt_pass)
-
-    self.mqttClient.connect(mqtt_host, mqtt_port, 60)
-    self.mqttClient.loop_start()
-    self.mqttClient.subscribe("crnw/raw")
+    transport = MqttTransport(self.mqttMRBus, mqtt_host, mqtt_port, mqtt_user, mqtt_pass, payloadFormat)
+    if transport.connect():
+      self.transport = transport
 
 
   def OnExit(self, event):
     """Close the frame, terminating the application."""
-    if self.mqttClient.is_connected():
-      self.mqttClient.disconnect()
+    self.disconnect()
+    self.stopCapture()
 
     self.Close(True)
 
@@ -604,56 +690,13 @@ class DispatchConsole(wx.Frame):
       wx.OK|wx.ICON_INFORMATION)
 
 
-def mqtt_onMessage(client, userdata, message):
-  contents = message.payload.decode()
-  mqttMRBus = userdata['mrbus']
-  pkt = MRBusPacket.fromJSON(contents)
-  if pkt is not None:
-    mqttMRBus.incomingPkts.put(pkt)
-    #print("Adding pkt %s" % (pkt))
-  else:
-    print("Packet failed")
-
-def mqtt_onConnect(client, userdata, flags, rc):
-#  logger = userdata['logger']
-  print("In mqtt_onConnect")
-  if rc == 0:
-    # Successful Connection
-    #logger.info("Successful MQTT Connection")
-    print("Successful MQTT Connection")
-    client.connected_flag = True
-  elif rc == 1:
-    print("ERROR: MQTT Incorrect Protocol Version")
-    client.connected_flag = False
-  elif rc == 2:
-    print("ERROR: MQTT Invalid Client ID")
-    client.connected_flag = False
-  elif rc == 3:
-    print("ERROR: MQTT Broker Unavailable")
-    client.connected_flag = False
-  elif rc == 4:
-    print("ERROR: MQTT Bad Username/Password")
-    client.connected_flag = False
-  elif rc == 5:
-    print("ERROR: MQTT Not Authorized")
-    client.connected_flag = False
-  else:
-    print("ERROR: MQTT Other Failure %d" % (rc))
-    client.connected_flag = False
-
-
 def main():
   mqttMRBus = MqttMRBus()
-  user_data = {'mrbus': mqttMRBus}
-  client_name = socket.getfqdn()
-  mqtt_client = mqtt.Client(client_name, userdata=user_data)
-  mqtt_client.on_message = mqtt_onMessage
-  mqtt_client.on_connect = mqtt_onConnect
 
   app = wx.App()
-  #ex = DispatchConsole(layoutData, mqttMRBus, mqttClient)
+  #ex = DispatchConsole(layoutData, mqttMRBus)
 
-  ex = DispatchConsole("layout.json", mqttMRBus, mqtt_client)
+  ex = DispatchConsole("layout.json", mqttMRBus)
   ex.Show()
   app.MainLoop()
 
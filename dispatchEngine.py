@@ -0,0 +1,277 @@
+import datetime
+from cells import TextCell
+from palette import Palette
+from trackGraph import TrackGraph
+from mrbusUtils import MRBusSensorTable
+from switch import Switch
+from block import Block
+from signal import Signal
+from controlpoint import ControlPoint
+from controlpoint_cp3 import ControlPoint_CP3
+from controlpoint_xo2 import ControlPoint_XO2
+from controlpoint_xo3 import ControlPoint_XO3
+
+# The layout model with no gui attached - owns the blocks, switches, signals and
+# control points built from layout.json, applies incoming packets to them and tells
+# whoever subscribed what changed.  The wx console is one subscriber, but nothing
+# in here needs a display, so the engine can be driven and profiled on its own.
+class DispatchEngine:
+  def __init__(self, txCallback=None):
+    self.txCallback = txCallback
+    self.stateCallbacks = [ ]
+    self.fastClockCallbacks = [ ]
+    self.layoutData = None
+    self.themeChanged = False   # Whether the last layout loaded changed any colors
+    self.clear()
+
+  def clear(self):
+    self.cells = []
+    self.blocks = [ ]
+    self.signals = []
+    self.switches = []
+    self.controlpoints = []
+    self.recalcOrder = { }
+    self.ownerCPs = { }
+    self.clickables = { }
+    self.cellXY = { }
+    self.trackGraph = None
+    self.objectsByName = { }
+    self.dirtyCells = set()
+    self.blinkyCells = set()
+    self.sensorTable = MRBusSensorTable()
+    self.fcAddress = 0
+
+  # callback(changed) is called with the list of objects whose state changed, after
+  # they've all been recalculated
+  def subscribeStateChanges(self, callback):
+    self.stateCallbacks.append(callback)
+
+  # callback(fastTimeStr) is called with the text for each fast clock update
+  def subscribeFastClock(self, callback):
+    self.fastClockCallbacks.append(callback)
+
+  def notifyStateChanges(self, changed):
+    for callback in self.stateCallbacks:
+      callback(changed)
+
+  # Hands back every cell that's changed since the last call, for redrawing
+  def takeDirtyCells(self):
+    dirtyCells = list(self.dirtyCells)
+    self.dirtyCells.clear()
+    return dirtyCells
+
+  def txPacket(self, pkt):
+    if self.txCallback is not None:
+      self.txCallback(pkt)
+
+  def loadLayout(self, layoutData):
+    self.layoutData = layoutData
+    self.clear()
+
+    # Colors come from the layout's theme, if it has one.  Whoever draws them throws
+    # away anything drawn in the old ones.
+    self.themeChanged = Palette.loadTheme(self.layoutData.get('theme'))
+
+    if "fastClockAddress" in self.layoutData.keys():
+      self.fcAddress = int(str(self.layoutData['fastClockAddress']), 0)
+
+    for text in self.layoutData['text']:
+      newCell = TextCell()
+      newCell.setText(text['value'])
+      x = int(text['x'])
+      y = int(text['y'])
+      newCell.setXY(x, y)
+      if text['type'] == 'blockname':
+        newCell.setColor(Palette.text_blockname)
+      self.cells.append(newCell)
+
+    for signalconfig in self.layoutData['signals']:
+      newSignal = Signal(signalconfig, self.txPacket, self.sensorTable)
+      newSignal.cell.setBlinkySet(self.blinkyCells)
+      self.signals.append(newSignal)
+      self.cells = self.cells + newSignal.getCells()
+      self.clickables[newSignal.getClickXY()] = newSignal.onLeftClick
+
+    for switchconfig in self.layoutData['switches']:
+      newSwitch = Switch(switchconfig, self.txPacket, self.sensorTable)
+      self.switches.append(newSwitch)
+      self.cells = self.cells + newSwitch.getCells()
+      self.clickables[newSwitch.getClickXY()] = newSwitch.onLeftClick
+
+    for blockconfig in self.layoutData['blocks']:
+      newBlock = Block(blockconfig, self.txPacket, self.cellXY, self.sensorTable)
+      self.blocks.append(newBlock)
+      self.cells = self.cells + newBlock.getCells()
+
+    for cell in self.cells:
+      # Build a cell finder
+      self.cellXY[(cell.cell_x,cell.cell_y)] = cell
+      cell.setDirtySet(self.dirtyCells)
+
+    # Now every cell is in place, work out once where the track goes from each
+    self.trackGraph = TrackGraph(self.cellXY)
+    for block in self.blocks:
+      block.setTrackGraph(self.trackGraph)
+
+    # CPs look their parts up by name, and route traces look up each block they
+    # pass into, so keep a finder for those too.  First of a name wins, as before.
+    for (objectType, objects) in [('switch', self.switches), ('signal', self.signals), ('block', self.blocks)]:
+      for obj in objects:
+        self.objectsByName.setdefault((objectType, obj.name), obj)
+
+    for cpconfig in self.layoutData['controlPoints']:
+      if cpconfig['type'] == 'cp3':
+        newCP = ControlPoint_CP3(cpconfig, self.txPacket, self.getRailroadObject, self.sensorTable)
+      elif cpconfig['type'] == 'xo2':
+        newCP = ControlPoint_XO2(cpconfig, self.txPacket, self.getRailroadObject, self.sensorTable)
+      elif cpconfig['type'] == 'xo3':
+        newCP = ControlPoint_XO3(cpconfig, self.txPacket, self.getRailroadObject, self.sensorTable)
+      else:
+        newCP = ControlPoint(cpconfig, self.txPacket, self.getRailroadObject, self.sensorTable)
+      self.controlpoints.append(newCP)
+
+    self.buildRecalcOrder()
+
+  # Sources of every packet the layout cares about, for filtering in the network thread
+  def getWantedSources(self):
+    wantedSources = self.sensorTable.getSources()
+    if 0 != self.fcAddress:
+      wantedSources.add(self.fcAddress)
+    return wantedSources
+
+  def getRailroadObject(self, objectType, objectName):
+    return self.objectsByName.get((objectType, objectName))
+
+  def applyPacket(self, pkt):
+    self.applyPackets([pkt])
+
+  def applyPackets(self, pkts):
+    # Apply the whole batch to the model first, remembering which objects changed,
+    # then recalculate each of those once and notify once at the end
+    dirty = { }
+    touchedCPs = set()
+    changedBlocks = set()
+
+    # A CP waiting on its node to answer a command hears every packet from it until
+    # the answer comes, as the answer may not change any bits
+    for cp in self.controlpoints:
+      if cp.awaitingResponse():
+        cp.resyncSensors()
+
+    for pkt in pkts:
+      if 0 != self.fcAddress and pkt.src == self.fcAddress:
+        self.fastClockUpdate(pkt)
+
+      try:
+        # The sensor table hands back only the objects watching a bit that changed
+        for listener in self.sensorTable.applyPacket(pkt):
+          if listener.updateFromPacket(pkt):
+            dirty[listener] = True
+            # Repeats no longer reach the CP, so let it know one of its parts changed
+            if listener in self.ownerCPs:
+              touchedCPs.add(self.ownerCPs[listener])
+            if isinstance(listener, Block):
+              changedBlocks.add(listener)
+      except Exception as e:
+        print(e)
+
+    # A block changing can also extend or cut short a route some other CP has traced
+    # through it, which CPs used to pick up from their next status repeat
+    if len(changedBlocks) > 0:
+      for cp in self.controlpoints:
+        if cp not in touchedCPs and cp.routeCrosses(changedBlocks):
+          touchedCPs.add(cp)
+
+    # A CP still waiting on its node to answer a command is left for the answer to
+    # recalculate, otherwise it would show a state the node hasn't reported yet
+    for cp in touchedCPs:
+      if not cp.awaitingResponse():
+        dirty[cp] = True
+
+    # Recalculate in blocks, switches, signals, control points order so CPs see
+    # their switches' and blocks' final state
+    changed = sorted(dirty, key=self.recalcOrder.get)
+    for listener in changed:
+      listener.recalculateState()
+
+    self.notifyStateChanges(changed)
+
+  def buildRecalcOrder(self):
+    # The sensor table already knows which objects listen to which bits, this just
+    # records the blocks, switches, signals, control points order dirty objects get
+    # recalculated in, and which CP each object belongs to
+    self.recalcOrder = { }
+    self.ownerCPs = { }
+    for listener in self.blocks + self.switches + self.signals + self.controlpoints:
+      self.recalcOrder[listener] = len(self.recalcOrder)
+      if getattr(listener, 'cp', None) is not None:
+        self.ownerCPs[listener] = listener.cp
+
+  def processTimers(self):
+    # Timeouts used to be checked whenever any packet arrived, now that packets only go to
+    # their listeners they get checked here once a second instead
+    changed = [ ]
+    for timed in self.switches + self.controlpoints:
+      if timed.processTimers():
+        changed.append(timed)
+    if len(changed) > 0:
+      self.notifyStateChanges(changed)
+
+  def fastClockUpdate(self, pkt):
+    try:
+      self.realFastClockUpdate(pkt)
+    except Exception as e:
+      print(e)
+
+
+  def realFastClockUpdate(self, pkt):
+    #print("Doing FC Update")
+    if pkt.src != self.fcAddress or pkt.cmd != ord('T') or len(pkt.data) < 12:
+      return
+
+    flags = pkt.data[3]
+    try:
+      fastTime = datetime.time(pkt.data[4], pkt.data[5], pkt.data[6])
+    except Exception as e:
+      print(e)
+      fastTime = None
+
+    fastHold = False
+    if (flags & 0x02) != 0:
+      fastHold = True
+
+    fastFactor = pkt.data[7] * 256 + pkt.data[8]
+    inFastMode = flags & 0x01
+    displayRealAMPM = False;
+    if (flags & 0x04) != 0:
+      displayRealAMPM = True
+
+    displayFastAMPM = False;
+    if (flags & 0x08) != 0:
+      displayFastAMPM = True
+    try:
+      year = (pkt.data[9] * 16) + ((pkt.data[10]<<4) & 0xF0)
+      month = pkt.data[10] & 0x0F
+      day = pkt.data[11]
+      realTime = datetime.datetime(year, month, day, pkt.data[0], pkt.data[1], pkt.data[2])
+    except Exception as e:
+      print(e)
+      realTime = None
+    fastTimeStr = ""
+    if None != fastTime:
+      if fastHold:
+        fastTimeStr = fastTime.strftime("FAST: HOLD")
+      elif displayFastAMPM:
+        fastTimeStr = fastTime.strftime("FAST: %I:%M:%S%p")
+      else:
+        fastTimeStr = fastTime.strftime("FAST: %H:%M:%S")
+
+    if None != realTime:
+      fastTimeStr += "   "
+      if displayRealAMPM:
+        fastTimeStr += realTime.strftime("REAL: %I:%M:%S%p")
+      else:
+        fastTimeStr += realTime.strftime("REAL: %H:%M:%S")
+
+    for callback in self.fastClockCallbacks:
+      callback(fastTimeStr)
@@ -0,0 +1,250 @@
+"""
+Makes big layouts for scaling tests out of a small one.
+
+The template layout (our own layout.json by default) is tiled across the screen
+as many times as needed, each copy with its own names and its own MRBus node
+addresses, so every block, siding, switch, signal and siding_end/cp3/xo2/xo3
+control point in the template turns up N times with consistent sensor patterns
+and commands.  Copy 0 is the template unchanged.
+
+Alongside the layout it can write a traffic profile - every (src, cmd) the
+layout's sensors listen to, how long the status payload is and which bits are
+watched - which SyntheticTraffic in benchmark.py plays from.
+
+  python layoutGenerator.py --blocks 500 -o big-layout.json --profile big-traffic.json
+"""
+import io
+import re
+import json
+import math
+import copy
+import argparse
+import contextlib
+from mrbusUtils import MRBusBit
+
+patternFormat = re.compile(r'^(!?)([^,]+),([^,]+),(.*)$')
+
+# Node addresses handed out to the copies.  0xFE is the console's own address and
+# 0xFF broadcast.  Once they're all used the next copies reuse them with a different
+# status command, so (src, cmd) stays unique even past what one MRBus could hold.
+addressPool = list(range(0x01, 0xFE))
+statusCmds = ['S'] + [chr(c) for c in range(ord('a'), ord('z') + 1)]
+
+class LayoutGenerator:
+  def __init__(self, template):
+    self.template = template
+    self.fcAddress = 0
+    if 'fastClockAddress' in template.keys():
+      self.fcAddress = int(str(template['fastClockAddress']), 0)
+
+    # Every node address the template's sensors or commands use
+    self.templateAddresses = set()
+    for pattern in self.patterns(template):
+      parsed = MRBusBit.parsePattern(pattern)
+      if parsed is not None:
+        self.templateAddresses.add(parsed[1])
+    for command in self.commands(template):
+      self.templateAddresses.add(int(command.split(',')[0], 0))
+
+    (minX, minY, maxX, maxY) = self.bounds(template)
+    self.width = maxX + 3
+    self.height = maxY + 3
+
+  def patterns(self, layoutData):
+    for obj in layoutData['blocks'] + layoutData['switches'] + layoutData['signals']:
+      for (key, value) in obj.items():
+        if key.startswith('sensor'):
+          yield value
+    for cp in layoutData['controlPoints']:
+      for sensor in cp.get('sensors', [ ]):
+        yield sensor['source']
+      for entranceSignal in cp['entranceSignals']:
+        if 'sensor' in entranceSignal.keys():
+          yield entranceSignal['sensor']
+
+  def commands(self, layoutData):
+    for switch in layoutData['switches']:
+      for key in ['commandNormal', 'commandReverse']:
+        if key in switch.keys():
+          yield switch[key]
+    for cp in layoutData['controlPoints']:
+      for entranceSignal in cp['entranceSignals']:
+        yield entranceSignal['cmd']
+        yield entranceSignal['clr_cmd']
+
+  def bounds(self, layoutData):
+    xs = [ ]
+    ys = [ ]
+    for obj in layoutData['text'] + layoutData['signals'] + layoutData['switches']:
+      xs.append(int(obj['x']))
+      ys.append(int(obj['y']))
+    for block in layoutData['blocks']:
+      for cell in block['cells']:
+        xs.append(self.cellCoord(block['base_x'], cell['x']))
+        if 'x_end' in cell.keys():
+          xs.append(self.cellCoord(block['base_x'], cell['x_end']))
+        ys.append(self.cellCoord(block['base_y'], cell['y']))
+        if 'y_end' in cell.keys():
+          ys.append(self.cellCoord(block['base_y'], cell['y_end']))
+    return (min(xs), min(ys), max(xs), max(ys))
+
+  # Block cell coordinates are relative to the block's base when they start with +
+  # or -, otherwise absolute, same as relCoord() in block.py
+  def isRelative(self, value):
+    return str(value)[0] in '+-'
+
+  def cellCoord(self, base, value):
+    return int(base) + int(value) if self.isRelative(value) else int(value)
+
+  # Gives each template address a new (address, status cmd) for copy number n
+  def makeAddressMap(self, n):
+    if n == 0:
+      return { a:(a, None) for a in self.templateAddresses }
+    free = [a for a in addressPool if a not in self.templateAddresses and a != self.fcAddress]
+    addresses = sorted(self.templateAddresses)
+    addressMap = { }
+    for (i, address) in enumerate(addresses):
+      slot = (n - 1) * len(addresses) + i
+      bank = slot // len(free)
+      if bank >= len(statusCmds):
+        raise ValueError("Ran out of node addresses at copy %d" % (n))
+      addressMap[address] = (free[slot % len(free)], statusCmds[bank])
+    return addressMap
+
+  def remapPattern(self, pattern, addressMap):
+    m = patternFormat.match(pattern)
+    if m is None:
+      return pattern
+    (negate, src, cmd, bits) = m.groups()
+    if int(src, 0) not in addressMap:
+      return pattern
+    (newSrc, newCmd) = addressMap[int(src, 0)]
+    if newCmd is not None and cmd == 'S':
+      cmd = newCmd
+    return "%s0x%02X,%s,%s" % (negate, newSrc, cmd, bits)
+
+  def remapCommand(self, command, addressMap):
+    fields = command.split(',')
+    fields[0] = "0x%02X" % (addressMap[int(fields[0], 0)][0])
+    return ','.join(fields)
+
+  def copyLayout(self, n, columns):
+    layoutData = copy.deepcopy(self.template)
+    if n == 0:
+      return layoutData
+
+    addressMap = self.makeAddressMap(n)
+    offsetX = (n % columns) * self.width
+    offsetY = (n // columns) * self.height
+
+    def rename(name):
+      return "%s [%d]" % (name, n)
+
+    for obj in layoutData['text'] + layoutData['signals'] + layoutData['switches']:
+      obj['x'] = int(obj['x']) + offsetX
+      obj['y'] = int(obj['y']) + offsetY
+
+    for obj in layoutData['blocks'] + layoutData['switches'] + layoutData['signals']:
+      obj['name'] = rename(obj['name'])
+      for key in list(obj.keys()):
+        if key.startswith('sensor'):
+          obj[key] = self.remapPattern(obj[key], addressMap)
+        elif key.startswith('command'):
+          obj[key] = self.remapCommand(obj[key], addressMap)
+
+    for block in layoutData['blocks']:
+      block['base_x'] = int(block['base_x']) + offsetX
+      block['base_y'] = int(block['base_y']) + offsetY
+      for cell in block['cells']:
+        for (key, offset) in [('x', offsetX), ('x_end', offsetX), ('y', offsetY), ('y_end', offsetY)]:
+          if key in cell.keys() and not self.isRelative(cell[key]):
+            cell[key] = str(int(cell[key]) + offset)
+      for key in ['leftAdjoiningBlockName', 'rightAdjoiningBlockName']:
+        if key in block.keys():
+          block[key] = rename(block[key])
+
+    for cp in layoutData['controlPoints']:
+      cp['name'] = rename(cp['name'])
+      for item in cp['switches'] + cp['blocks']:
+        item['name'] = rename(item['name'])
+      for sensor in cp.get('sensors', [ ]):
+        sensor['source'] = self.remapPattern(sensor['source'], addressMap)
+      for entranceSignal in cp['entranceSignals']:
+        entranceSignal['name'] = rename(entranceSignal['name'])
+        entranceSignal['cmd'] = self.remapCommand(entranceSignal['cmd'], addressMap)
+        entranceSignal['clr_cmd'] = self.remapCommand(entranceSignal['clr_cmd'], addressMap)
+        if 'sensor' in entranceSignal.keys():
+          entranceSignal['sensor'] = self.remapPattern(entranceSignal['sensor'], addressMap)
+
+    return layoutData
+
+  def generate(self, copies):
+    columns = max(1, int(math.ceil(math.sqrt(copies))))
+    layoutData = copy.deepcopy(self.template)
+    layoutData['layoutName'] = "%s x%d" % (self.template.get('layoutName', 'Layout'), copies)
+    for key in ['text', 'signals', 'switches', 'blocks', 'controlPoints']:
+      layoutData[key] = [ ]
+
+    for n in range(copies):
+      layoutCopy = self.copyLayout(n, columns)
+      for key in ['text', 'signals', 'switches', 'blocks', 'controlPoints']:
+        layoutData[key] += layoutCopy[key]
+    return layoutData
+
+
+# Describes the status traffic a layout's nodes send - each (src, cmd) its sensors
+# listen to, the payload length they need and the bits they watch.  interval is how
+# often each node sends its status, changeRate the share of packets that flip a bit.
+def makeTrafficProfile(sensorTable, interval=1.0, changeRate=0.05):
+  nodes = { }
+  for i in range(len(sensorTable)):
+    if sensorTable.groupIds[i] < 0:
+      continue
+    key = (sensorTable.srcs[i], sensorTable.cmds[i])
+    if key not in nodes.keys():
+      nodes[key] = { 'src':key[0], 'cmd':key[1], 'length':0, 'watchedBits':[ ] }
+    node = nodes[key]
+    node['length'] = max(node['length'], sensorTable.byteNums[i] + 1)
+    node['watchedBits'].append([sensorTable.byteNums[i], sensorTable.bitNums[i]])
+
+  return { 'interval':interval, 'changeRate':changeRate, 'nodes':[nodes[key] for key in sorted(nodes.keys())] }
+
+def generateLayout(template, copies):
+  return LayoutGenerator(template).generate(copies)
+
+def main():
+  parser = argparse.ArgumentParser(description="Generate a large layout by tiling copies of a template layout")
+  parser.add_argument('--template', default='layout.json')
+  parser.add_argument('--copies', type=int, help="number of copies of the template")
+  parser.add_argument('--blocks', type=int, help="make at least this many blocks instead")
+  parser.add_argument('-o', '--output', default='generated-layout.json')
+  parser.add_argument('--profile', help="also write the layout's traffic profile to this file")
+  args = parser.parse_args()
+
+  with open(args.template) as file:
+    template = json.load(file)
+
+  copies = 1
+  if args.blocks is not None:
+    copies = max(1, int(math.ceil(args.blocks / len(template['blocks']))))
+  elif args.copies is not None:
+    copies = args.copies
+
+  layoutData = generateLayout(template, copies)
+  with open(args.output, 'w') as file:
+    json.dump(layoutData, file, indent=1)
+  print("Wrote [%s] - %d blocks, %d switches, %d signals, %d control points" % (args.output, len(layoutData['blocks']), len(layoutData['switches']), len(layoutData['signals']), len(layoutData['controlPoints'])))
+
+  if args.profile:
+    # Only needs the sensor table, which doesn't need anything drawn
+    from dispatchEngine import DispatchEngine
+    engine = DispatchEngine()
+    with contextlib.redirect_stdout(io.StringIO()):
+      engine.loadLayout(layoutData)
+    profile = makeTrafficProfile(engine.sensorTable)
+    with open(args.profile, 'w') as file:
+      json.dump(profile, file, indent=1)
+    print("Wrote [%s] - %d nodes, %.0f packets/sec" % (args.profile, len(profile['nodes']), len(profile['nodes']) / profile['interval']))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,495 @@
+"""
+Plays the part of the layout's MRBus nodes, so the console can be run and measured
+with no railroad attached.
+
+The simulator reads the same layout.json as the console.  It keeps the state every
+sensor pattern in the layout describes - switch positions, block occupancy, control
+point lined bits - as the status payloads the nodes would send, answers the switch
+and route/clear commands the console sends, and broadcasts each node's status
+whenever it changes and every statusInterval seconds besides.
+
+Inside the console it's just another transport (connectionType "simulator").  On
+its own it can stand in for the nodes on a broker, or drive a headless console and
+measure click-to-green latency and command throughput:
+
+  python layoutSimulator.py [layout.json] --mqtt localhost:1883
+  python layoutSimulator.py [layout.json] --measure --rounds 20 [--json results.json]
+"""
+import os
+import sys
+import copy
+import json
+import heapq
+import queue
+import random
+import argparse
+import threading
+import time
+from mrbusUtils import MRBusBit, MRBusPacket, MRBusDecoder
+from mrbusBuffer import MRBusPacketBuffer
+
+# paho is only needed to stand in for the nodes on a broker
+try:
+  import paho.mqtt.client as mqtt
+except ImportError:
+  mqtt = None
+
+
+class LayoutSimulator:
+  def __init__(self, layoutData, sendCallback, statusInterval=1.0, responseDelay=0.0, switchTime=0.0, occupancyRate=0.0, seed=None):
+    # Each repeat is scheduled statusInterval after the last, so 0 would never let time move on
+    if statusInterval <= 0:
+      raise ValueError("Status interval must be more than 0 seconds, not %s" % (statusInterval))
+    self.sendCallback = sendCallback       # Called with each status packet, from the simulator thread
+    self.statusInterval = statusInterval   # Seconds between the status repeats from each node
+    self.responseDelay = responseDelay     # Seconds between a command arriving and it taking effect
+    self.switchTime = switchTime           # Extra seconds a switch takes to throw
+    self.occupancyRate = occupancyRate     # Random block occupancy changes per second, 0 for none
+    self.rng = random.Random(seed)
+
+    self.nodes = { }          # (src, cmd) -> status payload, as a bytearray
+    self.commands = { }       # (dest, cmd, data) -> [(sensor, value), ...] the command sets
+    self.switchCommands = set()   # Keys of the commands that throw a switch
+    self.occupancy = [ ]      # Block occupancy sensors, for the random occupancy changes
+    self.incoming = queue.SimpleQueue()
+    self.events = [ ]         # Heap of (due time, sequence, kind, item)
+    self.sequence = 0
+    self.simThread = None
+    self.stopSim = False
+
+    self.received = 0
+    self.unknown = 0
+    self.applied = 0
+    self.statusSent = 0
+    self.occupancyChanges = 0
+
+    self.loadLayout(layoutData)
+
+  # Sensors are (src, cmd, byte, bit, negate), taken from the layout's patterns
+  def addSensor(self, pattern):
+    parsed = MRBusBit.parsePattern(pattern)
+    if parsed is None:
+      return None
+    (negate, src, cmd, byteNum, bitNum) = parsed
+    payload = self.nodes.setdefault((src, cmd), bytearray())
+    if len(payload) <= byteNum:
+      payload.extend(bytes(byteNum + 1 - len(payload)))
+    return (src, cmd, byteNum, bitNum, negate)
+
+  def setSensor(self, sensor, value):
+    (src, cmd, byteNum, bitNum, negate) = sensor
+    payload = self.nodes[(src, cmd)]
+    old = payload[byteNum]
+    if value != negate:
+      payload[byteNum] |= 1 << bitNum
+    else:
+      payload[byteNum] &= ~(1 << bitNum) & 0xFF
+    return payload[byteNum] != old
+
+  def getSensor(self, sensor):
+    (src, cmd, byteNum, bitNum, negate) = sensor
+    return bool(self.nodes[(src, cmd)][byteNum] & (1 << bitNum)) != negate
+
+  # Commands are keyed the way the console builds them, see ControlPoint and Switch
+  def addCommand(self, command, effects):
+    cmdBytes = command.split(',')
+    pkt = MRBusPacket(cmdBytes[0], 0xFE, cmdBytes[1], [int(str(d),0) for d in cmdBytes[2:]])
+    key = (pkt.dest, pkt.cmd, pkt.data)
+    effects = [(sensor, value) for (sensor, value) in effects if sensor is not None]
+    # Several entrance signals can share a command (all the cp3 main signals do), in
+    # which case they'd better agree on what it does
+    self.commands.setdefault(key, [ ]).extend(effects)
+    return key
+
+  def loadLayout(self, layoutData):
+    signalBound = { }
+    for signalConfig in layoutData['signals']:
+      signalBound[signalConfig['name']] = signalConfig['type'] == 'signal_left'
+      if 'sensorLined' in signalConfig.keys():
+        self.addSensor(signalConfig['sensorLined'])
+
+    for blockConfig in layoutData['blocks']:
+      for key in ['sensorOccupancy', 'sensorManual']:
+        if key in blockConfig.keys():
+          sensor = self.addSensor(blockConfig[key])
+          if sensor is not None and key == 'sensorOccupancy':
+            self.occupancy.append(sensor)
+      # Track power is on unless something turns it off
+      if 'sensorPower' in blockConfig.keys():
+        sensor = self.addSensor(blockConfig['sensorPower'])
+        if sensor is not None:
+          self.setSensor(sensor, True)
+
+    for switchConfig in layoutData['switches']:
+      sensorNormal = None
+      sensorReverse = None
+      if 'sensorNormal' in switchConfig.keys():
+        sensorNormal = self.addSensor(switchConfig['sensorNormal'])
+      if 'sensorReverse' in switchConfig.keys():
+        sensorReverse = self.addSensor(switchConfig['sensorReverse'])
+      # Every switch starts out lined normal
+      if sensorNormal is not None:
+        self.setSensor(sensorNormal, True)
+      if 'commandNormal' in switchConfig.keys():
+        self.switchCommands.add(self.addCommand(switchConfig['commandNormal'], [(sensorNormal, True), (sensorReverse, False)]))
+      if 'commandReverse' in switchConfig.keys():
+        self.switchCommands.add(self.addCommand(switchConfig['commandReverse'], [(sensorNormal, False), (sensorReverse, True)]))
+
+    for cpConfig in layoutData['controlPoints']:
+      sensors = { }
+      for sensorConfig in cpConfig.get('sensors', [ ]):
+        sensors[sensorConfig['role']] = self.addSensor(sensorConfig['source'])
+
+      for entranceSignal in cpConfig['entranceSignals']:
+        if 'sensor' in entranceSignal.keys():
+          # xo2/xo3 - every entrance signal has a lined bit of its own
+          sensor = self.addSensor(entranceSignal['sensor'])
+          self.addCommand(entranceSignal['cmd'], [(sensor, True)])
+          self.addCommand(entranceSignal['clr_cmd'], [(sensor, False)])
+        else:
+          # siding_end/cp3 - one lined bit for each direction out of the CP
+          sensorLinedLeft = sensors.get('sensorLinedLeft')
+          sensorLinedRight = sensors.get('sensorLinedRight')
+          if signalBound.get(entranceSignal['name'], False):
+            self.addCommand(entranceSignal['cmd'], [(sensorLinedLeft, True), (sensorLinedRight, False)])
+          else:
+            self.addCommand(entranceSignal['cmd'], [(sensorLinedLeft, False), (sensorLinedRight, True)])
+          self.addCommand(entranceSignal['clr_cmd'], [(sensorLinedLeft, False), (sensorLinedRight, False)])
+
+    # Collapse duplicates from shared commands, keeping the order they were added in
+    for key in self.commands.keys():
+      self.commands[key] = list(dict.fromkeys(self.commands[key]))
+
+    print("Simulating %d nodes, answering %d commands" % (len(self.nodes), len(self.commands)))
+
+  def start(self):
+    if self.simThread is not None:
+      return
+    self.stopSim = False
+    self.simThread = threading.Thread(target=self.simLoop, name="mrbus-simulator", daemon=True)
+    self.simThread.start()
+
+  def stop(self):
+    if self.simThread is None:
+      return
+    self.stopSim = True
+    self.incoming.put(None)
+    self.simThread.join()
+    self.simThread = None
+
+  def isRunning(self):
+    return self.simThread is not None
+
+  # Called from whatever thread the console sends from
+  def receive(self, pkt):
+    self.incoming.put(pkt)
+
+  def schedule(self, due, kind, item):
+    self.sequence += 1
+    heapq.heappush(self.events, (due, self.sequence, kind, item))
+
+  def sendStatus(self, key):
+    self.sendCallback(MRBusPacket.fromValues(0xFF, key[0], key[1], bytes(self.nodes[key])))
+    self.statusSent += 1
+
+  # Runs in its own thread.  Sleeps on the incoming queue until either a command comes
+  # in or the next event is due, so commands are picked up as soon as they're sent.
+  def simLoop(self):
+    now = time.monotonic()
+    self.events = [ ]
+    # Spread the nodes' status repeats out over the interval, like a real bus
+    keys = sorted(self.nodes.keys())
+    for (i, key) in enumerate(keys):
+      self.schedule(now + self.statusInterval * i / max(1, len(keys)), 'status', key)
+    if self.occupancyRate > 0 and len(self.occupancy) > 0:
+      self.schedule(now + self.rng.expovariate(self.occupancyRate), 'occupancy', None)
+
+    while not self.stopSim:
+      timeout = None
+      if len(self.events) > 0:
+        timeout = max(0, self.events[0][0] - time.monotonic())
+      try:
+        pkt = self.incoming.get(timeout=timeout)
+      except queue.Empty:
+        pkt = None
+
+      if pkt is not None:
+        self.commandReceived(pkt)
+
+      now = time.monotonic()
+      while len(self.events) > 0 and self.events[0][0] <= now:
+        (due, sequence, kind, item) = heapq.heappop(self.events)
+        if kind == 'status':
+          self.sendStatus(item)
+          self.schedule(due + self.statusInterval, 'status', item)
+        elif kind == 'command':
+          self.applyEffects(item)
+        elif kind == 'occupancy':
+          sensor = self.rng.choice(self.occupancy)
+          self.applyEffects([(sensor, not self.getSensor(sensor))])
+          self.occupancyChanges += 1
+          self.schedule(now + self.rng.expovariate(self.occupancyRate), 'occupancy', None)
+
+  def commandReceived(self, pkt):
+    self.received += 1
+    key = (pkt.dest, pkt.cmd, pkt.data)
+    effects = self.commands.get(key)
+    if effects is None:
+      self.unknown += 1
+      print("Simulator has nothing to do for [%s]" % (str(pkt)))
+      return
+
+    delay = self.responseDelay
+    if key in self.switchCommands:
+      delay += self.switchTime
+    self.schedule(time.monotonic() + delay, 'command', effects)
+
+  # Sets the sensors and sends a status from every node that changed straight away,
+  # rather than leaving it for the next repeat
+  def applyEffects(self, effects):
+    changed = set()
+    for (sensor, value) in effects:
+      if self.setSensor(sensor, value):
+        changed.add((sensor[0], sensor[1]))
+    self.applied += 1
+    for key in sorted(changed):
+      self.sendStatus(key)
+
+  def getStats(self):
+    return { 'nodes':len(self.nodes), 'received':self.received, 'unknown':self.unknown, 'applied':self.applied,
+      'statusSent':self.statusSent, 'occupancyChanges':self.occupancyChanges }
+
+
+# The simulator as a transport (see mrbusTransport.py), so the console can run against it
+class SimulatorTransport:
+  name = 'Simulator'
+
+  def __init__(self, mrbus, layoutData, **options):
+    self.mrbus = mrbus
+    self.simulator = LayoutSimulator(layoutData, self.packetFromSimulator, **options)
+
+  def connect(self):
+    self.simulator.start()
+    return True
+
+  def disconnect(self):
+    self.simulator.stop()
+
+  def isConnected(self):
+    return self.simulator.isRunning()
+
+  def send(self, pkt):
+    print("Sending [%s]  [%s]" % (self.name, str(pkt)))
+    self.simulator.receive(pkt)
+
+  def packetFromSimulator(self, pkt):
+    recorder = self.mrbus.recorder
+    if recorder is not None:
+      recorder.record(pkt)
+    self.mrbus.packetReceived(pkt)
+
+
+# Stands in for the nodes on a broker - statuses go out on crnw/raw and commands are
+# taken from crnw/send, in either payload format
+def runMQTT(layoutData, host, port, payloadFormat, options):
+  if mqtt is None:
+    print("paho-mqtt is not installed, cannot stand in on a broker")
+    return
+
+  decoder = MRBusDecoder()
+  client = mqtt.Client("mrbus-simulator")
+
+  def publish(pkt):
+    if payloadFormat == 'binary':
+      client.publish(topic='crnw/raw', payload=pkt.toBinary())
+    else:
+      client.publish(topic='crnw/raw', payload=pkt.toJSON())
+
+  simulator = LayoutSimulator(layoutData, publish, **options)
+
+  def onMessage(client, userdata, message):
+    pkt = decoder.decode(message.payload)
+    if pkt is not None:
+      simulator.receive(pkt)
+
+  def onConnect(client, userdata, flags, rc):
+    print("Connected to [%s:%d], rc=%d" % (host, port, rc))
+    client.subscribe("crnw/send")
+
+  client.on_message = onMessage
+  client.on_connect = onConnect
+  client.connect(host, port, 60)
+  client.loop_start()
+  simulator.start()
+  try:
+    while True:
+      time.sleep(10)
+      print(simulator.getStats())
+  except KeyboardInterrupt:
+    pass
+  simulator.stop()
+  client.loop_stop()
+  client.disconnect()
+
+
+# Stands in for the console's MqttMRBus when measuring, minus the gui wakeup
+class MeasureBus:
+  recorder = None
+
+  def __init__(self):
+    self.incomingPkts = MRBusPacketBuffer(maxsize=500, overflowPolicy=MRBusPacketBuffer.COLLAPSE)
+    self.wakeup = threading.Event()
+
+  def packetReceived(self, pkt):
+    if self.incomingPkts.put(pkt):
+      self.wakeup.set()
+
+
+def percentile(values, p):
+  if len(values) == 0:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+# Runs a headless console against the simulator.  Each round clicks one entrance
+# signal on every CP at once, times how long each takes to go green, then clears them
+# all again.  timelock overrides every CP's running time so rounds needn't wait on it.
+def measure(layoutData, rounds=10, timeout=5.0, timelock=0, options={ }):
+  from dispatchEngine import DispatchEngine
+
+  layoutData = copy.deepcopy(layoutData)
+  for cpConfig in layoutData['controlPoints']:
+    cpConfig['timeoutSeconds'] = str(timelock)
+
+  bus = MeasureBus()
+  transport = SimulatorTransport(bus, layoutData, **options)
+  commandsSent = [0]
+
+  def txPacket(pkt):
+    commandsSent[0] += 1
+    transport.send(pkt)
+
+  engine = DispatchEngine(txPacket)
+  engine.loadLayout(layoutData)
+
+  # Plays the gui thread - applies whatever has arrived until done() or the timeout
+  def pump(done, timeout):
+    endTime = time.perf_counter() + timeout
+    while not done():
+      remaining = endTime - time.perf_counter()
+      if remaining <= 0:
+        return False
+      bus.wakeup.wait(min(remaining, 0.01))
+      bus.wakeup.clear()
+      engine.applyPackets(bus.incomingPkts.drain())
+      engine.processTimers()
+    return True
+
+  def isGreen(signal):
+    return signal.lined and not signal.unverified
+
+  transport.connect()
+  # Wait for the first status from every node before clicking anything
+  pump(lambda: all([s.positionNormal for s in engine.switches]), max(timeout, options.get('statusInterval', 1.0) * 2))
+
+  latencies = [ ]
+  timeouts = 0
+  refused = 0
+  startTime = time.perf_counter()
+  for r in range(rounds):
+    clicked = { }
+    for cp in engine.controlpoints:
+      roles = sorted(cp.signals.keys())
+      signal = cp.signals[roles[r % len(roles)]]
+      sent = commandsSent[0]
+      clickTime = time.perf_counter()
+      signal.onLeftClick()
+      if commandsSent[0] == sent:
+        refused += 1   # Points against it, or the OS occupied
+      else:
+        clicked[signal] = clickTime
+
+    pending = dict(clicked)
+    def checkGreen():
+      now = time.perf_counter()
+      for signal in list(pending.keys()):
+        if isGreen(signal):
+          latencies.append(now - pending.pop(signal))
+      return len(pending) == 0
+    pump(checkGreen, timeout)
+    timeouts += len(pending)
+
+    for signal in clicked.keys():
+      if isGreen(signal):
+        signal.onLeftClick(ctrl=True)
+    pump(lambda: not any([isGreen(signal) for signal in clicked.keys()]), timeout)
+
+  elapsed = time.perf_counter() - startTime
+  transport.disconnect()
+  stats = transport.simulator.getStats()
+
+  return { 'layoutName':layoutData.get('layoutName', ''), 'rounds':rounds, 'controlPoints':len(engine.controlpoints),
+    'responseDelay':options.get('responseDelay', 0.0), 'routes':len(latencies), 'refused':refused, 'timeouts':timeouts,
+    'latencyMs':{ 'min':min(latencies, default=0) * 1000, 'median':percentile(latencies, 50) * 1000,
+      'p95':percentile(latencies, 95) * 1000, 'max':max(latencies, default=0) * 1000 },
+    'commandsSent':commandsSent[0], 'commandsPerSecond':commandsSent[0] / elapsed if elapsed > 0 else 0.0,
+    'elapsedSeconds':elapsed, 'simulator':stats }
+
+def positiveFloat(value):
+  value = float(value)
+  if value <= 0:
+    raise argparse.ArgumentTypeError("must be more than 0, not %s" % (value))
+  return value
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulate the layout's MRBus nodes")
+  parser.add_argument('layout', nargs='?', default='layout.json')
+  parser.add_argument('--status-interval', type=positiveFloat, default=1.0, help="seconds between each node's status repeats")
+  parser.add_argument('--response-delay', type=float, default=0.0, help="seconds before a command takes effect")
+  parser.add_argument('--switch-time', type=float, default=0.0, help="extra seconds for a switch to throw")
+  parser.add_argument('--occupancy-rate', type=float, default=0.0, help="random block occupancy changes per second")
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--mqtt', help="stand in for the nodes on this broker, host[:port]")
+  parser.add_argument('--format', choices=['json', 'binary'], default='json', help="payload format to publish statuses in")
+  parser.add_argument('--measure', action='store_true', help="measure click-to-green latency against a headless console")
+  parser.add_argument('--rounds', type=int, default=10)
+  parser.add_argument('--timeout', type=float, default=5.0, help="seconds to wait for a route before giving up on it")
+  parser.add_argument('--timelock', type=int, default=0, help="running time for every CP while measuring")
+  parser.add_argument('--json', help="also write the measurement to this file")
+  args = parser.parse_args()
+
+  with open(args.layout) as file:
+    layoutData = json.load(file)
+
+  options = { 'statusInterval':args.status_interval, 'responseDelay':args.response_delay, 'switchTime':args.switch_time,
+    'occupancyRate':args.occupancy_rate, 'seed':args.seed }
+
+  if args.mqtt:
+    (host, sep, port) = args.mqtt.partition(':')
+    runMQTT(layoutData, host, int(port) if port else 1883, args.format, options)
+    return
+
+  if not args.measure:
+    parser.error("one of --mqtt or --measure is needed")
+
+  # Layout objects chatter on stdout, keep it out of the results
+  realStdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    report = measure(layoutData, args.rounds, args.timeout, args.timelock, options)
+  finally:
+    sys.stdout.close()
+    sys.stdout = realStdout
+
+  latency = report['latencyMs']
+  print("%s - %d CPs, %d rounds, %d routes lined, %d refused, %d timed out" % (report['layoutName'], report['controlPoints'], report['rounds'], report['routes'], report['refused'], report['timeouts']))
+  print("  click to green  min %.2f ms  median %.2f ms  p95 %.2f ms  max %.2f ms" % (latency['min'], latency['median'], latency['p95'], latency['max']))
+  print("  commands        %d sent, %.0f/s" % (report['commandsSent'], report['commandsPerSecond']))
+  print("  simulator       %s" % (report['simulator']))
+
+  if args.json:
+    with open(args.json, 'w') as file:
+      json.dump(report, file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+import collections
+import threading
+
+# Bounded buffer for handing packets from a network/serial thread to the gui thread.
+# put() never waits on the consumer - when the buffer is full the overflow policy
+# decides what gets thrown away, and every packet thrown away is counted.
+class MRBusPacketBuffer:
+  DROP_OLDEST = 'drop_oldest'   # Make room by discarding the oldest queued packet
+  DROP_NEWEST = 'drop_newest'   # Discard the incoming packet
+  COLLAPSE = 'collapse'         # Replace the queued packet from the same (src, cmd), else drop oldest
+  policies = [ DROP_OLDEST, DROP_NEWEST, COLLAPSE ]
+
+  def __init__(self, maxsize=500, overflowPolicy=DROP_OLDEST):
+    self.lock = threading.Lock()
+    self.pkts = collections.deque()
+    self.maxsize = maxsize
+    self.overflowPolicy = self.DROP_OLDEST
+    self.setOverflowPolicy(overflowPolicy)
+    self.received = 0
+    self.dropped = 0
+    self.highWater = 0
+
+  def setOverflowPolicy(self, overflowPolicy):
+    if overflowPolicy not in self.policies:
+      print("Unknown overflow policy [%s], using [%s]" % (overflowPolicy, self.overflowPolicy))
+      return False
+    self.overflowPolicy = overflowPolicy
+    return True
+
+  # Called from the producer thread.  Returns true if the buffer was empty before
+  # this packet, which is when the consumer needs waking up.
+  def put(self, pkt):
+    with self.lock:
+      self.received += 1
+      wasEmpty = len(self.pkts) == 0
+
+      if len(self.pkts) >= self.maxsize:
+        self.dropped += 1
+        if self.overflowPolicy == self.DROP_NEWEST:
+          return False
+
+        if self.overflowPolicy == self.COLLAPSE:
+          self.collapse(pkt)
+        else:
+          self.pkts.popleft()
+
+      self.pkts.append(pkt)
+      if len(self.pkts) > self.highWater:
+        self.highWater = len(self.pkts)
+      return wasEmpty
+
+  # Removes the newest queued packet from the same (src, cmd) as pkt, since pkt
+  # supersedes it, or the oldest packet if there isn't one.  Lock must be held.
+  def collapse(self, pkt):
+    for i in range(len(self.pkts) - 1, -1, -1):
+      queued = self.pkts[i]
+      if queued.src == pkt.src and queued.cmd == pkt.cmd:
+        del self.pkts[i]
+        return
+    self.pkts.popleft()
+
+  # Called from the consumer thread.  Takes everything queued so far in one go.
+  def drain(self):
+    with self.lock:
+      pkts = self.pkts
+      self.pkts = collections.deque()
+    return pkts
+
+  def __len__(self):
+    return len(self.pkts)
+
+  def getStats(self):
+    with self.lock:
+      return { 'depth':len(self.pkts), 'highWater':self.highWater, 'received':self.received, 'dropped':self.dropped }
@@ -0,0 +1,256 @@
+import os
+import time
+import queue
+import struct
+import bisect
+import threading
+from mrbusUtils import MRBusPacket, MRBusDecoder
+
+# Capture files hold the packets seen on the bus, so an evening's traffic can be
+# replayed later.  The layout of a file is
+#
+#   header   - magic, version, wall clock start time (us since the epoch)
+#   records  - one binary packet frame each (see MRBusPacket.toBinary), with the
+#              frame's timestamp being microseconds since the capture started,
+#              taken from the monotonic clock
+#   index    - (timestamp, file offset) pairs, one for the first record after
+#              each indexInterval, so any point in the capture is a bisect and a
+#              seek away
+#   footer   - offset and entry count of the index, and a magic of its own
+#
+# The index and footer are written when the capture is closed.  A file cut short
+# by a crash has neither and is read by scanning the records instead.
+
+captureMagic = b'MRBCAP'
+captureVersion = 1
+captureHeader = struct.Struct('<6sBxQ')
+captureIndexEntry = struct.Struct('<QQ')
+captureFooter = struct.Struct('<QQ4s')
+captureFooterMagic = b'MIDX'
+
+
+# Takes packets from the receive thread and writes them from a thread of its own, so
+# the receive thread only ever pays for a timestamp and a queue put
+class MRBusCaptureRecorder:
+  def __init__(self, fileName, indexInterval=1.0):
+    self.fileName = fileName
+    self.indexInterval = int(indexInterval * 1000000)
+    self.pending = queue.SimpleQueue()
+    self.decoder = MRBusDecoder()
+    self.startTime = time.monotonic_ns() // 1000
+    self.index = [ ]
+    self.recorded = 0
+    self.failed = 0
+
+    self.file = open(fileName, 'wb')
+    self.file.write(captureHeader.pack(captureMagic, captureVersion, time.time_ns() // 1000))
+
+    self.writerThread = threading.Thread(target=self.writerLoop, name="mrbus-capture", daemon=True)
+    self.writerThread.start()
+
+  # Called from the receive thread with either the raw payload off crnw/raw or a
+  # packet that's already been decoded
+  def record(self, payloadOrPkt):
+    self.pending.put((time.monotonic_ns() // 1000, payloadOrPkt))
+
+  def writerLoop(self):
+    nextIndexTime = 0
+    while True:
+      item = self.pending.get()
+      if item is None:
+        break
+      (timestamp, pkt) = item
+      if not isinstance(pkt, MRBusPacket):
+        pkt = self.decoder.decode(pkt)
+        if pkt is None:
+          self.failed += 1
+          continue
+
+      timestamp -= self.startTime
+      if timestamp >= nextIndexTime:
+        self.index.append((timestamp, self.file.tell()))
+        nextIndexTime = timestamp + self.indexInterval
+      self.file.write(pkt.toBinary(timestamp))
+      self.recorded += 1
+
+  # Writes out everything still queued, then the index and footer
+  def close(self):
+    if self.file is None:
+      return
+    self.pending.put(None)
+    self.writerThread.join()
+
+    indexOffset = self.file.tell()
+    for entry in self.index:
+      self.file.write(captureIndexEntry.pack(*entry))
+    self.file.write(captureFooter.pack(indexOffset, len(self.index), captureFooterMagic))
+    self.file.close()
+    self.file = None
+    print("Captured %d packets to [%s]" % (self.recorded, self.fileName))
+
+
+# Reads a capture file back as (timestamp, packet) pairs, timestamps in microseconds
+# since the capture started
+class MRBusCaptureReader:
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.file = open(fileName, 'rb')
+
+    (magic, version, self.startWallTime) = captureHeader.unpack(self.file.read(captureHeader.size))
+    if magic != captureMagic or version != captureVersion:
+      self.file.close()
+      raise ValueError("[%s] is not a version %d capture file" % (fileName, captureVersion))
+
+    self.indexTimes = [ ]
+    self.indexOffsets = [ ]
+    self.recordsEnd = os.path.getsize(fileName)
+    self.readIndex()
+
+  def readIndex(self):
+    if self.recordsEnd < captureHeader.size + captureFooter.size:
+      return
+    self.file.seek(self.recordsEnd - captureFooter.size)
+    (indexOffset, entries, magic) = captureFooter.unpack(self.file.read(captureFooter.size))
+    if magic != captureFooterMagic or indexOffset + entries * captureIndexEntry.size + captureFooter.size != self.recordsEnd:
+      print("No index in [%s], it will be scanned" % (self.fileName))
+      return
+
+    self.file.seek(indexOffset)
+    for (timestamp, offset) in captureIndexEntry.iter_unpack(self.file.read(entries * captureIndexEntry.size)):
+      self.indexTimes.append(timestamp)
+      self.indexOffsets.append(offset)
+    self.recordsEnd = indexOffset
+
+  def close(self):
+    self.file.close()
+
+  # Length of the capture in microseconds, from the last record
+  def duration(self):
+    lastTime = 0
+    start = captureHeader.size
+    if len(self.indexOffsets) > 0:
+      start = self.indexOffsets[-1]
+    for (timestamp, pkt) in self.packets(offset=start):
+      lastTime = timestamp
+    return lastTime
+
+  # Yields (timestamp, packet) from the first record at or after startTime
+  def packets(self, startTime=0, offset=None):
+    if offset is None:
+      offset = captureHeader.size
+      i = bisect.bisect_right(self.indexTimes, startTime) - 1
+      if i >= 0:
+        offset = self.indexOffsets[i]
+
+    header = MRBusPacket.binaryHeader
+    self.file.seek(offset)
+    while offset + header.size <= self.recordsEnd:
+      frameHeader = self.file.read(header.size)
+      dataLen = frameHeader[4]
+      frame = frameHeader + self.file.read(dataLen)
+      offset += header.size + dataLen
+      decoded = MRBusPacket.fromBinary(frame)
+      if decoded is None:
+        print("Bad record in [%s], stopping" % (self.fileName))
+        return
+      (pkt, timestamp) = decoded
+      if timestamp >= startTime:
+        yield (timestamp, pkt)
+
+  def __iter__(self):
+    return self.packets()
+
+
+# Plays a capture file back into the packet buffer as if it were arriving off the
+# layout.  Looks like any other transport (see mrbusTransport.py), so the console
+# runs against it with no broker and no layout attached.  speed is a multiplier on
+# the recorded timing, 0 meaning as fast as possible - in that mode the replay waits
+# for the gui to make room in the buffer rather than letting packets be dropped,
+# so what's measured is how fast the whole pipeline can go.
+class MRBusCaptureReplayer:
+  name = 'Replay'
+
+  def __init__(self, mrbus, fileName, speed=1.0):
+    self.mrbus = mrbus
+    self.fileName = fileName
+    self.speed = speed
+    self.reader = None
+    self.replayThread = None
+    self.stopReplay = False
+    self.finished = False
+    self.replayed = 0
+    self.startTime = 0
+    self.endTime = 0
+    self.maxDepth = 0
+
+  def connect(self):
+    try:
+      self.reader = MRBusCaptureReader(self.fileName)
+    except (OSError, ValueError) as e:
+      print("Cannot replay [%s]: %s" % (self.fileName, e))
+      return False
+
+    print("Replaying [%s] at %s" % (self.fileName, "max speed" if self.speed <= 0 else "%gx" % (self.speed)))
+    self.stopReplay = False
+    self.finished = False
+    self.replayThread = threading.Thread(target=self.replayLoop, name="mrbus-replay", daemon=True)
+    self.replayThread.start()
+    return True
+
+  def disconnect(self):
+    if self.replayThread is None:
+      return
+    self.stopReplay = True
+    self.replayThread.join()
+    self.replayThread = None
+    self.reader.close()
+
+  # Once the file has run out nothing more will arrive
+  def isConnected(self):
+    return not self.finished and self.replayThread is not None
+
+  # Nothing is listening on the other end of a replay
+  def send(self, pkt):
+    print("Replay, not sending [%s]" % (str(pkt)))
+
+  def replayLoop(self):
+    incomingPkts = self.mrbus.incomingPkts
+    self.startTime = time.monotonic()
+    firstTimestamp = None
+
+    for (timestamp, pkt) in self.reader:
+      if self.stopReplay:
+        break
+
+      if self.speed > 0:
+        if firstTimestamp is None:
+          firstTimestamp = timestamp
+        delay = self.startTime + (timestamp - firstTimestamp) / 1000000 / self.speed - time.monotonic()
+        if delay > 0:
+          time.sleep(delay)
+      else:
+        while len(incomingPkts) >= incomingPkts.maxsize and not self.stopReplay:
+          time.sleep(0.001)
+
+      self.mrbus.packetReceived(pkt)
+      self.replayed += 1
+      depth = len(incomingPkts)
+      if depth > self.maxDepth:
+        self.maxDepth = depth
+
+    self.endTime = time.monotonic()
+    self.finished = True
+    stats = self.getStats()
+    print("Replay of [%s] done, %d packets in %.1fs, %.0f pkts/sec, max queue depth %d" % (self.fileName, stats['replayed'], stats['elapsed'], stats['pps'], stats['maxDepth']))
+
+  def getStats(self):
+    if self.finished:
+      elapsed = self.endTime - self.startTime
+    elif self.startTime != 0:
+      elapsed = time.monotonic() - self.startTime
+    else:
+      elapsed = 0
+    pps = 0
+    if elapsed > 0:
+      pps = self.replayed / elapsed
+    return { 'replayed':self.replayed, 'elapsed':elapsed, 'pps':pps, 'depth':len(self.mrbus.incomingPkts), 'maxDepth':self.maxDepth, 'finished':self.finished }
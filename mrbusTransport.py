@@ -0,0 +1,272 @@
+import os
+import socket
+import select
+import threading
+from mrbusUtils import MRBusPacket
+
+# termios is POSIX only, and only the serial transport needs it
+try:
+  import termios
+except ImportError:
+  termios = None
+
+# paho is only needed for the mqtt transport
+try:
+  import paho.mqtt.client as mqtt
+except ImportError:
+  mqtt = None
+
+# Transports move packets between the layout and the console.  Every transport has
+# the same few methods - connect(), disconnect(), isConnected() and send(pkt) - and
+# hands each received packet to mrbus.packetReceived() from its own thread, where
+# mrbus is the MqttMRBus that owns the packet buffer and decoder.  send() is called
+# connected or not, a transport that can't hold on to packets until it is drops them.
+
+
+def mqtt_onMessage(client, userdata, message):
+  mqttMRBus = userdata['mrbus']
+  # Capture everything, before filtering, so a replay sees what the layout saw
+  recorder = mqttMRBus.recorder
+  if recorder is not None:
+    recorder.record(message.payload)
+  # Packets from nodes nothing listens to are dropped here, before they're fully parsed
+  pkt = mqttMRBus.decoder.decode(message.payload)
+  if pkt is not None:
+    mqttMRBus.packetReceived(pkt)
+    #print("Adding pkt %s" % (str(pkt)))
+
+def mqtt_onConnect(client, userdata, flags, rc):
+#  logger = userdata['logger']
+  print("In mqtt_onConnect")
+  if rc == 0:
+    # Successful Connection
+    #logger.info("Successful MQTT Connection")
+    print("Successful MQTT Connection")
+    client.connected_flag = True
+  elif rc == 1:
+    print("ERROR: MQTT Incorrect Protocol Version")
+    client.connected_flag = False
+  elif rc == 2:
+    print("ERROR: MQTT Invalid Client ID")
+    client.connected_flag = False
+  elif rc == 3:
+    print("ERROR: MQTT Broker Unavailable")
+    client.connected_flag = False
+  elif rc == 4:
+    print("ERROR: MQTT Bad Username/Password")
+    client.connected_flag = False
+  elif rc == 5:
+    print("ERROR: MQTT Not Authorized")
+    client.connected_flag = False
+  else:
+    print("ERROR: MQTT Other Failure %d" % (rc))
+    client.connected_flag = False
+
+
+# Packets go through a broker, received on crnw/raw and sent on crnw/send
+class MqttTransport:
+  name = 'MQTT'
+
+  def __init__(self, mrbus, host, port, user=None, password=None, payloadFormat='json'):
+    self.mrbus = mrbus
+    self.host = host
+    self.port = port
+    self.user = user
+    self.password = password
+    self.payloadFormat = payloadFormat   # How packets are sent on crnw/send, 'json' or 'binary'
+    self.client = None
+
+    if mqtt is None:
+      print("paho-mqtt is not installed, cannot use the MQTT transport")
+      return
+
+    self.client = mqtt.Client(socket.getfqdn(), userdata={'mrbus': mrbus})
+    self.client.on_message = mqtt_onMessage
+    self.client.on_connect = mqtt_onConnect
+
+  def connect(self):
+    if self.client is None:
+      return False
+
+    print("Starting MQTT connection user=[%s], pass=[%s], host=[%s], port=[%d]" % (self.user, self.password, self.host, self.port))
+
+    if self.user != None:
+      self.client.username_pw_set(self.user, self.password)
+
+    self.client.connect(self.host, self.port, 60)
+    self.client.loop_start()
+    self.client.subscribe("crnw/raw")
+    return True
+
+  def disconnect(self):
+    if self.client is None:
+      return
+    if self.client.is_connected():
+      self.client.disconnect()
+    self.client.loop_stop()
+
+  def isConnected(self):
+    return self.client is not None and self.client.is_connected()
+
+  # paho queues anything published before the broker accepts the connection, so
+  # this only needs a client
+  def send(self, pkt):
+    if self.client is None:
+      print("No MQTT client, dropping [%s]" % (str(pkt)))
+      return
+    topic = 'crnw/send'
+    if self.payloadFormat == 'binary':
+      message = pkt.toBinary()
+      print("Sending [%s]  [%s]" % (topic, str(pkt)))
+    else:
+      message = pkt.toJSON()
+      print("Sending [%s]  [%s]" % (topic, message))
+    self.client.publish(topic=topic, payload=message)
+    print("Sent")
+
+
+# Talks straight to an MRBus serial interface (CI2 or anything else speaking the same
+# ASCII protocol), no broker in the way.  Received packets come in as lines of hex,
+#   P:DD SS LL CRCL CRCH CMD D0 D1 ...
+# and packets go out as
+#   :SS->DD CMD D0 D1 ...;
+# Works just as well against one end of a pty pair for testing.
+class SerialTransport:
+  name = 'Serial'
+  baudRates = { }
+  if termios is not None:
+    baudRates = { 9600:termios.B9600, 19200:termios.B19200, 38400:termios.B38400, 57600:termios.B57600, 115200:termios.B115200 }
+
+  def __init__(self, mrbus, device, baud=115200):
+    self.mrbus = mrbus
+    self.device = device
+    self.baud = baud
+    self.fd = None
+    self.readerThread = None
+    self.stopReader = False
+    self.writeLock = threading.Lock()
+    self.badLines = 0
+
+  def connect(self):
+    if termios is None:
+      print("No termios on this platform, cannot use the serial transport")
+      return False
+
+    if self.baud not in self.baudRates:
+      print("Unsupported baud rate [%s] for [%s]" % (self.baud, self.device))
+      return False
+
+    try:
+      fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError as e:
+      print("Cannot open serial port [%s]: %s" % (self.device, e))
+      return False
+
+    try:
+      # Raw mode, 8N1, no flow control
+      attrs = termios.tcgetattr(fd)
+      attrs[0] = termios.IGNPAR
+      attrs[1] = 0
+      attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+      attrs[3] = 0
+      attrs[4] = self.baudRates[self.baud]
+      attrs[5] = self.baudRates[self.baud]
+      attrs[6][termios.VMIN] = 0
+      attrs[6][termios.VTIME] = 0
+      termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error as e:
+      print("Cannot configure serial port [%s]: %s" % (self.device, e))
+      os.close(fd)
+      return False
+
+    print("Opened serial port [%s] at %d baud" % (self.device, self.baud))
+    self.fd = fd
+    self.stopReader = False
+    self.readerThread = threading.Thread(target=self.readerLoop, name="mrbus-serial", daemon=True)
+    self.readerThread.start()
+    return True
+
+  def disconnect(self):
+    self.stopReader = True
+    if self.readerThread is not None:
+      self.readerThread.join()
+      self.readerThread = None
+    self.closePort()
+
+  # Under the write lock, so send() never writes to a descriptor that's been closed
+  # and maybe reused
+  def closePort(self):
+    with self.writeLock:
+      if self.fd is not None:
+        os.close(self.fd)
+        self.fd = None
+
+  def isConnected(self):
+    return self.fd is not None
+
+  def send(self, pkt):
+    message = ":%02X->%02X %02X" % (pkt.src, pkt.dest, pkt.cmd) + "".join([" %02X" % d for d in pkt.data]) + ";\r"
+    print("Sending [%s]  [%s]" % (self.device, message.strip()))
+    data = message.encode('ascii')
+    with self.writeLock:
+      if self.fd is None:
+        print("Serial port [%s] is closed, dropping [%s]" % (self.device, str(pkt)))
+        return
+      while len(data) > 0:
+        try:
+          data = data[os.write(self.fd, data):]
+        except BlockingIOError:
+          select.select([], [self.fd], [], 0.1)
+        except OSError as e:
+          print("Serial port [%s] write failed, dropping [%s]: %s" % (self.device, str(pkt), e))
+          return
+
+  # Runs in its own thread.  Waits on the port with a timeout so disconnect() can
+  # stop it, and splits whatever arrives into lines.
+  def readerLoop(self):
+    pending = b''
+    while not self.stopReader:
+      (readable, writable, errored) = select.select([self.fd], [], [], 0.25)
+      if not readable:
+        continue
+      try:
+        chunk = os.read(self.fd, 4096)
+      except BlockingIOError:
+        continue
+      except OSError as e:
+        # A pty whose other end has gone away reports EIO.  The port is no use after
+        # this, so close it and let isConnected() say so.
+        print("Serial port [%s] read failed: %s" % (self.device, e))
+        self.closePort()
+        break
+      if len(chunk) == 0:
+        # Readable with nothing to read is the same thing on some kernels
+        print("Serial port [%s] hung up" % (self.device))
+        self.closePort()
+        break
+
+      pending += chunk
+      lines = pending.replace(b'\r', b'\n').split(b'\n')
+      pending = lines.pop()
+      for line in lines:
+        pkt = self.parseLine(line)
+        if pkt is not None:
+          recorder = self.mrbus.recorder
+          if recorder is not None:
+            recorder.record(pkt)
+          self.mrbus.packetReceived(pkt)
+
+  def parseLine(self, line):
+    line = line.strip()
+    if not line.startswith(b'P:'):
+      return None   # Interface chatter, acks and the like
+    try:
+      values = [int(v, 16) for v in line[2:].split()]
+      # The length byte counts the whole packet, header included
+      if len(values) < 6 or len(values) < values[2]:
+        raise ValueError("short packet")
+      return MRBusPacket.fromValues(values[0], values[1], values[5], values[6:values[2]])
+    except ValueError:
+      self.badLines += 1
+      print("Bad serial line [%s]" % (line))
+      return None
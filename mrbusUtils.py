@@ -1,24 +1,49 @@
 import re
 import json
+import array
+import time
+import struct
 import datetime
+import operator
 
-class MRBusPacket:
-  def __init__(self, dest=0, src=0, cmd=0, data=0):
-    self.dest=int(str(dest), 0)
-    self.src=int(str(src), 0)
-    self.cmd=int(str(cmd), 0)
-    self.data = []
-    for d in data:
-      self.data.append(int(str(d), 0))
+# orjson is a good bit quicker at parsing the packet JSON, but optional
+try:
+  import orjson
+  jsonLoads = orjson.loads
+except ImportError:
+  orjson = None
+  jsonLoads = json.loads
 
-  def __hash__(self):
-    return hash(repr(self))
+# Packets are immutable (dest, src, cmd, data) tuples with the data held as bytes, so
+# they're small, safe to hand between threads, and hash/compare on the raw values.
+# Being a tuple, a packet on its own after % is taken as the format's arguments, so
+# format it with str(pkt).
+class MRBusPacket(tuple):
+  __slots__ = ()
 
+  dest = property(operator.itemgetter(0))
+  src = property(operator.itemgetter(1))
+  cmd = property(operator.itemgetter(2))
+  data = property(operator.itemgetter(3))
+
+  # Accepts anything int(str(x), 0) understands, for values coming out of config files
+  def __new__(cls, dest=0, src=0, cmd=0, data=()):
+    return tuple.__new__(cls, (int(str(dest), 0), int(str(src), 0), int(str(cmd), 0), bytes([int(str(d), 0) for d in data])))
+
+  def __getnewargs__(self):
+    return tuple(self)
+
+  # Only ever equal to another packet, never to a plain tuple of the same values
   def __eq__(self, other):
-    return repr(self)==repr(other)
+    return isinstance(other, MRBusPacket) and tuple.__eq__(self, other)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  __hash__ = tuple.__hash__
 
   def __repr__(self):
-    return "mrbus.packet(0x%02x, 0x%02x, 0x%02x, %s)"%(self.dest, self.src, self.cmd, repr(self.data))
+    return "mrbus.packet(0x%02x, 0x%02x, 0x%02x, %s)"%(self.dest, self.src, self.cmd, repr(list(self.data)))
 
   def __str__(self):
     c='(0x%02X'%self.cmd
@@ -30,92 +55,339 @@ class MRBusPacket:
 
   def toJSON(self):
     updateTime = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()
-    pktinfo = { 'type': 'pkt', 'src': self.src, 'dst': self.dest, 'cmd': self.cmd, 'data':self.data, 'time': updateTime }
+    pktinfo = { 'type': 'pkt', 'src': self.src, 'dst': self.dest, 'cmd': self.cmd, 'data':list(self.data), 'time': updateTime }
 #    mosquitto_pub -h crnw.drgw.net -t 'crnw/send' -m "{\"cmd\": \"0x43\", \"data\": [\"0x02\", \"0x44\", \"0x57\"], \"dst\": \"0x37\", \"src\": 254, \"time\": \"2020-12-17T05:02:08.280321+00:00\", \"type\": \"pkt\"}"
     return json.dumps(pktinfo, sort_keys=True)
 
+  # Compact framing for the MQTT topics: version, src, dst, cmd, data length, a
+  # uint64 timestamp in microseconds since the epoch, then the raw data bytes
+  binaryVersion = 0x01
+  binaryHeader = struct.Struct('<BBBBBQ')
+
+  def toBinary(self, timestamp=None):
+    if timestamp is None:
+      timestamp = time.time_ns() // 1000
+    return self.binaryHeader.pack(self.binaryVersion, self.src, self.dest, self.cmd, len(self.data), timestamp) + self.data
+
+  # Returns (packet, timestamp in microseconds) or None if the frame is bad
+  @classmethod
+  def fromBinary(cls, payload):
+    header = cls.binaryHeader
+    if len(payload) < header.size:
+      return None
+    (version, src, dest, cmd, dataLen, timestamp) = header.unpack_from(payload)
+    if version != cls.binaryVersion or len(payload) != header.size + dataLen:
+      return None
+    return (tuple.__new__(cls, (dest, src, cmd, bytes(payload[header.size:]))), timestamp)
+
+  # Builds a packet from values that are already ints (data may be bytes or a list
+  # of ints), skipping the string conversions the constructor does
+  @classmethod
+  def fromValues(cls, dest, src, cmd, data):
+    return tuple.__new__(cls, (dest, src, cmd, bytes(data)))
+
   @classmethod
   def fromJSON(cls, message):
-    self = cls.__new__(cls)
-    retval = self._fromJSON(message)
-    if False == retval:
+    pkt = MRBusDecoder.parse(message)
+    if pkt is None:
       print("packet didn't parse")
+    return pkt
+
+
+# Turns the payloads from crnw/raw into packets, either JSON or binary frames (told
+# apart by the first byte, JSON always starts with '{').  Meant to be run in the
+# network thread, so it first pulls the source address out of the raw bytes and
+# throws away packets from nodes nobody is listening to before paying for the parse.
+class MRBusDecoder:
+  srcPattern = re.compile(rb'"src"\s*:\s*"?(0x[0-9A-Fa-f]+|[0-9]+)')
+
+  def __init__(self):
+    self.wantedSources = None   # None means keep everything
+    self.decoded = 0
+    self.filtered = 0
+    self.failed = 0
+
+  # Set from the gui thread, replaced in one assignment so the network thread
+  # always sees either the old set or the new one
+  def setWantedSources(self, sources):
+    if sources is None:
+      self.wantedSources = None
+    else:
+      self.wantedSources = frozenset(sources)
+
+  # Takes the raw message payload (bytes), returns a packet or None if the packet
+  # was filtered out or didn't parse
+  def decode(self, payload):
+    if len(payload) > 1 and payload[0] == MRBusPacket.binaryVersion:
+      return self.decodeBinary(payload)
+
+    wantedSources = self.wantedSources
+    if wantedSources is not None:
+      m = self.srcPattern.search(payload)
+      if m is not None:
+        try:
+          src = int(m.group(1), 0)
+        except ValueError:   # e.g. a leading zero, which parse() wouldn't take either
+          self.failed += 1
+          print("Packet failed")
+          return None
+        if src not in wantedSources:
+          self.filtered += 1
+          return None
+
+    pkt = self.parse(payload)
+    if pkt is None:
+      self.failed += 1
+      print("Packet failed")
+      return None
+
+    self.decoded += 1
+    return pkt
+
+  def decodeBinary(self, payload):
+    wantedSources = self.wantedSources
+    if wantedSources is not None and payload[1] not in wantedSources:
+      self.filtered += 1
       return None
-    return self
 
-  def _fromJSON(self, message):
+    decoded = MRBusPacket.fromBinary(payload)
+    if decoded is None:
+      self.failed += 1
+      print("Binary packet failed")
+      return None
+
+    self.decoded += 1
+    return decoded[0]
+
+  @staticmethod
+  def toInt(value):
+    if type(value) is int:
+      return value
+    return int(str(value), 0)
+
+  @classmethod
+  def parse(cls, payload):
     try:
-      decodedValues = json.loads(message)
-      if 'type' not in decodedValues or decodedValues['type'] != 'pkt':
-        return False
-      if 'src' not in decodedValues or 'dst' not in decodedValues or 'cmd' not in decodedValues or 'data' not in decodedValues:
-        return False
-      self.src = int(decodedValues['src'])
-      self.dest = int(decodedValues['dst'])
-      self.cmd = int(decodedValues['cmd'])
-      self.data = []
-      for d in decodedValues['data']:
-        self.data.append(int(d))
-
-    except:
-      return False
-      
-    return True
-    
-    
-class MRBusBit:
-  def __init__(self, pattern="", initialState = False, packetApplied = None):
-    self.src = 0
-    self.cmd = 0
-    self.byte = 0
-    self.bit = 0
-    self.negate = False
-    self.state = initialState
+      values = jsonLoads(payload)
+      if values.get('type') != 'pkt':
+        return None
+      toInt = cls.toInt
+      data = [d if type(d) is int else toInt(d) for d in values['data']]
+      return MRBusPacket.fromValues(toInt(values['dst']), toInt(values['src']), toInt(values['cmd']), data)
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return None
+
+
+# Every sensor bit in the layout lives here, with its definition spread over parallel
+# arrays indexed by sensor number.  Sensors are grouped by the (src, cmd) they listen
+# to, and each group keeps the payload bits its sensors care about as a single int,
+# so applying a packet is one mask and one XOR no matter how many sensors share it.
+class MRBusSensorTable:
+  def __init__(self):
+    self.srcs = array.array('B')
+    self.cmds = array.array('B')
+    self.byteNums = array.array('H')
+    self.bitNums = array.array('B')
+    self.positions = array.array('I')   # byte * 8 + bit, the bit number in the payload int
+    self.groupIds = array.array('i')    # -1 for sensors with no pattern
+    self.negates = bytearray()
+    self.initialStates = bytearray()
+
+    self.groupIndex = { }        # (src, cmd) -> group id
+    self.groupMasks = [ ]        # payload bits any sensor in the group looks at
+    self.groupValues = [ ]       # last received payload bits, masked
+    self.groupKnown = [ ]        # bits that have actually been received
+    self.groupFlipped = [ ]      # bits that changed in the last packet applied
+    self.groupNewlyKnown = [ ]   # bits received for the first time in the last packet
+    self.groupOwners = [ ]       # every owner with a sensor in the group
+    self.groupBitOwners = [ ]    # position -> owners with a sensor on that bit
+    self.groupResync = [ ]       # hand the next packet to every owner
+
+  def __len__(self):
+    return len(self.srcs)
+
+  # Registers a sensor from a pattern like "!0x38,S,11:0" and returns the handle
+  # the owning object keeps.  Owners are handed back by applyPacket().
+  def addSensor(self, pattern="", initialState=False, owner=None):
+    index = len(self.srcs)
+    src = cmd = byte = bit = 0
+    negate = False
     if pattern != "":
-      self.fromPattern(pattern)
+      parsed = MRBusBit.parsePattern(pattern)
+      if parsed is not None:
+        (negate, src, cmd, byte, bit) = parsed
+      if byte < 0:
+        print("Pattern [%s] points into the packet header" % (pattern))
+        src = cmd = byte = bit = 0
 
-  # Changes the internal bit state if the packet matches
-  # Returns true if this packet applied to us and changed our state
+    self.srcs.append(src)
+    self.cmds.append(cmd)
+    self.byteNums.append(byte)
+    self.bitNums.append(bit)
+    self.positions.append(byte * 8 + bit)
+    self.negates.append(negate)
+    self.initialStates.append(initialState)
+
+    if src == 0:
+      self.groupIds.append(-1)   # Unconfigured, never matches anything
+      return MRBusBit(self, index)
+
+    key = (src, cmd)
+    if key not in self.groupIndex:
+      self.groupIndex[key] = len(self.groupMasks)
+      self.groupMasks.append(0)
+      self.groupValues.append(0)
+      self.groupKnown.append(0)
+      self.groupFlipped.append(0)
+      self.groupNewlyKnown.append(0)
+      self.groupOwners.append([ ])
+      self.groupBitOwners.append({ })
+      self.groupResync.append(False)
+    group = self.groupIndex[key]
+    self.groupIds.append(group)
+
+    pos = byte * 8 + bit
+    self.groupMasks[group] |= 1 << pos
+    if owner is not None:
+      if owner not in self.groupOwners[group]:
+        self.groupOwners[group].append(owner)
+      bitOwners = self.groupBitOwners[group].setdefault(pos, [ ])
+      if owner not in bitOwners:
+        bitOwners.append(owner)
+
+    return MRBusBit(self, index)
+
+  # Updates every sensor listening to the packet's (src, cmd) and returns the owners of
+  # those whose state may have changed, in the order they were registered.  A repeat of
+  # the bits a group already has costs a dict lookup and a couple of int operations.
+  def applyPacket(self, pkt):
+    group = self.groupIndex.get((pkt.src, pkt.cmd))
+    if group is None:
+      return ()
+
+    present = (1 << (8 * len(pkt.data))) - 1
+    mask = self.groupMasks[group] & present
+    value = int.from_bytes(pkt.data, 'little') & mask
+    oldValue = self.groupValues[group]
+    known = self.groupKnown[group]
+
+    flipped = (value ^ oldValue) & mask & known
+    newlyKnown = mask & ~known
+    self.groupFlipped[group] = flipped
+    self.groupNewlyKnown[group] = newlyKnown
+
+    if self.groupResync[group]:
+      self.groupResync[group] = False
+      self.groupValues[group] = (oldValue & ~mask) | value
+      self.groupKnown[group] = known | mask
+      return self.groupOwners[group]
+
+    touched = flipped | newlyKnown
+    if 0 == touched:
+      return ()
+
+    self.groupValues[group] = (oldValue & ~mask) | value
+    self.groupKnown[group] = known | mask
+
+    bitOwners = self.groupBitOwners[group]
+    owners = { }
+    while touched:
+      lowBit = touched & -touched
+      for owner in bitOwners.get(lowBit.bit_length() - 1, ()):
+        owners[owner] = True
+      touched ^= lowBit
+    return list(owners)
+
+  # Every node address a sensor listens to
+  def getSources(self):
+    return set(key[0] for key in self.groupIndex.keys())
+
+  def getState(self, index):
+    group = self.groupIds[index]
+    pos = self.positions[index]
+    if group < 0 or not (self.groupKnown[group] >> pos) & 1:
+      return bool(self.initialStates[index])
+    return bool((self.groupValues[group] >> pos) & 1) != bool(self.negates[index])
+
+  # The current state of every sensor in the layout, one byte per sensor
+  def getStates(self):
+    return bytearray(self.getState(index) for index in range(0, len(self.srcs)))
+
+
+# Handle to one sensor in an MRBusSensorTable
+class MRBusBit:
+  __slots__ = ('table', 'index')
+
+  def __init__(self, table, index):
+    self.table = table
+    self.index = index
+
+  @property
+  def src(self):
+    return self.table.srcs[self.index]
+
+  @property
+  def cmd(self):
+    return self.table.cmds[self.index]
+
+  @property
+  def byte(self):
+    return self.table.byteNums[self.index]
+
+  @property
+  def bit(self):
+    return self.table.bitNums[self.index]
+
+  @property
+  def negate(self):
+    return bool(self.table.negates[self.index])
+
+  @property
+  def state(self):
+    return self.table.getState(self.index)
+
+  # Returns true if this packet carries our bit
   def packetApplies(self, pkt):
-    if self.src == pkt.src and self.cmd == pkt.cmd and len(pkt.data) >= self.byte:
+    if self.src == pkt.src and self.cmd == pkt.cmd and len(pkt.data) > self.byte:
       return True
     return False
-  
-  
+
+  # Returns true if the packet, which must already have gone through the table's
+  # applyPacket(), changed our state
   def testPacket(self, pkt, debug=False):
-    if self.src == 0:
+    table = self.table
+    group = table.groupIds[self.index]
+    if group < 0 or not self.packetApplies(pkt):
       return False
 
-    oldState = self.state
-    if self.packetApplies(pkt):
-      if (pkt.data[self.byte] & (1<<self.bit)) != 0:
-        self.state = True
-      else:
-        self.state = False
-
-      if self.negate:
-        self.state = not self.state
-
-      if oldState is not self.state:
-        return True
+    pos = table.positions[self.index]
+    if (table.groupFlipped[group] >> pos) & 1:
+      return True
+    if (table.groupNewlyKnown[group] >> pos) & 1:
+      return self.getState() != bool(table.initialStates[self.index])
     return False
-  
+
   def getState(self):
-    return self.state
-  
-  def fromPattern(self, pattern):
+    return self.table.getState(self.index)
+
+  # Makes the next packet for our (src, cmd) reach every owner in the group, even if
+  # nothing in it changed - for an owner waiting on the node to answer a command
+  def resync(self):
+    group = self.table.groupIds[self.index]
+    if group >= 0:
+      self.table.groupResync[group] = True
+
+  # Splits a pattern like "!0x38,S,11:0" into (negate, src, cmd, byte, bit), with the
+  # byte number made relative to the start of the packet data
+  @staticmethod
+  def parsePattern(pattern):
     m = re.match("(?P<neg>!*)(?P<src>0x[0-9A-Za-z]{2}),(?P<cmd>[0-9A-Za-z]{1}),(?P<byte>\d+):(?P<bit>\d+)", pattern)
     if m is not None:
       if m.group('neg') != None and m.group('neg')=='!':
-        self.negate = True
+        negate = True
       else:
-        self.negate = False
-      self.src = int(m.group('src'), 0)
-      self.cmd = ord(m.group('cmd'))
-      self.byte = int(m.group('byte'))-6
-      self.bit = int(m.group('bit'))
-
-      return True
+        negate = False
+      return (negate, int(m.group('src'), 0), ord(m.group('cmd')), int(m.group('byte'))-6, int(m.group('bit')))
 
     print("Pattern did not match")
-    return False
+    return None
@@ -0,0 +1,64 @@
+import sys
+
+# Every color the console draws with, by what it's for.  A layout can change any of
+# them with a "theme" section in layout.json, e.g.
+#
+#   "theme": { "track_idle":"#888888", "background":"#101010" }
+#
+defaultColors = {
+  'track_occupied':'#ff0000',
+  'track_idle'    :'#ffffff',
+  'track_lined'   :'#00ff00',
+  'track_manual'  :'#00ccff',
+  'track_unknown' :'#cccccc',
+  'track_nopower' :'#ffd700',
+  'switch_locked' :'#ff0000',
+  'switch_normal' :'#00ff00',
+  'switch_manual' :'#00ccff',
+  'switch_unknown':'#cccccc',
+  'signal_blinkoff':'#777777',
+  'signal_lined'  :'#00ff00',
+  'signal_normal' :'#ff0000',
+  'signal_unknown':'#cccccc',
+  'default'       :'#cccccc',
+  'background'    :'#000',
+  'grid'          :'#AAA',
+  'text'          :'#FFF',
+  'text_blockname':'#ccffff',
+}
+
+# The current colors, as attributes named after defaultColors' keys - so
+# Palette.track_lined rather than a lookup by name in the middle of a loop.  They're
+# interned, so two names with the same color hold the same object and comparing
+# colors can be done with "is".  The pens and brushes drawn with them are cached by
+# GDICache in cells.py.
+class Palette:
+  colors = { }
+
+  # Sets every color back to its default, then applies the theme over the top.
+  # Returns true if any color changed, in which case anything cached from the old
+  # colors needs throwing away.
+  @staticmethod
+  def loadTheme(theme=None):
+    colors = dict(defaultColors)
+    if theme is not None:
+      for (name, color) in theme.items():
+        if name not in defaultColors.keys():
+          print("Unknown theme color [%s]" % (name))
+          continue
+        colors[name] = str(color)
+
+    changed = False
+    for (name, color) in colors.items():
+      color = sys.intern(color)
+      if Palette.colors.get(name) is not color:
+        changed = True
+        Palette.colors[name] = color
+        setattr(Palette, name, color)
+    return changed
+
+  @staticmethod
+  def getColor(name):
+    return Palette.colors.get(name, Palette.colors['default'])
+
+Palette.loadTheme()
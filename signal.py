@@ -1,8 +1,9 @@
-from cells import SignalCell,TrackCellColors,TrackCellType
-from mrbusUtils import MRBusBit,MRBusPacket
+from cells import SignalCell,TrackCellType
+from palette import Palette
+from mrbusUtils import MRBusPacket
 
 class Signal:
-  def __init__(self, config, txCallback):
+  def __init__(self, config, txCallback, sensorTable):
     self.name = config['name']
     self.lined = False
     self.unverified = True   # Set when a command has been issued but no response has come
@@ -16,7 +17,7 @@ class Signal:
     pattern = ""
     if "sensorLined" in config.keys():
       pattern = config['sensorLined']
-    self.sensorLined = MRBusBit(pattern)
+    self.sensorLined = sensorTable.addSensor(pattern, False, self)
 
     cellType = {
       'signal_left':TrackCellType.SIG_SINGLE_LEFT,
@@ -31,6 +32,12 @@ class Signal:
 
   # processPacket takes an incoming MRBus packet
   def processPacket(self, pkt):
+    if self.updateFromPacket(pkt):
+      self.recalculateState()
+
+  # Applies the packet to the signal's sensor state only, returns true if
+  # recalculateState() needs to be run afterwards
+  def updateFromPacket(self, pkt):
     changed = self.sensorLined.testPacket(pkt)
 
     if self.unverified and self.sensorLined.packetApplies(pkt):
@@ -39,7 +46,7 @@ class Signal:
     if changed:
       self.unverified = False
       self.lined = self.sensorLined.getState()
-      self.recalculateState()
+    return changed
 
   def getClickXY(self):
     return (self.cell.getXY())
@@ -89,14 +96,14 @@ class Signal:
 
   def recalculateState(self):
 #    print("Recalculating state for [%s]" % (self.name))
-    signalColor = TrackCellColors.getColor('signal_unknown')
+    signalColor = Palette.signal_unknown
 
     if self.unverified:
-      signalColor = TrackCellColors.getColor('signal_unknown')
+      signalColor = Palette.signal_unknown
     elif self.lined:
-      signalColor = TrackCellColors.getColor('signal_lined')
+      signalColor = Palette.signal_lined
     else:
-      signalColor = TrackCellColors.getColor('signal_normal')
+      signalColor = Palette.signal_normal
     self.cell.setColor(signalColor, self.blinky)
 #    print("Setting signal [%s] to %s" % (self.name, signalColor))
 
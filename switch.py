@@ -1,9 +1,10 @@
-from cells import SwitchCell,TrackCellColors,TrackCellType
-from mrbusUtils import MRBusBit,MRBusPacket
+from cells import SwitchCell,TrackCellType
+from palette import Palette
+from mrbusUtils import MRBusPacket
 import datetime
 
 class Switch:
-  def __init__(self, config, txCallback):
+  def __init__(self, config, txCallback, sensorTable):
     self.name = config['name']
     self.positionNormal = True
     self.positionReverse = False
@@ -28,22 +29,22 @@ class Switch:
     pattern = ""
     if "sensorNormal" in config.keys():
       pattern = config['sensorNormal']
-    self.sensorNormal = MRBusBit(pattern)
+    self.sensorNormal = sensorTable.addSensor(pattern, False, self)
     
     pattern = ""
     if "sensorReverse" in config.keys():
       pattern = config['sensorReverse']
-    self.sensorReverse = MRBusBit(pattern)
+    self.sensorReverse = sensorTable.addSensor(pattern, False, self)
 
     pattern = ""
     if "sensorManual" in config.keys():
       pattern = config['sensorManual']
-    self.sensorManual = MRBusBit(pattern)
+    self.sensorManual = sensorTable.addSensor(pattern, False, self)
 
     pattern = ""
     if "sensorOccupancy" in config.keys():
       pattern = config['sensorOccupancy']
-    self.sensorOccupancy = MRBusBit(pattern)
+    self.sensorOccupancy = sensorTable.addSensor(pattern, False, self)
 
     self.cell = SwitchCell()
     self.cell.setXY(int(config['x']), int(config['y']))
@@ -57,12 +58,18 @@ class Switch:
 
   # processPacket takes an incoming MRBus packet
   def processPacket(self, pkt):
+    if self.updateFromPacket(pkt):
+      self.recalculateState()
+
+  # Applies the packet to the switch's sensor state only, returns true if
+  # recalculateState() needs to be run afterwards
+  def updateFromPacket(self, pkt):
     changed = self.sensorNormal.testPacket(pkt)
     changed = self.sensorReverse.testPacket(pkt) or changed
     changed = self.sensorManual.testPacket(pkt) or changed
     changed = self.sensorOccupancy.testPacket(pkt) or changed
 
-    if self.positionNormal == False and self.positionReverse == False and (self.commandLastSent != None and (datetime.datetime.utcnow() - self.commandLastSent).total_seconds() > 3):
+    if self.commandTimedOut():
       changed = True
 
     if changed:
@@ -70,9 +77,25 @@ class Switch:
       self.positionReverse = self.sensorReverse.getState()
       self.manualControl = self.sensorManual.getState()
       self.occupied = self.sensorOccupancy.getState()
-      self.recalculateState()
 #    else:
 #      print("Processed packet for [%s], no change in state" % (self.name))
+    return changed
+
+  # A switch we commanded that hasn't reported either position within 3 seconds
+  # falls back to whatever the sensors say
+  def commandTimedOut(self):
+    if self.positionNormal == False and self.positionReverse == False and (self.commandLastSent != None and (datetime.datetime.utcnow() - self.commandLastSent).total_seconds() > 3):
+      return True
+    return False
+
+  # Called periodically so timeouts still fire when no packets arrive for this switch
+  def processTimers(self):
+    if not self.commandTimedOut():
+      return False
+    self.positionNormal = self.sensorNormal.getState()
+    self.positionReverse = self.sensorReverse.getState()
+    self.recalculateState()
+    return True
 
   def getClickXY(self):
     return (self.cell.getXY())
@@ -95,7 +118,7 @@ class Switch:
       pkt = self.commandNormal
 
     if None != pkt:
-      print("Sending switch change pkt to %s\n[%s]" % (self.name, pkt))
+      print("Sending switch change pkt to %s\n[%s]" % (self.name, str(pkt)))
       self.commandLastSent = datetime.datetime.utcnow()
       self.txCallback(pkt)
 
@@ -115,24 +138,24 @@ class Switch:
   def recalculateState(self):
     #print("Recalculating state for [%s]" % (self.name))
     
-    defaultColor = TrackCellColors.getColor('switch_unknown')
+    defaultColor = Palette.switch_unknown
     # Compute switch square color
     if self.manualControl:  # Manual is first, since manual makes the OS "occupied"
-      self.cell.setSwitchStatusColor(TrackCellColors.getColor('switch_manual'))
+      self.cell.setSwitchStatusColor(Palette.switch_manual)
     elif self.locked or self.occupied:
-      self.cell.setSwitchStatusColor(TrackCellColors.getColor('switch_locked'))
+      self.cell.setSwitchStatusColor(Palette.switch_locked)
     elif self.positionNormal or self.positionReverse:
-      self.cell.setSwitchStatusColor(TrackCellColors.getColor('switch_normal'))
+      self.cell.setSwitchStatusColor(Palette.switch_normal)
     else:
       self.cell.setSwitchStatusColor(defaultColor)
 
     # Compute track color
     if self.lined:
-      self.cell.setColor(TrackCellColors.getColor('track_lined'))
+      self.cell.setColor(Palette.track_lined)
     elif self.occupied:
-      self.cell.setColor(TrackCellColors.getColor('track_occupied'))
+      self.cell.setColor(Palette.track_occupied)
     else:
-      self.cell.setColor(TrackCellColors.getColor('track_idle'))
+      self.cell.setColor(Palette.track_idle)
 
     if self.positionNormal:
       self.cell.setSwitchPosition(0)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The console's modules live at the top of the repo, not in a package
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+  sys.path.insert(0, root)
+
+# signal.py has the same name as the standard library's signal module, which pytest
+# has usually imported by now.  Drop that from the module cache so the layout code's
+# "from signal import Signal" finds ours - pytest keeps its own reference.
+if 'signal' in sys.modules and not str(getattr(sys.modules['signal'], '__file__', '')).startswith(root):
+  del sys.modules['signal']
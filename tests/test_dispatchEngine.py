@@ -0,0 +1,53 @@
+import contextlib
+import io
+import json
+import os
+
+import dispatchEngine
+from mrbusUtils import MRBusPacket
+
+layoutPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'layout.json')
+
+def status(src, data):
+  return MRBusPacket(0xFF, src, ord('S'), data)
+
+def loadEngine():
+  sent = [ ]
+  engine = dispatchEngine.DispatchEngine(sent.append)
+  with open(layoutPath) as f:
+    layoutData = json.load(f)
+  with contextlib.redirect_stdout(io.StringIO()):
+    engine.loadLayout(layoutData)
+  return (engine, sent)
+
+
+def test_signal_stays_unverified_until_its_node_answers():
+  (engine, sent) = loadEngine()
+  signal = engine.getRailroadObject('signal', 'Nicolai Main 2 Signal')
+  with contextlib.redirect_stdout(io.StringIO()):
+    engine.applyPackets([status(0x30, [0] * 10)])
+    assert not signal.unverified
+    signal.onLeftClick()
+  assert len(sent) == 1
+  assert signal.unverified
+
+  # Occupancy changing somewhere else on the layout isn't an answer
+  with contextlib.redirect_stdout(io.StringIO()):
+    engine.applyPackets([status(0x36, [0xFF] * 10)])
+    engine.applyPackets([status(0x36, [0x00] * 10)])
+  assert signal.unverified
+
+  # Even if nothing in it changed, the CP's node reporting is
+  with contextlib.redirect_stdout(io.StringIO()):
+    engine.applyPackets([status(0x30, [0] * 10)])
+  assert not signal.unverified
+
+
+def test_signals_unknown_until_their_node_reports():
+  (engine, sent) = loadEngine()
+  signal = engine.getRailroadObject('signal', 'Nicolai Main 2 Signal')
+  with contextlib.redirect_stdout(io.StringIO()):
+    for src in [0x24, 0x36, 0x37]:
+      engine.applyPackets([status(src, [0xFF] * 10)])
+      engine.applyPackets([status(src, [0x00] * 10)])
+  assert signal.unverified
@@ -0,0 +1,85 @@
+import contextlib
+import io
+import json
+import os
+import queue
+import time
+
+import pytest
+
+from layoutSimulator import LayoutSimulator
+from mrbusUtils import MRBusBit, MRBusPacket
+
+layoutPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'layout.json')
+
+def loadLayoutData():
+  with open(layoutPath) as f:
+    return json.load(f)
+
+def command(text):
+  cmdBytes = text.split(',')
+  return MRBusPacket(cmdBytes[0], 0xFE, cmdBytes[1], [int(str(d),0) for d in cmdBytes[2:]])
+
+def findEntranceSignal(layoutData, name):
+  for cpConfig in layoutData['controlPoints']:
+    for entranceSignal in cpConfig['entranceSignals']:
+      if entranceSignal['name'] == name:
+        return (cpConfig, entranceSignal)
+
+# Waits for a status from the sensor's node with the sensor in the given state
+def waitForSensor(statuses, pattern, state, timeout=5.0):
+  (negate, src, cmd, byteNum, bitNum) = MRBusBit.parsePattern(pattern)
+  endTime = time.monotonic() + timeout
+  while True:
+    try:
+      pkt = statuses.get(timeout=max(0, endTime - time.monotonic()))
+    except queue.Empty:
+      return None
+    if (pkt.src, pkt.cmd) == (src, cmd) and len(pkt.data) > byteNum:
+      if (bool(pkt.data[byteNum] & (1 << bitNum)) != negate) == state:
+        return pkt
+
+@pytest.fixture
+def simulator():
+  statuses = queue.SimpleQueue()
+  with contextlib.redirect_stdout(io.StringIO()):
+    # A long interval, so the statuses seen are the answers and not the repeats
+    sim = LayoutSimulator(loadLayoutData(), statuses.put, statusInterval=60.0)
+  sim.start()
+  yield (sim, statuses)
+  sim.stop()
+
+
+def test_route_command_answered_with_status(simulator):
+  (sim, statuses) = simulator
+  (cpConfig, entranceSignal) = findEntranceSignal(loadLayoutData(), 'Nicolai Main 2 Signal')
+
+  sim.receive(command(entranceSignal['cmd']))
+  assert waitForSensor(statuses, entranceSignal['sensor'], True) is not None
+
+  sim.receive(command(entranceSignal['clr_cmd']))
+  assert waitForSensor(statuses, entranceSignal['sensor'], False) is not None
+  assert sim.getStats()['applied'] == 2
+  assert sim.getStats()['unknown'] == 0
+
+def test_siding_end_lines_the_signals_direction(simulator):
+  (sim, statuses) = simulator
+  (cpConfig, entranceSignal) = findEntranceSignal(loadLayoutData(), 'S Eyak Siding Signal')
+  sensors = { sensor['role']:sensor['source'] for sensor in cpConfig['sensors'] }
+
+  # signal_left, so the left lined bit
+  sim.receive(command(entranceSignal['cmd']))
+  assert waitForSensor(statuses, sensors['sensorLinedLeft'], True) is not None
+
+def test_unknown_command_counted(simulator):
+  (sim, statuses) = simulator
+  with contextlib.redirect_stdout(io.StringIO()):
+    sim.receive(MRBusPacket.fromValues(0x30, 0xFE, 0x43, b'\x00\x00'))
+    sim.stop()
+  assert sim.getStats()['unknown'] == 1
+
+def test_status_interval_must_be_positive():
+  for statusInterval in [0, -1.0]:
+    with pytest.raises(ValueError):
+      with contextlib.redirect_stdout(io.StringIO()):
+        LayoutSimulator(loadLayoutData(), None, statusInterval=statusInterval)
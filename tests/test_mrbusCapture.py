@@ -0,0 +1,149 @@
+import contextlib
+import io
+import os
+import time
+
+import pytest
+
+from mrbusBuffer import MRBusPacketBuffer
+from mrbusCapture import MRBusCaptureReader, MRBusCaptureRecorder, MRBusCaptureReplayer, captureFooter
+from mrbusUtils import MRBusPacket
+
+# Stands in for the monotonic clock, so every record's timestamp is known
+class FakeClock:
+  def __init__(self):
+    self.now = 1000000000
+
+  def monotonic_ns(self):
+    return self.now
+
+  def advance(self, us):
+    self.now += us * 1000
+
+@pytest.fixture
+def clock(monkeypatch):
+  fake = FakeClock()
+  monkeypatch.setattr(time, 'monotonic_ns', fake.monotonic_ns)
+  return fake
+
+# Just enough of MqttMRBus for the replayer to hand packets to
+class ReplayBus:
+  def __init__(self, maxsize):
+    self.incomingPkts = MRBusPacketBuffer(maxsize)
+
+  def packetReceived(self, pkt):
+    self.incomingPkts.put(pkt)
+
+# Records the packets 250ms apart, returning the (timestamp, packet) pairs expected back
+def recordCapture(fileName, clock, pkts, indexInterval=1.0):
+  recorder = MRBusCaptureRecorder(fileName, indexInterval)
+  expected = [ ]
+  for (i, pkt) in enumerate(pkts):
+    recorder.record(pkt)
+    expected.append((i * 250000, pkt))
+    clock.advance(250000)
+  with contextlib.redirect_stdout(io.StringIO()):
+    recorder.close()
+  return expected
+
+def statusPackets(count):
+  return [MRBusPacket.fromValues(0xFF, 0x30 + (i % 8), 0x53, bytes([i % 256, 0x5A])) for i in range(count)]
+
+def readCapture(fileName, startTime=0):
+  with contextlib.redirect_stdout(io.StringIO()):
+    reader = MRBusCaptureReader(fileName)
+    try:
+      return (list(reader.packets(startTime)), len(reader.indexTimes))
+    finally:
+      reader.close()
+
+
+def test_record_read_round_trip(tmp_path, clock):
+  fileName = str(tmp_path / 'round.mrbcap')
+  pkts = statusPackets(20)
+  expected = recordCapture(fileName, clock, pkts)
+  (records, indexEntries) = readCapture(fileName)
+  assert records == expected
+  assert all(type(pkt) is MRBusPacket for (timestamp, pkt) in records)
+  assert indexEntries == 5
+
+def test_raw_payloads_decoded_when_written(tmp_path, clock):
+  fileName = str(tmp_path / 'raw.mrbcap')
+  pkt = MRBusPacket.fromValues(0xFF, 0x30, 0x53, b'\x01\x02')
+  recorder = MRBusCaptureRecorder(fileName)
+  recorder.record(pkt.toJSON().encode())
+  recorder.record(pkt.toBinary())
+  recorder.record(b'not a packet')
+  with contextlib.redirect_stdout(io.StringIO()):
+    recorder.close()
+  assert (recorder.recorded, recorder.failed) == (2, 1)
+  (records, indexEntries) = readCapture(fileName)
+  assert [p for (timestamp, p) in records] == [pkt, pkt]
+
+def test_index_seek_to_mid_file_time(tmp_path, clock):
+  fileName = str(tmp_path / 'seek.mrbcap')
+  expected = recordCapture(fileName, clock, statusPackets(40))
+
+  # Between two index entries and between two records
+  (records, indexEntries) = readCapture(fileName, startTime=5100000)
+  assert indexEntries == 10
+  assert records == [(timestamp, pkt) for (timestamp, pkt) in expected if timestamp >= 5100000]
+  assert records[0][0] == 5250000
+
+  # Right on an index entry
+  (records, indexEntries) = readCapture(fileName, startTime=6000000)
+  assert records[0][0] == 6000000
+  assert len(records) == 16
+
+def test_footer_cut_off_is_scanned(tmp_path, clock):
+  fileName = str(tmp_path / 'cut.mrbcap')
+  expected = recordCapture(fileName, clock, statusPackets(20))
+  reader = MRBusCaptureReader(fileName)
+  indexOffset = reader.recordsEnd
+  reader.close()
+  size = os.path.getsize(fileName)
+
+  # Only part of the footer written, then killed before close so neither index nor footer
+  for length in [size - captureFooter.size // 2, indexOffset]:
+    os.truncate(fileName, length)
+    (records, indexEntries) = readCapture(fileName, startTime=2000000)
+    assert indexEntries == 0
+    assert records == expected[8:]
+
+  # And cut in the middle of the last record
+  os.truncate(fileName, indexOffset - 1)
+  (records, indexEntries) = readCapture(fileName)
+  assert records == expected[:-1]
+
+def test_empty_and_longest_data(tmp_path, clock):
+  fileName = str(tmp_path / 'edges.mrbcap')
+  pkts = [MRBusPacket.fromValues(0xFF, 0x30, 0x53, b''),
+          MRBusPacket.fromValues(0xFF, 0xFF, 0xFF, b'\xff' * 14),
+          MRBusPacket.fromValues(0, 0, 0, b''),
+          MRBusPacket.fromValues(0x30, 0xFE, 0x43, b'\x00' * 14)]
+  expected = recordCapture(fileName, clock, pkts)
+  (records, indexEntries) = readCapture(fileName)
+  assert records == expected
+  assert [len(pkt.data) for (timestamp, pkt) in records] == [0, 14, 0, 14]
+
+def test_replay_delivers_every_packet(tmp_path, clock):
+  fileName = str(tmp_path / 'replay.mrbcap')
+  expected = recordCapture(fileName, clock, statusPackets(50))
+
+  # A buffer smaller than the capture, so the replay has to wait for it to be drained
+  bus = ReplayBus(8)
+  replayer = MRBusCaptureReplayer(bus, fileName, speed=0)
+  received = [ ]
+  with contextlib.redirect_stdout(io.StringIO()):
+    assert replayer.connect()
+    while replayer.isConnected():
+      received.extend(bus.incomingPkts.drain())
+      time.sleep(0.001)
+    replayer.disconnect()
+  received.extend(bus.incomingPkts.drain())
+
+  assert received == [pkt for (timestamp, pkt) in expected]
+  assert replayer.getStats()['replayed'] == 50
+  assert replayer.getStats()['finished']
+  assert bus.incomingPkts.getStats()['dropped'] == 0
+  assert not replayer.isConnected()
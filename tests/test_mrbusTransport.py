@@ -0,0 +1,100 @@
+import os
+import threading
+
+import pytest
+
+import mrbusTransport
+from mrbusBuffer import MRBusPacketBuffer
+from mrbusTransport import SerialTransport
+from mrbusUtils import MRBusPacket
+
+pytestmark = pytest.mark.skipif(mrbusTransport.termios is None or not hasattr(os, 'openpty'), reason="needs termios and ptys")
+
+# Just enough of MqttMRBus for a transport to hand packets to
+class LoopbackBus:
+  recorder = None
+
+  def __init__(self):
+    self.incomingPkts = MRBusPacketBuffer()
+    self.received = threading.Event()
+
+  def packetReceived(self, pkt):
+    self.incomingPkts.put(pkt)
+    self.received.set()
+
+def readPackets(bus, count):
+  pkts = [ ]
+  while len(pkts) < count and bus.received.wait(5.0):
+    bus.received.clear()
+    pkts.extend(bus.incomingPkts.drain())
+  return pkts
+
+@pytest.fixture
+def pty():
+  (master, slave) = os.openpty()
+  yield (master, os.ttyname(slave))
+  os.close(slave)
+  os.close(master)
+
+
+def test_received_line_reaches_buffer(pty):
+  (master, device) = pty
+  bus = LoopbackBus()
+  transport = SerialTransport(bus, device)
+  assert transport.connect()
+  try:
+    # Interface chatter first, then a packet split across two writes
+    os.write(master, b"Ok\r\nP:FF 30 09 12 34 53 01 02")
+    os.write(master, b" FF\r\n")
+    pkts = readPackets(bus, 1)
+  finally:
+    transport.disconnect()
+
+  assert pkts == [MRBusPacket.fromValues(0xFF, 0x30, 0x53, b'\x01\x02\xff')]
+  assert transport.badLines == 0
+
+def test_bad_line_is_counted(pty):
+  (master, device) = pty
+  bus = LoopbackBus()
+  transport = SerialTransport(bus, device)
+  assert transport.connect()
+  try:
+    os.write(master, b"P:FF 30 0C 12 34 53 01\r\nP:FF 31 06 00 00 41\r\n")
+    pkts = readPackets(bus, 1)
+  finally:
+    transport.disconnect()
+
+  assert pkts == [MRBusPacket.fromValues(0xFF, 0x31, 0x41, b'')]
+  assert transport.badLines == 1
+
+def test_send_writes_command_line(pty):
+  (master, device) = pty
+  transport = SerialTransport(LoopbackBus(), device)
+  assert transport.connect()
+  try:
+    transport.send(MRBusPacket.fromValues(0x30, 0xFE, 0x43, b'\x47\x04'))
+    written = b''
+    while not written.endswith(b'\r') and not written.endswith(b'\n'):
+      written += os.read(master, 256)
+  finally:
+    transport.disconnect()
+
+  assert written.strip() == b":FE->30 43 47 04;"
+
+def test_port_closed_when_other_end_goes_away():
+  (master, slave) = os.openpty()
+  transport = SerialTransport(LoopbackBus(), os.ttyname(slave))
+  try:
+    assert transport.connect()
+    # Only the transport has the device open now, so it sees a hang up
+    os.close(slave)
+    os.close(master)
+    transport.readerThread.join(5.0)
+    assert not transport.readerThread.is_alive()
+    assert not transport.isConnected()
+
+    # Anything sent after that is dropped
+    transport.send(MRBusPacket.fromValues(0x30, 0xFE, 0x43, b'\x47\x04'))
+  finally:
+    transport.disconnect()
+  assert not transport.isConnected()
@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+from mrbusUtils import MRBusPacket, MRBusDecoder
+
+def randomPackets(count=500, seed=1):
+  rng = random.Random(seed)
+  pkts = [ ]
+  for i in range(count):
+    data = bytes(rng.randrange(256) for d in range(rng.randrange(0, 15)))
+    pkts.append(MRBusPacket.fromValues(rng.randrange(256), rng.randrange(256), rng.randrange(256), data))
+
+  # The edges - no data, and every byte all ones
+  pkts.append(MRBusPacket.fromValues(0, 0, 0, b''))
+  pkts.append(MRBusPacket.fromValues(0xFF, 0xFF, 0xFF, b''))
+  pkts.append(MRBusPacket.fromValues(0xFF, 0xFF, 0xFF, b'\xff' * 14))
+  return pkts
+
+
+def test_binary_round_trip():
+  for pkt in randomPackets():
+    (decoded, timestamp) = MRBusPacket.fromBinary(pkt.toBinary(1234567890123456))
+    assert decoded == pkt
+    assert (decoded.dest, decoded.src, decoded.cmd, decoded.data) == (pkt.dest, pkt.src, pkt.cmd, pkt.data)
+    assert type(decoded) is MRBusPacket
+    assert timestamp == 1234567890123456
+
+def test_json_round_trip():
+  for pkt in randomPackets(seed=2):
+    decoded = MRBusPacket.fromJSON(pkt.toJSON())
+    assert decoded == pkt
+    assert type(decoded) is MRBusPacket
+
+def test_decoder_round_trip():
+  decoder = MRBusDecoder()
+  for pkt in randomPackets(seed=3):
+    assert decoder.decode(pkt.toBinary()) == pkt
+    assert decoder.decode(pkt.toJSON().encode()) == pkt
+  assert decoder.failed == 0
+
+def test_bad_binary_frames():
+  frame = MRBusPacket.fromValues(0xFF, 0x30, 0x53, b'\xff' * 4).toBinary()
+  assert MRBusPacket.fromBinary(frame[:-1]) is None
+  assert MRBusPacket.fromBinary(frame + b'\x00') is None
+  assert MRBusPacket.fromBinary(frame[:5]) is None
+  assert MRBusPacket.fromBinary(b'\x02' + frame[1:]) is None
+
+def test_decoder_rejects_bad_source():
+  decoder = MRBusDecoder()
+  decoder.setWantedSources([0x30])
+  for payload in [b'{"src": 08, "dst": 255, "cmd": 83, "data": [], "type": "pkt"}',
+                  b'{"src": "08", "dst": 255, "cmd": 83, "data": [], "type": "pkt"}']:
+    assert decoder.decode(payload) is None
+  assert decoder.failed == 2
+
+  decoder.setWantedSources(None)
+  assert decoder.decode(b'{"src": "08", "dst": 255, "cmd": 83, "data": [], "type": "pkt"}') is None
+  assert decoder.failed == 3
+
+def test_decoder_filters_unwanted_sources():
+  decoder = MRBusDecoder()
+  decoder.setWantedSources([0x30])
+  wanted = MRBusPacket.fromValues(0xFF, 0x30, 0x53, b'\x01')
+  unwanted = MRBusPacket.fromValues(0xFF, 0x31, 0x53, b'\x01')
+  assert decoder.decode(wanted.toJSON().encode()) == wanted
+  assert decoder.decode(wanted.toBinary()) == wanted
+  assert decoder.decode(unwanted.toJSON().encode()) is None
+  assert decoder.decode(unwanted.toBinary()) is None
+  assert (decoder.decoded, decoder.filtered, decoder.failed) == (2, 2, 0)
+
+def test_packet_formatting():
+  pkt = MRBusPacket.fromValues(0x30, 0xFE, 0x43, b'\x47\x04')
+  assert "[%s]" % (str(pkt)) == "[packet(0xFE->0x30) (0x43 'C')  2:['0x47', '0x04']]"
+  assert "[%s]" % (str(MRBusPacket.fromValues(0xFF, 0x30, 0x05, b''))) == "[packet(0x30->0xFF) (0x05    )  0:[]]"
+
+  # On its own a packet is the format's argument tuple, hence str(pkt) everywhere
+  with pytest.raises(TypeError):
+    "[%s]" % (pkt)
+  assert repr(pkt) == "mrbus.packet(0x30, 0xfe, 0x43, [71, 4])"
+
+def test_packet_only_equals_packets():
+  pkt = MRBusPacket.fromValues(0xFF, 0x30, 0x53, b'\x01')
+  assert pkt == MRBusPacket(0xFF, 0x30, 0x53, [1])
+  assert pkt != (0xFF, 0x30, 0x53, b'\x01')
+  assert not pkt == (0xFF, 0x30, 0x53, b'\x01')
+  assert pkt != MRBusPacket.fromValues(0xFF, 0x30, 0x53, b'\x02')
+  assert len(set([pkt, MRBusPacket(0xFF, 0x30, 0x53, [1])])) == 1
@@ -0,0 +1,111 @@
+from cells import TrackCellType
+
+# Where the route tracer goes next from each kind of cell, walking left and walking
+# right - (dx, dy) with the switch normal, (dx, dy) with it reversed.  A cell type
+# that isn't here stops the trace before that cell, and an END cell is the last one
+# traced, with the route carrying on into whatever block owns the cell beyond it.
+leftSteps = {
+  TrackCellType.HORIZONTAL:        ((-1, 0), (-1, 0)),
+  TrackCellType.END_HORIZ_RIGHT:   ((-1, 0), (-1, 0)),
+  TrackCellType.DIAG_LEFT_UP:      ((-1, -1), (-1, -1)),
+  TrackCellType.DIAG_RIGHT_UP:     ((-1, 1), (-1, 1)),
+  TrackCellType.ANGLE_LEFT_UP:     ((-1, -1), (-1, -1)),
+  TrackCellType.ANGLE_LEFT_DOWN:   ((-1, 1), (-1, 1)),
+  TrackCellType.ANGLE_RIGHT_UP:    ((-1, 0), (-1, 0)),
+  TrackCellType.ANGLE_RIGHT_DOWN:  ((-1, 0), (-1, 0)),
+  TrackCellType.SWITCH_RIGHT_UP:   ((-1, 0), (-1, 0)),
+  TrackCellType.SWITCH_RIGHT_DOWN: ((-1, 0), (-1, 0)),
+  TrackCellType.SWITCH_LEFT_UP:    ((-1, 0), (-1, -1)),
+  TrackCellType.SWITCH_LEFT_DOWN:  ((-1, 0), (-1, 1)),
+}
+
+rightSteps = {
+  TrackCellType.HORIZONTAL:        ((1, 0), (1, 0)),
+  TrackCellType.END_HORIZ_LEFT:    ((1, 0), (1, 0)),
+  TrackCellType.DIAG_LEFT_UP:      ((1, 1), (1, 1)),
+  TrackCellType.DIAG_RIGHT_UP:     ((1, -1), (1, -1)),
+  TrackCellType.ANGLE_LEFT_UP:     ((1, 0), (1, 0)),
+  TrackCellType.ANGLE_LEFT_DOWN:   ((1, 0), (1, 0)),
+  TrackCellType.ANGLE_RIGHT_UP:    ((1, -1), (1, -1)),
+  TrackCellType.ANGLE_RIGHT_DOWN:  ((1, 1), (1, 1)),
+  TrackCellType.SWITCH_RIGHT_UP:   ((1, 0), (1, -1)),
+  TrackCellType.SWITCH_RIGHT_DOWN: ((1, 0), (1, 1)),
+  TrackCellType.SWITCH_LEFT_UP:    ((1, 0), (1, 0)),
+  TrackCellType.SWITCH_LEFT_DOWN:  ((1, 0), (1, 0)),
+}
+
+switchTypes = [ TrackCellType.SWITCH_RIGHT_UP, TrackCellType.SWITCH_RIGHT_DOWN, TrackCellType.SWITCH_LEFT_UP, TrackCellType.SWITCH_LEFT_DOWN ]
+
+# Edges walking left and right from a cell
+class TrackNode:
+  __slots__ = ('nextNormal', 'nextReverse', 'isSwitch', 'isEnd', 'exitBlock')
+
+  def __init__(self):
+    self.nextNormal = None    # Next cell with the switch normal, or the only next cell
+    self.nextReverse = None   # Next cell with the switch reversed
+    self.isSwitch = False     # Only switches look at their position
+    self.isEnd = False        # The trace stops after this cell...
+    self.exitBlock = None     # ...and carries on into this block, if there is one
+
+
+# The layout's cells compiled into a directed graph, so tracing a route is a walk
+# from node to node instead of working out each cell's exits as it goes.  Built
+# once the layout is loaded - cells don't change type or move after that.
+class TrackGraph:
+  def __init__(self, cellXY):
+    self.cellXY = cellXY
+    self.nodes = { }   # (cell, walkLeft) -> TrackNode, no entry where the trace stops
+    self.compile()
+
+  def compile(self):
+    self.nodes = { }
+    for ((x, y), cell) in self.cellXY.items():
+      for walkLeft in [True, False]:
+        node = self.compileNode(cell, x, y, walkLeft)
+        if node is not None:
+          self.nodes[(cell, walkLeft)] = node
+
+  def compileNode(self, cell, x, y, walkLeft):
+    node = TrackNode()
+    if walkLeft and cell.trackType == TrackCellType.END_HORIZ_LEFT:
+      exitXY = (x - 1, y)
+    elif not walkLeft and cell.trackType == TrackCellType.END_HORIZ_RIGHT:
+      exitXY = (x + 1, y)
+    else:
+      exitXY = None
+
+    if exitXY is not None:
+      node.isEnd = True
+      nextCell = self.cellXY.get(exitXY)
+      if nextCell is not None and nextCell.owner is not None:
+        node.exitBlock = nextCell.owner.name
+      return node
+
+    steps = leftSteps if walkLeft else rightSteps
+    if cell.trackType not in steps:
+      return None   # Don't know where to go from here
+
+    ((dx, dy), (rdx, rdy)) = steps[cell.trackType]
+    node.nextNormal = self.cellXY.get((x + dx, y + dy))
+    node.nextReverse = self.cellXY.get((x + rdx, y + rdy))
+    node.isSwitch = cell.trackType in switchTypes
+    return node
+
+  # Follows the track from startXY, returning the cells passed over and the name of
+  # the block the route carries on into, if it reaches one
+  def trace(self, startXY, walkLeft):
+    nodes = self.nodes
+    cells = [ ]
+    cell = self.cellXY.get(startXY)
+    while cell is not None:
+      node = nodes.get((cell, walkLeft))
+      if node is None:
+        break
+      cells.append(cell)
+      if node.isEnd:
+        return (cells, node.exitBlock)
+      if node.isSwitch and cell.switchState != 0:
+        cell = node.nextReverse
+      else:
+        cell = node.nextNormal
+    return (cells, None)